@@ -0,0 +1,477 @@
+"""
+生成链路性能基准测试
+用法:
+    python benchmark.py run [--quick] [--rows 100,1000,10000,100000] [--output 结果.json]
+    python benchmark.py compare 基准结果.json 本次结果.json [--threshold 0.1]
+    python benchmark.py gen-excel 行数 [输出路径]
+    python benchmark.py imports [--top 15]
+
+run 使用合成数据测量金额大写、年龄、context 构建、Excel/Word 模板渲染、到期清单解析等热点函数，
+并通过进程内 ASGI 客户端测量 /api/generate 和 /api/customers 的端到端耗时。
+结果保存为 JSON（默认 bench_results/时间戳.json）；compare 按中位数对比两次结果，
+变慢超过阈值的项目视为性能回退，退出码为 1。
+imports 报告 import main 的耗时按包分解，以及服务启动到开始响应、到后台预热完成的时间。
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from datetime import date, datetime, timedelta
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULT_DIR = os.path.join(BASE_DIR, "bench_results")
+DATA_DIR = os.path.join(BASE_DIR, "bench_data")
+DEFAULT_ROWS = "100,1000,10000,100000"
+QUICK_ROWS = "100,1000"
+SEED = 20240101
+
+# ============= 合成数据 =============
+
+SURNAMES = "赵钱孙李周吴郑王冯陈褚卫蒋沈韩杨朱秦尤许何吕施张孔曹严华金魏陶姜"
+GIVEN_CHARS = "伟芳娜敏静丽强磊军洋勇艳杰娟涛明超秀霞平刚桂英华玉萍红鹏飞"
+BRANCHES = ["营业部", "城东支行", "城西支行", "滨江支行", "西湖支行", "新罗支行", "漳平支行"]
+ID_WEIGHTS = [7, 9, 10, 5, 8, 4, 2, 1, 6, 3, 7, 9, 10, 5, 8, 4, 2]
+ID_CHECK = "10X98765432"
+
+# 与 贷款到期清单.xlsx 的列一致
+CUSTOMER_COLUMNS = [
+    "客户主体", "支行简称", "贷款人", "证件号（对公情况）", "联系方式（对公情况）", "住址",
+    "配偶名", "身份证", "联系方式",
+    "共同借款人1名称", "共同借款人1证件号", "共同借款人1联系方式",
+    "共同借款人2名称", "共同借款人2证件号", "共同借款人2联系方式",
+] + [f"担保人{i}{suffix}" for i in range(1, 6) for suffix in ("名称", "身份证", "联系方式")] + ["到期日"]
+
+
+def fake_name(rng):
+    return rng.choice(SURNAMES) + "".join(rng.choice(GIVEN_CHARS) for _ in range(rng.randint(1, 2)))
+
+
+def fake_id_card(rng):
+    birth = date(1955, 1, 1) + timedelta(days=rng.randint(0, 16000))
+    body = f"350{rng.randint(100, 999)}{birth:%Y%m%d}{rng.randint(0, 999):03d}"
+    return body + ID_CHECK[sum(int(d) * w for d, w in zip(body, ID_WEIGHTS)) % 11]
+
+
+def fake_credit_code(rng):
+    return "91350" + "".join(rng.choice("0123456789ABCDEFGHJKLMNPQRTUWXY") for _ in range(13))
+
+
+def fake_mobile(rng):
+    return "1" + rng.choice("3589") + "".join(rng.choice("0123456789") for _ in range(9))
+
+
+def fake_person(rng, relation=""):
+    return {
+        "name": fake_name(rng),
+        "id_card": fake_id_card(rng),
+        "mobile": fake_mobile(rng),
+        "relation": relation,
+        "address": f"漳平市{rng.choice(['菁城', '桂林', '和平'])}街道{rng.randint(1, 300)}号",
+        "gender": rng.choice(["男", "女"]),
+        "ethnicity": "汉族",
+        "education": rng.choice(["大专", "本科", "高中"]),
+        "occupation": rng.choice(["个体经营", "职员", "农户"]),
+    }
+
+
+def make_request(rng, templates, joint=1, guarantors=2, collaterals=1):
+    """合成一个个人客户的 ContractRequest 请求体"""
+    start = date(2024, 1, 1) + timedelta(days=rng.randint(0, 365))
+    return {
+        "customer_type": "personal",
+        "loan_type": rng.choice(["credit", "guarantee", "mortgage"]),
+        "branch": {"name": "漳平农商银行营业部", "short_name": rng.choice(BRANCHES)},
+        "main_borrower": fake_person(rng),
+        "spouse": fake_person(rng, "配偶"),
+        "joint_borrowers": [fake_person(rng, "子女") for _ in range(joint)],
+        "guarantors": [fake_person(rng, "朋友") for _ in range(guarantors)],
+        "collaterals": [{
+            "owner": fake_name(rng), "type": "房产", "cert_no": f"闽({start.year})漳平市不动产权第{rng.randint(1, 99999):07d}号",
+            "location": "漳平市菁城街道", "value": round(rng.uniform(1e5, 5e6), 2), "area": f"{rng.randint(50, 300)}㎡",
+        } for _ in range(collaterals)],
+        "loan_amount": rng.randint(1, 500) * 10000,
+        "loan_term": rng.choice([12, 24, 36]),
+        "start_date": start.isoformat(),
+        "end_date": (start + timedelta(days=365 * 3)).isoformat(),
+        "loan_use": "经营周转",
+        "selected_templates": list(templates),
+    }
+
+
+def make_customer_row(rng):
+    enterprise = rng.random() < 0.2
+    row = {
+        "客户主体": "enterprise" if enterprise else "personal",
+        "支行简称": rng.choice(BRANCHES),
+        "贷款人": (fake_name(rng) + "贸易有限公司") if enterprise else fake_name(rng),
+        "证件号（对公情况）": fake_credit_code(rng) if enterprise else fake_id_card(rng),
+        "联系方式（对公情况）": fake_mobile(rng),
+        "住址": "漳平市菁城街道",
+        "到期日": (date(2025, 1, 1) + timedelta(days=rng.randint(0, 730))).isoformat(),
+    }
+    if not enterprise and rng.random() < 0.7:
+        row.update({"配偶名": fake_name(rng), "身份证": fake_id_card(rng), "联系方式": fake_mobile(rng)})
+    for i in range(1, rng.randint(1, 3)):
+        row.update({f"共同借款人{i}名称": fake_name(rng), f"共同借款人{i}证件号": fake_id_card(rng), f"共同借款人{i}联系方式": fake_mobile(rng)})
+    for i in range(1, rng.randint(1, 6)):
+        row.update({f"担保人{i}名称": fake_name(rng), f"担保人{i}身份证": fake_id_card(rng), f"担保人{i}联系方式": fake_mobile(rng)})
+    return [row.get(col) for col in CUSTOMER_COLUMNS]
+
+
+def write_customer_excel(path, rows, seed=SEED):
+    """生成指定行数的到期清单 Excel"""
+    import openpyxl
+
+    rng = random.Random(seed)
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(CUSTOMER_COLUMNS)
+    for _ in range(rows):
+        ws.append(make_customer_row(rng))
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    wb.save(path)
+    return path
+
+
+def customer_excel(rows):
+    """bench_data 下按行数缓存的合成到期清单，已存在时直接复用"""
+    path = os.path.join(DATA_DIR, f"到期清单_{rows}.xlsx")
+    if not os.path.exists(path):
+        print(f"  生成 {rows} 行到期清单 ...", flush=True)
+        write_customer_excel(path, rows)
+    return path
+
+# ============= 计时 =============
+
+
+def summarize(samples, number):
+    return {
+        "median": statistics.median(samples),
+        "min": min(samples),
+        "mean": statistics.fmean(samples),
+        "max": max(samples),
+        "repeat": len(samples),
+        "number": number,
+    }
+
+
+def measure(fn, repeat=5, number=None):
+    """每次调用的耗时（秒）；number 为空时自动确定每轮调用次数（每轮至少 0.2 秒）"""
+    timer = timeit.Timer(fn)
+    if number is None:
+        number, _ = timer.autorange()
+    return summarize([t / number for t in timer.repeat(repeat=repeat, number=number)], number)
+
+
+class Runner:
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = {}
+
+    def bench(self, name, fn, repeat=None, number=None, **extra):
+        try:
+            result = measure(fn, repeat or self.repeat, number)
+        except Exception as e:
+            result = {"error": f"{type(e).__name__}: {e}"}
+        result.update(extra)
+        self.results[name] = result
+        if "error" in result:
+            print(f"  {name:<60} 失败: {result['error']}")
+        else:
+            print(f"  {name:<60} {format_seconds(result['median']):>12}")
+        return result
+
+
+def format_seconds(seconds):
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.1f} us"
+    if seconds < 1:
+        return f"{seconds * 1e3:.2f} ms"
+    return f"{seconds:.3f} s"
+
+# ============= 基准项目 =============
+
+
+def usable_templates(main):
+    """模板目录中能正常解析的模板"""
+    names = sorted(n for n in os.listdir(main.TEMPLATE_DIR) if n.endswith((".docx", ".xlsx")))
+    results = [main.analyze_template_file(n, os.path.join(main.TEMPLATE_DIR, n)) for n in names]
+    return [r["name"] for r in results if r["ok"]]
+
+
+def bench_micro(main, runner, templates):
+    rng = random.Random(SEED)
+    amounts = [round(rng.uniform(0, 1e9), 2) for _ in range(1000)]
+    id_cards = [fake_id_card(rng) for _ in range(1000)]
+
+    print("微基准:")
+    runner.bench("num_to_cn.uncached_x1000", lambda: [main._amount_to_cn.__wrapped__(main.to_amount(a)) for a in amounts])
+    runner.bench("num_to_cn.cached_x1000", lambda: [main.num_to_cn(a) for a in amounts])
+    runner.bench("num_to_cn_batch_x1000", lambda: main.num_to_cn_batch(amounts))
+    runner.bench("calculate_age_x1000", lambda: [main.calculate_age(c) for c in id_cards])
+
+    data = main.ContractRequest(**make_request(rng, [], joint=3, guarantors=7, collaterals=5))
+    full = main.build_complete_context(data)
+    runner.bench("flatten_context", lambda: main.flatten_context(full))
+    runner.bench("build_complete_context.full", lambda: main.build_complete_context(data))
+    for name in templates:
+        keys = main.template_context_keys([name])
+        runner.bench(f"build_complete_context.keyed.{name}", lambda: main.build_complete_context(data, keys),
+                     keys=len(keys) if keys is not None else None)
+
+    print("模板渲染:")
+    for name in templates:
+        path = os.path.join(main.TEMPLATE_DIR, name)
+        context = main.build_complete_context(data)
+        if main.is_investigation_template(name):
+            context = {**context, **main.generate_investigation_context(data)}
+
+        def render(name=name, path=path, context=context):
+            result = main.render_template_job(name, path, name, context)
+            if "error" in result:
+                raise RuntimeError(result["error"])
+
+        runner.bench(f"render.{name}", render, number=1)
+
+
+def bench_customers(main, runner, rows_list):
+    print("到期清单:")
+    for rows in rows_list:
+        path = customer_excel(rows)
+        repeat = 1 if rows >= 50000 else min(runner.repeat, 3)
+        runner.bench(f"parse_customer_excel.{rows}", lambda: main.parse_customer_excel(path), repeat=repeat, number=1, rows=rows)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            store = main.CustomerStore(os.path.join(tmp, "customers.db"))
+            main.CustomerListCache(path, store).get()
+            # 重启后的首次读取：清单未变，直接从客户库加载
+            runner.bench(f"customer_store_load.{rows}", lambda: main.CustomerListCache(path, store).get(),
+                         repeat=repeat, number=1, rows=rows)
+            customers = store.fetch()
+            runner.bench(f"customer_store_query.{rows}", lambda: store.query(BRANCHES[1], "2000-01-01", "2099-12-31"),
+                         repeat=repeat, rows=rows)
+            runner.bench(f"customer_store_get.{rows}", lambda: store.get(customers[len(customers) // 2][0]), rows=rows)
+
+
+def bench_endpoints(main, runner, templates, rows_list):
+    from fastapi.testclient import TestClient
+
+    rng = random.Random(SEED)
+    payload = make_request(rng, templates)
+    cache = main.render_cache
+    cache_settings = (cache.directory, cache.max_bytes)
+
+    print("端到端:")
+    with TestClient(main.app) as client:
+        # 等后台启动预热结束，避免与计时重叠
+        main.warmup.wait()
+
+        def generate():
+            r = client.post("/api/generate", json=payload)
+            if r.status_code != 200:
+                raise RuntimeError(f"HTTP {r.status_code}: {r.text[:200]}")
+
+        try:
+            # 第一次请求包含渲染进程启动和模板加载，不计入
+            cache.max_bytes = 0
+            generate()
+            runner.bench("e2e.generate", generate, number=1, templates=len(templates))
+
+            with tempfile.TemporaryDirectory() as tmp:
+                cache.directory = tmp
+                cache.max_bytes = 64 * 1024 * 1024
+                cache._index = None
+                generate()
+                runner.bench("e2e.generate_cached", generate, number=1, templates=len(templates))
+        finally:
+            # 恢复原缓存目录，索引在下次使用时按原目录重新加载
+            cache.directory, cache.max_bytes = cache_settings
+            cache._index = None
+            cache._total = 0
+
+        original = main.customer_cache
+        try:
+            for rows in rows_list:
+                with tempfile.TemporaryDirectory() as tmp:
+                    store = main.CustomerStore(os.path.join(tmp, "customers.db"))
+                    main.customer_cache = main.CustomerListCache(customer_excel(rows), store)
+                    client.get("/api/customers")
+                    runner.bench(f"e2e.customers.{rows}", lambda: client.get("/api/customers").raise_for_status(),
+                                 repeat=min(runner.repeat, 3), number=1, rows=rows)
+        finally:
+            main.customer_cache = original
+
+
+# 在新进程中测量启动耗时：导入 main、启动钩子执行完（开始响应）、后台预热完成
+STARTUP_SCRIPT = """
+import json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+with TestClient(main.app) as client:
+    client.get("/api/ready")
+    serving = time.perf_counter()
+    main.warmup.wait()
+    ready = time.perf_counter()
+    print(json.dumps({"import": imported - start, "serving": serving - start, "ready": ready - start,
+                      "steps": main.warmup.to_dict()["steps"]}))
+"""
+
+
+def import_times():
+    """python -X importtime 的结果：[(模块, 自身微秒, 累计微秒)]"""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=BASE_DIR,
+                          capture_output=True, text=True, check=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((name.strip(), int(self_us), int(cumulative)))
+    return rows
+
+
+def imports(args):
+    rows = import_times()
+    main_row = next(r for r in rows if r[0] == "main")
+    packages = {}
+    for name, self_us, _ in rows:
+        top = name.split(".")[0]
+        packages[top] = packages.get(top, 0) + self_us
+
+    print(f"import main: {format_seconds(main_row[2] / 1e6)}（main 模块自身 {format_seconds(main_row[1] / 1e6)}）")
+    print(f"{'包':<30} {'耗时':>12} {'占比':>8}")
+    for top, total in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{top:<30} {format_seconds(total / 1e6):>12} {total / main_row[2]:>8.1%}")
+
+    proc = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=BASE_DIR,
+                          capture_output=True, text=True, check=True)
+    startup = json.loads(proc.stdout.strip().splitlines()[-1])
+    print(f"\n开始响应: {format_seconds(startup['serving'])}（其中导入 {format_seconds(startup['import'])}）")
+    print(f"预热完成: {format_seconds(startup['ready'])}")
+    for name, step in startup["steps"].items():
+        error = f"  失败: {step['error']}" if step.get("error") else ""
+        print(f"  {name:<20} {format_seconds(step.get('seconds', 0)):>12}{error}")
+    return 0
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run(args):
+    # 渲染缓存会让重复请求直接命中，基准测试默认关闭（e2e.generate_cached 单独测量）
+    os.environ.setdefault("BANK_RENDER_CACHE_MB", "0")
+    # 不把基准测试生成的文件包留档到 output 目录
+    os.environ.setdefault("BANK_SAVE_OUTPUT_COPY", "0")
+    sys.path.insert(0, BASE_DIR)
+    import main
+
+    rows_list = [int(r) for r in (args.rows or (QUICK_ROWS if args.quick else DEFAULT_ROWS)).split(",") if r]
+    runner = Runner(repeat=3 if args.quick else 5)
+    templates = usable_templates(main)
+
+    started = time.time()
+    bench_micro(main, runner, templates)
+    bench_customers(main, runner, rows_list)
+    # 端到端使用 data.json 中配置的模板（即前端可选的模板）
+    configured = [t["filename"] for t in main.config_registry.system_config.get("templates", [])]
+    bench_endpoints(main, runner, [t for t in configured if t in templates] or templates, rows_list)
+
+    report = {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "git": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "render_backend": f"{main.RENDER_BACKEND} x {main.RENDER_WORKERS}",
+            "rows": rows_list,
+            "duration": round(time.time() - started, 1),
+        },
+        "results": runner.results,
+    }
+    output = args.output or os.path.join(RESULT_DIR, f"{datetime.now():%Y%m%d_%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存: {output}")
+    return 0
+
+
+def compare(args):
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)["results"]
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)["results"]
+
+    regressions = 0
+    print(f"{'项目':<50} {'基准':>12} {'本次':>12} {'变化':>8}")
+    for name in sorted(set(base) | set(new)):
+        b, n = base.get(name), new.get(name)
+        if not b or not n or "median" not in b or "median" not in n:
+            print(f"{name:<50} {'-' if not b or 'median' not in b else format_seconds(b['median']):>12} "
+                  f"{'-' if not n or 'median' not in n else format_seconds(n['median']):>12}")
+            continue
+        change = n["median"] / b["median"] - 1
+        flag = ""
+        if change > args.threshold:
+            flag = "  ⚠️ 变慢"
+            regressions += 1
+        elif change < -args.threshold:
+            flag = "  ✅ 变快"
+        print(f"{name:<50} {format_seconds(b['median']):>12} {format_seconds(n['median']):>12} {change:>+8.1%}{flag}")
+    print(f"性能回退 {regressions} 项（阈值 {args.threshold:.0%}）")
+    return 1 if regressions else 0
+
+
+def gen_excel(args):
+    path = args.path or os.path.join(DATA_DIR, f"到期清单_{args.rows}.xlsx")
+    write_customer_excel(path, args.rows)
+    print(f"已生成: {path}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成链路性能基准测试")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("run", help="运行基准测试")
+    p.add_argument("--quick", action="store_true", help="少量数据、较少重复次数")
+    p.add_argument("--rows", help=f"到期清单行数，逗号分隔（默认 {DEFAULT_ROWS}）")
+    p.add_argument("--output", help="结果 JSON 路径")
+    p.set_defaults(func=run)
+
+    p = sub.add_parser("compare", help="对比两次结果")
+    p.add_argument("base")
+    p.add_argument("new")
+    p.add_argument("--threshold", type=float, default=0.1, help="判定为回退的变慢比例（默认 0.1）")
+    p.set_defaults(func=compare)
+
+    p = sub.add_parser("gen-excel", help="生成合成到期清单")
+    p.add_argument("rows", type=int)
+    p.add_argument("path", nargs="?")
+    p.set_defaults(func=gen_excel)
+
+    p = sub.add_parser("imports", help="导入耗时分解与启动耗时")
+    p.add_argument("--top", type=int, default=15, help="显示耗时最多的前 N 个包")
+    p.set_defaults(func=imports)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
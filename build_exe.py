@@ -1,7 +1,13 @@
 import PyInstaller.__main__
+import argparse
 import os
 import shutil
 
+# --onedir: 生成目录版（dist/BankContractSystem/），启动时不必先把全部文件解压到临时目录，双击后打开更快
+parser = argparse.ArgumentParser(description="Build BankContractSystem executable")
+parser.add_argument("--onedir", action="store_true", help="build a folder instead of a single exe (faster startup)")
+options = parser.parse_args()
+
 print(">>> Starting build process...")
 
 # Clean old builds
@@ -16,7 +22,7 @@ sep = ';' if os.name == 'nt' else ':'
 args = [
     'main.py',
     '--name=BankContractSystem',
-    '--onefile',
+    '--onedir' if options.onedir else '--onefile',
     '--noconsole',
     '--clean',
     
@@ -42,5 +48,8 @@ args = [
 print("Building executable...")
 PyInstaller.__main__.run(args)
 
-print(">>> Build complete! Executable in dist/")
+if options.onedir:
+    print(">>> Build complete! Folder in dist/BankContractSystem/ (copy the whole folder)")
+else:
+    print(">>> Build complete! Executable in dist/")
 
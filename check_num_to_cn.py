@@ -0,0 +1,88 @@
+"""
+金额大写前后端一致性校验
+用法: python check_num_to_cn.py [样本数量]
+
+用 node 执行 frontend/src/utils.ts 中的 numToChinese，与后端 num_to_cn 逐个比对，
+输出不一致的金额。前端使用浮点运算，个别“x.xx5”类金额的舍入可能与后端（十进制四舍五入）不同。
+"""
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+UTILS_TS = os.path.join(BASE_DIR, "frontend", "src", "utils.ts")
+
+# 容易出错的边界金额：节内/节间的零、纯角分、进位
+EDGE_CASES = [
+    0, 0.01, 0.1, 0.5, 0.05, 1, 1.01, 1.1, 10, 10.5, 11, 100, 100.05, 101, 110,
+    1000, 1001, 1010, 1100, 10000, 10001, 10010, 10100, 11000, 100000, 100001,
+    1000000, 1000010, 10000000, 100000000, 100000001, 100010000, 101000000,
+    1000000000, 1234567.89, 99999999.99, 500000, 19.99, 0.29, 0.57,
+]
+
+
+def load_frontend_function():
+    """从 utils.ts 中取出 numToChinese 并去掉类型标注，得到可直接执行的 JS"""
+    with open(UTILS_TS, encoding="utf-8") as f:
+        source = f.read()
+    match = re.search(r"export function numToChinese\(num: number\): string \{.*?\n\}", source, re.S)
+    if not match:
+        raise RuntimeError("utils.ts 中未找到 numToChinese")
+    js = match.group(0)
+    js = js.replace("export function numToChinese(num: number): string", "function numToChinese(num)")
+    return js
+
+
+def run_frontend(values):
+    script = load_frontend_function() + """
+let input = '';
+process.stdin.on('data', c => input += c);
+process.stdin.on('end', () => {
+    const values = JSON.parse(input);
+    process.stdout.write(JSON.stringify(values.map(numToChinese)));
+});
+"""
+    proc = subprocess.run(
+        ["node", "-e", script], input=json.dumps(values).encode("utf-8"),
+        capture_output=True, check=True,
+    )
+    return json.loads(proc.stdout.decode("utf-8"))
+
+
+def sample_values(count, seed=20240101):
+    rng = random.Random(seed)
+    values = list(EDGE_CASES)
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.4:
+            # 常见贷款金额：整万、整千
+            values.append(rng.randint(1, 9999) * rng.choice([100, 1000, 10000]))
+        elif kind < 0.8:
+            values.append(round(rng.randint(0, 10 ** 10) / 100, 2))
+        else:
+            # 稀疏数字，覆盖节间零
+            digits = [rng.choice("0000000123456789") for _ in range(rng.randint(1, 12))]
+            values.append(int("".join(digits)))
+    return values
+
+
+def main():
+    from main import num_to_cn_batch
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    values = sample_values(count)
+    backend = num_to_cn_batch(values)
+    frontend = run_frontend(values)
+
+    mismatches = [(v, b, f) for v, b, f in zip(values, backend, frontend) if b != f]
+    for value, b, f in mismatches[:50]:
+        print(f"{value}\n  后端: {b}\n  前端: {f}")
+    print(f"共比对 {len(values)} 个金额，不一致 {len(mismatches)} 个")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,22 +1,50 @@
 // TXT文件解析
-function parseTxtFile(content) {
-    const match = content.match(/SYSTEM_DATA_START:(.*):SYSTEM_DATA_END/);
+// SYSTEM_DATA 旧格式为 Base64(JSON)；新格式为 SD2.<数据结构版本>.<Base64(zlib 压缩的 JSON)>
+function base64ToBytes(base64Data) {
+    const binaryString = atob(base64Data);
+    const bytes = new Uint8Array(binaryString.length);
+    for (let i = 0; i < binaryString.length; i++) {
+        bytes[i] = binaryString.charCodeAt(i);
+    }
+    return bytes;
+}
+
+// 能读取的最高数据结构版本（与后端 SYSTEM_DATA_SCHEMA 一致）
+const SYSTEM_DATA_SCHEMA = 1;
+
+// 存档由更新版本的系统生成：字段含义可能已变化，不能按当前结构展示
+class SystemDataVersionError extends Error {
+    constructor(schema) {
+        super(`存档由更新版本的系统生成（数据结构版本 ${schema}），请升级插件后再打开`);
+        this.name = 'SystemDataVersionError';
+    }
+}
+
+async function parseTxtFile(content) {
+    const match = content.match(/SYSTEM_DATA_START:([^:\s]*):SYSTEM_DATA_END/);
     if (match && match[1]) {
         try {
-            // Base64解码
-            const base64Data = match[1];
-            // 将Base64字符串转换为Uint8Array
-            const binaryString = atob(base64Data);
-            const bytes = new Uint8Array(binaryString.length);
-            for (let i = 0; i < binaryString.length; i++) {
-                bytes[i] = binaryString.charCodeAt(i);
+            const payload = match[1];
+            if (!payload.includes('.')) {
+                // 旧格式：Base64 -> UTF-8 -> JSON
+                return JSON.parse(new TextDecoder('utf-8').decode(base64ToBytes(payload)));
+            }
+            const [tag, schemaText, body] = payload.split('.');
+            if (tag !== 'SD2') {
+                throw new Error(`不支持的存档格式: ${tag}`);
+            }
+            const schema = Number(schemaText);
+            if (!Number.isInteger(schema)) {
+                throw new Error(`存档数据结构版本无效: ${schemaText}`);
             }
-            // UTF-8解码
-            const decoder = new TextDecoder('utf-8');
-            const jsonString = decoder.decode(bytes);
-            // 解析JSON
-            return JSON.parse(jsonString);
+            if (schema > SYSTEM_DATA_SCHEMA) {
+                throw new SystemDataVersionError(schema);
+            }
+            // 新格式：Base64 -> zlib 解压 -> JSON
+            const stream = new Blob([base64ToBytes(body)]).stream().pipeThrough(new DecompressionStream('deflate'));
+            return JSON.parse(await new Response(stream).text());
         } catch (e) {
+            if (e instanceof SystemDataVersionError) throw e;
             console.error('解析失败:', e);
             return null;
         }
@@ -140,9 +168,15 @@ function renderData(data) {
 // 处理文件
 function handleFile(file) {
     const reader = new FileReader();
-    reader.onload = (e) => {
+    reader.onload = async (e) => {
         const content = e.target.result;
-        const data = parseTxtFile(content);
+        let data = null;
+        let errorText = '未找到有效数据';
+        try {
+            data = await parseTxtFile(content);
+        } catch (err) {
+            errorText = err.message;
+        }
 
         if (data) {
             chrome.storage.local.set({ lastData: data });
@@ -151,6 +185,7 @@ function handleFile(file) {
             document.getElementById('empty-state').style.display = 'none';
             renderData(data);
         } else {
+            document.getElementById('empty-message').textContent = errorText;
             document.getElementById('upload-area').style.display = 'none';
             document.getElementById('empty-state').style.display = 'flex';
         }
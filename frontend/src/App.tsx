@@ -1,6 +1,6 @@
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useRef } from 'react';
 import axios from 'axios';
-import { numToChinese } from './utils';
+import { numToChinese, decodeSystemData, SystemDataVersionError } from './utils';
 import {
   Form, Input, Button, InputNumber, Card, Checkbox, message,
   Layout, Tabs, Switch, Row, Col, Space, ConfigProvider, Tag, Typography,
@@ -27,6 +27,7 @@ const BASE_URL = import.meta.env.DEV ? "http://localhost:8090" : "";
 const API_URL = `${BASE_URL}/api/generate`;
 const BRANCH_API_URL = `${BASE_URL}/api/branches`;
 const CONFIG_API_URL = `${BASE_URL}/api/config`;
+const CUSTOMER_API_URL = `${BASE_URL}/api/customers`;
 const PRIMARY_COLOR = '#1677ff';
 
 const RULES = {
@@ -284,6 +285,8 @@ function App() {
   // 到期客户相关状态
   const [customerSource, setCustomerSource] = useState<'new' | 'existing'>('new');
   const [customerList, setCustomerList] = useState<any[]>([]);
+  const [customerSearching, setCustomerSearching] = useState(false);
+  const customerSearchTimer = useRef<number | undefined>(undefined);
 
   const [form] = Form.useForm();
 
@@ -291,10 +294,9 @@ function App() {
   useEffect(() => {
     const initData = async () => {
       try {
-        const [branchRes, configRes, customersRes] = await Promise.all([
+        const [branchRes, configRes] = await Promise.all([
           axios.get(BRANCH_API_URL),
-          axios.get(CONFIG_API_URL),
-          axios.get(`${BASE_URL}/api/customers`)
+          axios.get(CONFIG_API_URL)
         ]);
         if (Array.isArray(branchRes.data)) {
           setBranchList(branchRes.data);
@@ -312,10 +314,6 @@ function App() {
           });
           setAllTemplates(configRes.data.templates || []);
         }
-        // 加载到期客户列表
-        if (customersRes.data && customersRes.data.customers) {
-          setCustomerList(customersRes.data.customers);
-        }
       } catch (err) { } finally { setInitLoading(false); }
     };
     initData();
@@ -324,14 +322,11 @@ function App() {
   // 2. 导入
   const handleImport = (file: File) => {
     const reader = new FileReader();
-    reader.onload = (e) => {
+    reader.onload = async (e) => {
       try {
         const content = e.target?.result as string;
-        const match = content.match(/SYSTEM_DATA_START:(.*):SYSTEM_DATA_END/);
-        if (match && match[1]) {
-          const utf8Json = new TextDecoder().decode(Uint8Array.from(atob(match[1]), c => c.charCodeAt(0)));
-          const data = JSON.parse(utf8Json);
-
+        const data = await decodeSystemData(content);
+        if (data) {
           // 设置基础状态
           setCustomerType(data.customer_type || 'personal');
           setLoanType(data.loan_type || 'guarantee');
@@ -369,15 +364,35 @@ function App() {
 
           message.success('数据导入成功！');
         } else { message.error('未找到存档数据'); }
-      } catch (err) { message.error('文件解析失败'); }
+      } catch (err) { message.error(err instanceof SystemDataVersionError ? err.message : '文件解析失败'); }
     };
     reader.readAsText(file);
     return false;
   };
 
+  // 到期客户：服务端分页搜索（输入停顿后再请求）
+  const searchCustomers = (q: string) => {
+    window.clearTimeout(customerSearchTimer.current);
+    customerSearchTimer.current = window.setTimeout(async () => {
+      setCustomerSearching(true);
+      try {
+        const res = await axios.get(`${CUSTOMER_API_URL}/search`, { params: { q, page_size: 50 } });
+        setCustomerList(res.data?.items || []);
+      } catch (err) { setCustomerList([]); } finally { setCustomerSearching(false); }
+    }, 250);
+  };
+
+  useEffect(() => {
+    if (customerSource === 'existing') searchCustomers('');
+  }, [customerSource]);
+
   // 选择到期客户并自动填充
-  const handleSelectCustomer = (idCard: string) => {
-    const customer = customerList.find(c => c.main_id_card === idCard);
+  const handleSelectCustomer = async (customerId: string) => {
+    let customer: any;
+    try {
+      const res = await axios.get(`${CUSTOMER_API_URL}/${customerId}`);
+      customer = res.data;
+    } catch (err) { message.error('读取客户信息失败，请重新搜索'); return; }
     if (!customer) return;
 
     // 自动设置客户主体类型
@@ -431,7 +446,7 @@ function App() {
     }
 
     // 填充配偶（如果有）
-    if (customer.spouse_name && customer.spouse_name !== 'nan' && customer.spouse_name.trim()) {
+    if (customer.spouse_name && customer.spouse_name.trim()) {
       setHasSpouse(true);
       form.setFieldsValue({
         spouse: {
@@ -717,8 +732,8 @@ function App() {
           } else {
             message.error('请检查所有必填字段是否已填写', 5);
           }
-        } else if (status === 500) {
-          // 服务器错误
+        } else if (status === 500 || status === 400) {
+          // 服务器错误 / 模板检查未通过
           if (error.response.data instanceof Blob) {
             error.response.data.text().then((text: string) => {
               try {
@@ -787,16 +802,17 @@ function App() {
                   <Form.Item label="选择客户">
                     <Select
                       showSearch
-                      placeholder="搜索客户姓名或证件号"
+                      placeholder="搜索姓名、证件号（支持后四位）或拼音首字母"
                       size="large"
                       options={customerList.map(c => ({
                         label: `${c.main_name} (${c.main_id_card}) - ${c.branch_short_name}`,
-                        value: c.main_id_card
+                        value: c.id
                       }))}
                       onChange={handleSelectCustomer}
-                      filterOption={(input, option) =>
-                        (option?.label ?? '').toLowerCase().includes(input.toLowerCase())
-                      }
+                      onSearch={searchCustomers}
+                      filterOption={false}
+                      loading={customerSearching}
+                      notFoundContent={customerSearching ? <Spin size="small" /> : undefined}
                     />
                   </Form.Item>
                 </Col>
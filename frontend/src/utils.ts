@@ -269,3 +269,45 @@ export function numToChinese(num: number): string {
 
     return result;
 }
+
+/**
+ * 数据存档 txt 中 SYSTEM_DATA_START:...:SYSTEM_DATA_END 的内容
+ * 旧格式为 Base64(JSON)；新格式为 SD2.<数据结构版本>.<Base64(zlib 压缩的 JSON)>
+ * 没有存档数据时返回 null，数据损坏时抛出异常
+ */
+const SYSTEM_DATA_PATTERN = /SYSTEM_DATA_START:([^:\s]*):SYSTEM_DATA_END/;
+// 本页面能读取的最高数据结构版本（与后端 SYSTEM_DATA_SCHEMA 一致）
+export const SYSTEM_DATA_SCHEMA = 1;
+
+/** 存档由更新版本的系统生成，字段含义可能已变化，不能按当前结构填入表单 */
+export class SystemDataVersionError extends Error {
+    constructor(schema: number) {
+        super(`存档由更新版本的系统生成（数据结构版本 ${schema}），请升级后再导入`);
+        this.name = 'SystemDataVersionError';
+    }
+}
+
+function base64ToBytes(b64: string) {
+    const binary = atob(b64);
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    return bytes;
+}
+
+export async function decodeSystemData(content: string): Promise<any | null> {
+    const match = content.match(SYSTEM_DATA_PATTERN);
+    if (!match || !match[1]) return null;
+    const payload = match[1];
+    if (!payload.includes('.')) {
+        return JSON.parse(new TextDecoder().decode(base64ToBytes(payload)));
+    }
+    const [tag, schemaText, body] = payload.split('.');
+    if (tag !== 'SD2') throw new Error(`不支持的存档格式: ${tag}`);
+    const schema = Number(schemaText);
+    if (!Number.isInteger(schema)) throw new Error(`存档数据结构版本无效: ${schemaText}`);
+    if (schema > SYSTEM_DATA_SCHEMA) throw new SystemDataVersionError(schema);
+    const stream = new Blob([base64ToBytes(body)]).stream().pipeThrough(new DecompressionStream('deflate'));
+    return JSON.parse(await new Response(stream).text());
+}
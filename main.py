@@ -2,36 +2,169 @@ import os
 import sys
 import traceback
 import time
-import shutil
 import zipfile
 import json
 import base64
+import io
+import re
+import copy
+import hashlib
+import zlib
+import sqlite3
+import bisect
+import threading
+import asyncio
+import functools
+import itertools
+import contextlib
+import contextvars
+import queue
+import atexit
+import random
+import shutil
+import gzip
+import email.utils
+from collections import OrderedDict
+from decimal import Decimal, ROUND_HALF_UP
+import urllib.parse
+import uuid
 from typing import List, Optional
 from datetime import datetime
 import logging
-from concurrent.futures import ThreadPoolExecutor
-from logging.handlers import RotatingFileHandler
-
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        RotatingFileHandler("app.log", maxBytes=10*1024*1024, backupCount=5, encoding='utf-8')
-    ]
-)
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+
+# ============= 日志 =============
+# 请求线程只把日志记录放入队列，由后台线程以 JSON Lines 格式写入 app.log；
+# 每条记录带请求ID，单个请求的日志量有上限，超出部分丢弃并在请求结束时记一条说明
+
+# 单个请求最多写入的日志字符数；异常堆栈最多保留的字符数；队列长度（写满后丢弃新日志）
+LOG_REQUEST_MAX_CHARS = int(os.environ.get("BANK_LOG_REQUEST_MAX_CHARS", "32768"))
+LOG_EXC_MAX_CHARS = int(os.environ.get("BANK_LOG_EXC_MAX_CHARS", "8000"))
+LOG_QUEUE_SIZE = int(os.environ.get("BANK_LOG_QUEUE_SIZE", "10000"))
+# 生成请求的完整数据：最多记录的字符数（0 为不记录）和抽样比例
+LOG_PAYLOAD_CHARS = int(os.environ.get("BANK_LOG_PAYLOAD_CHARS", "1000"))
+LOG_PAYLOAD_SAMPLE = float(os.environ.get("BANK_LOG_PAYLOAD_SAMPLE", "1"))
+
+log_stats = {"dropped": 0, "over_budget": 0}
+
+class LogContext:
+    """当前请求（或后台任务）的日志上下文；budget 为 None 时不限制日志量"""
+
+    def __init__(self, request_id, budget=None):
+        self.request_id = request_id
+        self.budget = budget
+        self.dropped = 0
+
+_log_context = contextvars.ContextVar("log_context", default=None)
+
+class RequestLogFilter(logging.Filter):
+    """在产生日志的线程上附加请求ID、格式化异常堆栈，并按请求限制日志量"""
+
+    def filter(self, record):
+        ctx = _log_context.get()
+        record.request_id = ctx.request_id if ctx is not None else None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)[-LOG_EXC_MAX_CHARS:]
+        if ctx is None or ctx.budget is None:
+            return True
+        size = len(record.getMessage()) + len(record.exc_text or "")
+        if size > ctx.budget:
+            ctx.dropped += 1
+            log_stats["over_budget"] += 1
+            return False
+        ctx.budget -= size
+        return True
+
+class AsyncLogHandler(QueueHandler):
+    """只在请求线程做最少的工作：合并消息参数后入队，JSON 序列化和写文件在后台线程进行"""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_stats["dropped"] += 1
+
+class JsonLineFormatter(logging.Formatter):
+    def format(self, record):
+        event = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            event["request_id"] = record.request_id
+        fields = getattr(record, "fields", None)
+        if fields:
+            event.update(fields)
+        if record.exc_text:
+            event["exc"] = record.exc_text
+        return json.dumps(event, ensure_ascii=False, default=str)
+
+# 渲染进程标记：主进程创建渲染进程池前设置，子进程（spawn）继承环境变量
+RENDER_WORKER_ENV = "BANK_RENDER_WORKER"
+
+def _setup_logging():
+    # 渲染子进程不写 app.log，避免多进程同时轮转同一文件。
+    # 不能用 multiprocessing.parent_process() 判断：spawn 子进程在反序列化进程池初始化函数时
+    # 就会导入本模块，此时父进程信息尚未设置
+    if os.environ.get(RENDER_WORKER_ENV) == "1":
+        logging.basicConfig(level=logging.INFO, handlers=[logging.NullHandler()])
+        return None
+    file_handler = RotatingFileHandler("app.log", maxBytes=10*1024*1024, backupCount=5, encoding='utf-8')
+    file_handler.setFormatter(JsonLineFormatter())
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    listener = QueueListener(log_queue, file_handler)
+    listener.start()
+
+    def flush_on_exit():
+        # 退出时把队列中剩余的日志写完
+        if listener._thread is not None:
+            listener.stop()
+
+    atexit.register(flush_on_exit)
+    handler = AsyncLogHandler(log_queue)
+    handler.addFilter(RequestLogFilter())
+    logging.basicConfig(level=logging.INFO, handlers=[handler])
+    return listener
+
+log_listener = _setup_logging()
 logger = logging.getLogger("BankContract")
 
-# Excel处理
-import openpyxl 
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, HTTPException, UploadFile, File, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from pydantic import BaseModel
-from docxtpl import DocxTemplate
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ValidationError
+from starlette.datastructures import Headers
+# openpyxl、docxtpl（连同 python-docx、Jinja2）导入较慢，在首次使用时才导入，
+# 服务可以先开始响应前端页面；启动后由后台预热提前完成导入（见“启动预热”）
 
-app = FastAPI()
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    """启动时开始后台预热（见“启动预热”）和过期任务清理；退出时先停止生成任务和后台线程，最后关闭执行器"""
+    warmup.start()
+    job_manager.start()
+    yield
+    job_manager.shutdown()
+    archive_index.stop()
+    template_catalog.stop()
+    config_registry.stop()
+    render_backend.shutdown()
+    blocking_executor.shutdown(wait=False, cancel_futures=True)
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -72,13 +205,171 @@ else:
 
 # 输出目录还是在当前运行目录下，方便用户查看
 OUTPUT_DIR = os.path.join(CWD, "output")
-# 临时目录
-TEMP_DIR = get_resource_path("temp")
-
 # 数据文件
 DATA_FILE = get_config_path("data.json")
 BRANCH_FILE = get_config_path("branches.json")
 
+# ============= HTTP 缓存与压缩 =============
+# 读多写少的接口（客户列表、配置、支行）按数据源文件生成 ETag/Last-Modified，客户端带 If-None-Match
+# 再次请求时内容未变直接返回 304；响应体超过阈值时按 Accept-Encoding 压缩（br 需安装 brotli）。
+# 序列化和压缩结果按内容版本缓存在内存中，同一版本只做一次
+
+COMPRESS_MIN_BYTES = int(os.environ.get("BANK_COMPRESS_MIN_BYTES", "1024"))
+ENCODED_CACHE_MB = int(os.environ.get("BANK_ENCODED_CACHE_MB", "64"))
+COMPRESSIBLE_TYPES = ("application/json", "application/javascript", "text/", "image/svg+xml")
+# Vite 构建产物文件名带内容哈希，内容变化时文件名随之变化
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+@functools.lru_cache(maxsize=None)
+def brotli_available():
+    try:
+        import brotli  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def choose_encoding(accept_encoding):
+    """按 Accept-Encoding 选择压缩方式：br 优先，其次 gzip；都不接受时返回 None"""
+    accepted = {}
+    for item in (accept_encoding or "").split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    if accepted.get("br", 0) > 0 and brotli_available():
+        return "br"
+    if accepted.get("gzip", accepted.get("*", 0)) > 0:
+        return "gzip"
+    return None
+
+def compress_body(raw, encoding):
+    if encoding == "br":
+        import brotli
+        return brotli.compress(raw, quality=5)
+    return gzip.compress(raw, compresslevel=6, mtime=0)
+
+class EncodedBodyCache:
+    """按 (内容版本, 编码) 缓存响应体，总大小超过上限时淘汰最久未用的"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def _store(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total -= len(old)
+            self._entries[key] = body
+            self._total += len(body)
+            while self._total > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._total -= len(evicted)
+
+    def get(self, version, encoding, build):
+        """
+        返回 (响应体, 实际使用的编码)；build() 生成未压缩的内容
+        小于 COMPRESS_MIN_BYTES 的内容不压缩
+        """
+        if encoding:
+            body = self._lookup((version, encoding))
+            if body is not None:
+                return body, encoding
+        raw = self._lookup((version, None))
+        if raw is None:
+            raw = build()
+            self._store((version, None), raw)
+        if not encoding or len(raw) < COMPRESS_MIN_BYTES:
+            return raw, None
+        body = compress_body(raw, encoding)
+        self._store((version, encoding), body)
+        return body, encoding
+
+encoded_bodies = EncodedBodyCache(ENCODED_CACHE_MB * 1024 * 1024)
+
+def _http_date(mtime):
+    return email.utils.formatdate(mtime, usegmt=True)
+
+def is_not_modified(request, etag, last_modified=None):
+    """If-None-Match 优先；没有时再看 If-Modified-Since（精确到秒）"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or any(tag.removeprefix("W/") == etag.removeprefix("W/") for tag in tags)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            return int(last_modified) <= email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def conditional_json(request, version, payload_fn, last_modified=None):
+    """
+    按内容版本返回 JSON：未变化时 304，否则返回（可能已压缩的）缓存响应体
+    version 须能唯一标识 payload_fn() 的内容，last_modified 为数据源文件的修改时间（秒）
+    """
+    etag = 'W/"%s"' % cache_key("json", request.url.path, version)[:32]
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if last_modified is not None:
+        headers["Last-Modified"] = _http_date(last_modified)
+    if is_not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    encoding = choose_encoding(request.headers.get("accept-encoding"))
+    body, encoding = encoded_bodies.get(etag, encoding, lambda: json.dumps(
+        payload_fn(), ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8"))
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    BYTES_WRITTEN.inc(len(body), "json_" + (encoding or "identity"))
+    return Response(body, media_type="application/json", headers=headers)
+
+class AssetFiles(StaticFiles):
+    """前端构建产物（/assets）：长期缓存；较大的文本文件按 Accept-Encoding 压缩后返回"""
+
+    async def get_response(self, path, scope):
+        response = await super().get_response(path, scope)
+        # 只有找到的文件才长期缓存；404（如发布过程中请求了新文件名）不能被浏览器缓存
+        if response.status_code in (200, 304):
+            response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        if not isinstance(response, FileResponse) or response.status_code != 200:
+            return response
+        media_type = response.media_type or ""
+        stat_result = response.stat_result
+        if not media_type.startswith(COMPRESSIBLE_TYPES) or stat_result is None or stat_result.st_size < COMPRESS_MIN_BYTES:
+            return response
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding"))
+        if encoding is None:
+            return response
+
+        def read():
+            with open(response.path, "rb") as f:
+                return f.read()
+
+        version = ("asset", response.path, stat_result.st_mtime_ns, stat_result.st_size)
+        body, encoding = await run_blocking(encoded_bodies.get, version, encoding, read)
+        headers = {k: v for k, v in response.headers.items() if k.lower() not in ("content-length", "etag")}
+        # 压缩后的表示与原文件内容等价，使用弱 ETag（If-None-Match 比较时忽略 W/）
+        headers["etag"] = "W/" + response.headers["etag"]
+        headers["content-encoding"] = encoding
+        headers["vary"] = "Accept-Encoding"
+        BYTES_WRITTEN.inc(len(body), "asset_" + encoding)
+        return Response(body, headers=headers)
+
 # 挂载静态文件 (前端)
 # 确保 static 目录存在，PyInstaller 打包时需要将 dist 目录打包为 static
 STATIC_DIR = get_resource_path("static")
@@ -94,12 +385,13 @@ if not os.path.exists(STATIC_DIR):
 if os.path.exists(STATIC_DIR):
     assets_dir = os.path.join(STATIC_DIR, "assets")
     if os.path.exists(assets_dir):
-        app.mount("/assets", StaticFiles(directory=assets_dir), name="assets")
+        app.mount("/assets", AssetFiles(directory=assets_dir), name="assets")
 
 @app.get("/")
 async def read_root():
     if os.path.exists(STATIC_DIR):
-        return FileResponse(os.path.join(STATIC_DIR, "index.html"))
+        # index.html 引用带哈希的资源文件，每次都要向服务器确认是否有新版本
+        return FileResponse(os.path.join(STATIC_DIR, "index.html"), headers={"Cache-Control": "no-cache"})
     return {"message": "Backend is running. Frontend static files not found."}
 
 # --- 数据模型 ---
@@ -161,158 +453,128 @@ class ContractRequest(BaseModel):
     
     selected_templates: List[str] = []
 
+class BatchRequest(BaseModel):
+    """批量生成：按客户ID，或按支行/到期日范围从到期清单中筛选"""
+    customer_ids: List[str] = []
+    branch_short_name: str = ""
+    due_from: str = ""  # YYYY-MM-DD
+    due_to: str = ""
+    loan_type: str = "guarantee"
+    selected_templates: List[str] = []
+
+class ArchiveText(BaseModel):
+    """一个数据存档：txt 全文，或只含 SYSTEM_DATA 的那一行"""
+    name: str = ""
+    content: str
+
+class ArchiveDecodeRequest(BaseModel):
+    archives: List[ArchiveText]
+
 # --- 辅助函数 ---
 
+CN_DIGITS = "零壹贰叁肆伍陆柒捌玖"
+CN_UNITS = ("", "拾", "佰", "仟")
+CN_SECTIONS = ("", "万", "亿", "兆")
+_CENT = Decimal("0.01")
+
+# 0-9999 每节的大写写法：[不补零写法, 作为非最高节时的写法（不足4位补“零”）]
+_SECTION_TABLE = None
+
+def _build_section_table():
+    table = []
+    for n in range(10000):
+        digits = f"{n:04d}"
+        out = []
+        zero = False
+        for i, ch in enumerate(digits):
+            d = ord(ch) - 48
+            if d == 0:
+                # 节内开头的零不读，中间的零合并为一个“零”
+                zero = bool(out)
+                continue
+            if zero:
+                out.append(CN_DIGITS[0])
+                zero = False
+            out.append(CN_DIGITS[d] + CN_UNITS[3 - i])
+        text = "".join(out)
+        table.append((text, CN_DIGITS[0] + text if 0 < n < 1000 else text))
+    return table
+
+def _int_to_cn(n):
+    """整数部分转大写（不含“元”）"""
+    global _SECTION_TABLE
+    if n == 0:
+        return CN_DIGITS[0]
+    if _SECTION_TABLE is None:
+        _SECTION_TABLE = _build_section_table()
+    sections = []
+    while n:
+        n, sect = divmod(n, 10000)
+        sections.append(sect)
+    if len(sections) > len(CN_SECTIONS):
+        raise ValueError("金额超出转换范围")
+    parts = []
+    pending_zero = False
+    for idx in range(len(sections) - 1, -1, -1):
+        sect = sections[idx]
+        if sect == 0:
+            # 中间整节为零时，只在后面还有数字时补一个“零”
+            pending_zero = bool(parts)
+            continue
+        plain, padded = _SECTION_TABLE[sect]
+        text = padded if parts else plain
+        if pending_zero and not text.startswith(CN_DIGITS[0]):
+            text = CN_DIGITS[0] + text
+        pending_zero = False
+        parts.append(text + CN_SECTIONS[idx])
+    return "".join(parts)
+
+def to_amount(num):
+    """金额统一转为精确到分的 Decimal（浮点数按其十进制写法处理，避免二进制误差）"""
+    if num is None or num == "":
+        return Decimal(0).quantize(_CENT)
+    if not isinstance(num, Decimal):
+        num = Decimal(str(num))
+    return num.quantize(_CENT, rounding=ROUND_HALF_UP)
+
+@functools.lru_cache(maxsize=4096)
+def _amount_to_cn(amount):
+    if amount == 0:
+        return "零元整"
+    sign = "负" if amount < 0 else ""
+    fen_total = int(abs(amount) * 100)
+    int_part, cents = divmod(fen_total, 100)
+    jiao, fen = divmod(cents, 10)
+
+    result = sign + _int_to_cn(int_part) + "元"
+    if cents == 0:
+        return result + "整"
+    if jiao > 0:
+        result += CN_DIGITS[jiao] + "角"
+    elif int_part > 0:
+        # 1.01 -> 壹元零壹分
+        result += CN_DIGITS[0]
+    if fen > 0:
+        result += CN_DIGITS[fen] + "分"
+    return result
+
 def num_to_cn(num):
     """
     将数字金额转换为人民币大写
     例如: 123456.78 -> 壹拾贰万叁仟肆佰伍拾陆元柒角捌分
     """
-    if num == 0:
-        return "零元整"
-    
-    CN_NUM = ['零', '壹', '贰', '叁', '肆', '伍', '陆', '柒', '捌', '玖']
-    CN_UNIT = ['', '拾', '佰', '仟']
-    CN_SECTION = ['', '万', '亿', '兆']
-    
-    # 分离整数和小数部分
-    int_part = int(num)
-    decimal_part = round((num - int_part) * 100)
-    
-    # 处理整数部分
-    str_num = str(int_part)
-    result = ""
-    
-    # 分段处理，从低位到高位，每4位一段
-    # 倒序处理
-    reversed_str = str_num[::-1]
-    sections = [reversed_str[i:i+4] for i in range(0, len(reversed_str), 4)]
-    
-    for section_idx, section in enumerate(sections):
-        section_result = ""
-        section_zero = True # 本节是否全0
-        
-        # 处理每一节，section是倒序的，如 1234 -> 4321
-        for i, digit in enumerate(section):
-            d = int(digit)
-            if d != 0:
-                section_zero = False
-                # 如果前面有0（高位有0），且当前位不是0，需要补零
-                # 但这里的逻辑是倒序构造，result = digit + unit + result
-                # 比较复杂，不如正序处理每一节
-                pass
-    
-    # 重写逻辑：正序
-    int_str = str(int_part)
-    length = len(int_str)
-    result = ""
-    zero = False # 前面是否有零需要补
-    
-    # 这种逐位处理逻辑对于 "万" 的插入比较麻烦
-    # 采用 section 分割法 (Low to High)
-    
-    sections = []
-    temp_str = int_str
-    while len(temp_str) > 0:
-        sections.append(temp_str[-4:])
-        temp_str = temp_str[:-4]
-        
-    chinese_sections = []
-    for idx, section in enumerate(sections):
-        if int(section) == 0:
-            # 如果本节是0，且不是最低节，且如果前面还有更高的节...
-            # 这里先存空，最后处理零的连接
-            if idx == 0: # 个位节全0
-                chinese_sections.append("")
-                continue
-            else:
-                # 高位节全0，如 1 0000 0001 的中间万位
-                # 需要补零吗？ 1亿零1元。
-                # 这种情况下，万位不仅不加万，还要作为零处理。
-                chinese_sections.append("零") # 占位
-                continue
-        
-        # 处理非0节
-        sect_res = ""
-        zero_flag = False # 节内零
-        
-        # 补齐4位方便处理？不，直接处理
-        # "0101" -> 101. 
-        # section is string. e.g. "101"
-        for i in range(len(section)):
-            d = int(section[i])
-            # 单位位置：倒数第几位
-            p = len(section) - 1 - i 
-            
-            if d == 0:
-                zero_flag = True
-            else:
-                if zero_flag:
-                    sect_res += CN_NUM[0]
-                    zero_flag = False
-                sect_res += CN_NUM[d] + CN_UNIT[p]
-        
-        # 如果本节有值，加上节单位
-        if sect_res:
-             # 处理 "10" -> "YiShi" or "Shi". Standard "YiShi".
-             # 特殊处理：如果是 10-19，且是最高位... 还是保留壹拾吧，标准。
-             pass
-        
-        if sect_res:
-            sect_res += CN_SECTION[idx]
-        
-        chinese_sections.append(sect_res)
-        
-    # 合并
-    # sections 是从低到高 [个位节, 万位节, 亿位节]
-    # 需要反转回来拼接
-    # 还需要处理节与节之间的零
-    
-    final_res = ""
-    # 从高到低遍历
-    for i in range(len(chinese_sections) - 1, -1, -1):
-        part = chinese_sections[i]
-        if part == "零":
-            # 只有当后面还有内容，且 final_res 不以零结尾时才加零？
-            if final_res and not final_res.endswith("零"):
-                final_res += "零"
-        else:
-            if part:
-                # 如果这个部分非空，且前面有值，且本部分原值（int）小于1000（意味着有前导0），需要补零？
-                # e.g. 1 0001 -> 1 section="1", 2 section="1". "YiWan" + "Yi". -> "YiWanLingYi".
-                # 检查 section 原始值
-                original_val = sections[i]
-                if len(original_val) == 4 and original_val.startswith('0') and final_res:
-                     if not final_res.endswith("零"):
-                         final_res += "零"
-                
-                final_res += part
-    
-    result = final_res
-    
-    # 清除末尾零
-    result = result.rstrip('零')
-    if not result: result = CN_NUM[0]
-    
-    if result != "零":
-        result += "元"
-    else:
-        result = "零元"
-        
-    # 小数
-    if decimal_part > 0:
-        jiao = decimal_part // 10
-        fen = decimal_part % 10
-        if jiao > 0:
-            result += CN_NUM[jiao] + '角'
-        elif fen > 0 and int_part > 0:
-            result += '零'
-            
-        if fen > 0:
-            result += CN_NUM[fen] + '分'
-    else:
-        result += '整'
-        
+    return _amount_to_cn(to_amount(num))
+
+def num_to_cn_batch(values):
+    """批量转换一列金额（如整张清单），重复金额只计算一次"""
+    converted = {}
+    result = []
+    for value in values:
+        amount = to_amount(value)
+        text = converted.get(amount)
+        if text is None:
+            text = converted[amount] = _amount_to_cn(amount)
+        result.append(text)
     return result
 
 def format_date_cn(date_str):
@@ -351,35 +613,310 @@ def flatten_context(context, parent_key='', sep='.'):
             items.append((new_key, v))
     return dict(items)
 
-def fill_excel_template(template_path, output_path, context):
-    # 扁平化数据以支持 {{ spouse.name }} 格式
-    flat_context = flatten_context(context)
-    # 合并原始context以防万一
-    flat_context.update(context)
-    
-    wb = openpyxl.load_workbook(template_path)
-    for sheet in wb.worksheets:
+# ============= 模板缓存 =============
+
+class CompiledTemplateMixin:
+    """
+    基于已解析模板的 DocxTemplate（与 DocxTemplate 组合成 CompiledDocxTemplate，见 compiled_template_class）
+    文档对象来自缓存中的母版副本，patch_xml 结果和 Jinja 编译结果在同一模板的所有渲染间共享
+    """
+
+    def __init__(self, entry, shared=False):
+        super().__init__(entry.path)
+        self._entry = entry
+        # shared=True 时直接使用母版，仅供只读的模板分析使用
+        self.docx = entry.document if shared else copy.deepcopy(entry.document)
+
+    def patch_xml(self, src_xml):
+        patched = self._entry.patched_xml.get(src_xml)
+        if patched is None:
+            patched = super().patch_xml(src_xml)
+            self._entry.patched_xml[src_xml] = patched
+        return patched
+
+    def render_xml_part(self, src_xml, part, context, jinja_env=None):
+        # 与 DocxTemplate.render_xml_part 一致，只是复用已编译的 Jinja 模板
+        if jinja_env:
+            return super().render_xml_part(src_xml, part, context, jinja_env)
+        from jinja2 import Template, TemplateError
+        split_xml = re.sub(r"<w:p([ >])", r"\n<w:p\1", src_xml)
+        try:
+            self.current_rendering_part = part
+            template = self._entry.compiled.get(src_xml)
+            if template is None:
+                template = Template(split_xml)
+                self._entry.compiled[src_xml] = template
+            dst_xml = template.render(context)
+        except TemplateError as exc:
+            # 与 docxtpl 一致：附上出错位置附近的模板文本，便于定位
+            if getattr(exc, "lineno", None) is not None:
+                line_number = max(exc.lineno - 4, 0)
+                exc.docx_context = map(lambda x: re.sub(r"<[^>]+>", "", x),
+                                       split_xml.splitlines()[line_number:line_number + 7])
+            raise exc
+        dst_xml = re.sub(r"\n<w:p([ >])", r"<w:p\1", dst_xml)
+        dst_xml = (
+            dst_xml.replace("{_{", "{{")
+            .replace("}_}", "}}")
+            .replace("{_%", "{%")
+            .replace("%_}", "%}")
+        )
+        return self.resolve_listing(dst_xml)
+
+    def jinja_sources(self):
+        """渲染时经过 Jinja 的全部文本：正文、页眉页脚、文档属性、脚注（与 DocxTemplate.render 一致）"""
+        yield self.patch_xml(self.get_xml())
+        for uri in (self.HEADER_URI, self.FOOTER_URI):
+            for _, part in self.get_headers_footers(uri):
+                yield self.patch_xml(self.get_part_xml(part))
+        for prop in ("author", "comments", "identifier", "language", "subject", "title"):
+            yield getattr(self.docx.core_properties, prop) or ""
+        for part in self.docx.part.package.parts:
+            if part.content_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.footnotes+xml":
+                blob = part.blob
+                yield self.patch_xml(blob.decode("utf-8") if isinstance(blob, bytes) else blob)
+
+@functools.lru_cache(maxsize=None)
+def compiled_template_class():
+    """CompiledDocxTemplate 类，首次调用时导入 docxtpl"""
+    from docxtpl import DocxTemplate
+    return type("CompiledDocxTemplate", (CompiledTemplateMixin, DocxTemplate), {})
+
+def _jinja_path(node, roots):
+    """{{ spouse.name }} / {{ spouse['name'] }} -> 'spouse.name'；不是以 roots 中变量开头的返回 None"""
+    from jinja2 import nodes
+    segments = []
+    while True:
+        if isinstance(node, nodes.Getattr):
+            segments.append(node.attr)
+            node = node.node
+        elif isinstance(node, nodes.Getitem) and isinstance(node.arg, nodes.Const) and isinstance(node.arg.value, str):
+            segments.append(node.arg.value)
+            node = node.node
+        else:
+            break
+    if isinstance(node, nodes.Name) and node.name in roots:
+        return ".".join([node.name] + segments[::-1])
+    return None
+
+def analyze_template(entry):
+    """
+    模板引用的变量，返回 (顶层变量名, 取值路径)
+    docx 通过 Jinja 语法树分析，xlsx 取占位符（spouse.name 的顶层变量为 spouse）
+    循环变量等模板内部定义的名字不计入
+    """
+    if entry.path.endswith(".docx"):
+        from jinja2 import Environment, meta, nodes
+        env = Environment()
+        tpl = compiled_template_class()(entry, shared=True)
+        names = set()
+        paths = set()
+        for source in tpl.jinja_sources():
+            ast = env.parse(source)
+            roots = meta.find_undeclared_variables(ast)
+            names |= roots
+            for node in ast.find_all((nodes.Name, nodes.Getattr, nodes.Getitem)):
+                path = _jinja_path(node, roots)
+                if path:
+                    paths.add(path)
+        # 只保留最长的路径：spouse.name 已包含 spouse
+        paths = {p for p in paths if not any(q.startswith(p + ".") for q in paths)}
+        return frozenset(names), frozenset(paths)
+    paths = frozenset(part[0] for _, _, parts in entry.excel_cells
+                      for part in parts if isinstance(part, tuple))
+    return frozenset(p.split(".")[0] for p in paths), paths
+
+class TemplateEntry:
+    """单个模板文件的缓存条目"""
+
+    def __init__(self, path, stat_key, content):
+        self.path = path
+        self.stat_key = stat_key
+        self.content = content
+        self.sha256 = hashlib.sha256(content).hexdigest()
+        self.document = None      # docx 母版 (python-docx Document)
+        self.patched_xml = {}     # 原始 xml -> patch_xml 结果
+        self.compiled = {}        # patch 后 xml -> jinja2.Template
+        self.excel_cells = []     # [(sheet序号, 坐标, [文本片段/占位符...])]
+        self.variables = None     # 模板引用的顶层变量名，首次使用时分析
+        self.paths = None         # 模板引用的取值路径 (spouse.name)
+
+class TemplateCache:
+    """
+    进程级模板缓存
+    按 (mtime, size) 校验模板文件，变化后自动重新加载；每次渲染拿到母版的独立副本
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, path) -> TemplateEntry:
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stat_key = (st.st_mtime_ns, st.st_size)
+        entry = self._entries.get(path)
+        if entry is not None and entry.stat_key == stat_key:
+            return entry
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or entry.stat_key != stat_key:
+                with open(path, "rb") as f:
+                    content = f.read()
+                entry = TemplateEntry(path, stat_key, content)
+                if path.endswith(".docx"):
+                    from docx import Document
+                    entry.document = Document(io.BytesIO(content))
+                elif path.endswith(".xlsx"):
+                    import openpyxl
+                    wb = openpyxl.load_workbook(io.BytesIO(content))
+                    entry.excel_cells = index_excel_placeholders(wb)
+                    wb.close()
+                self._entries[path] = entry
+                logger.info(f"📄 模板已加载到缓存: {os.path.basename(path)} ({entry.sha256[:8]})")
+            return entry
+
+    def docx(self, path):
+        """返回一个可独立渲染的 docx 模板副本（CompiledDocxTemplate）"""
+        return compiled_template_class()(self.get(path))
+
+    def xlsx(self, path):
+        """返回 (工作簿副本, 占位符索引)"""
+        import openpyxl
+        entry = self.get(path)
+        # openpyxl 的 Workbook 经 deepcopy 会丢失样式表，这里从内存中的文件内容加载
+        return openpyxl.load_workbook(io.BytesIO(entry.content)), entry.excel_cells
+
+    def analyze(self, path) -> TemplateEntry:
+        """返回已完成变量分析的缓存条目（分析结果按模板版本缓存）"""
+        entry = self.get(path)
+        if entry.variables is None:
+            variables, paths = analyze_template(entry)
+            entry.paths = paths
+            entry.variables = variables
+        return entry
+
+    def variables(self, path):
+        """模板引用的顶层变量名"""
+        return self.analyze(path).variables
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+template_cache = TemplateCache()
+
+# Excel 占位符：{{key}} 或 {{ key }}
+EXCEL_PLACEHOLDER = re.compile(r"\{\{ ?([^{}\s]+) ?\}\}")
+
+def index_excel_placeholders(wb):
+    """
+    扫描一次工作簿，只记录含占位符的单元格
+    每个单元格的文本拆成片段列表：普通文本为 str，占位符为 (key, 原文)
+    """
+    cells = []
+    for sheet_idx, sheet in enumerate(wb.worksheets):
         for row in sheet.iter_rows():
             for cell in row:
-                if cell.value and isinstance(cell.value, str) and "{{" in cell.value:
-                    text = cell.value
-                    # 优先替换长键 (如 spouse.name) 防止 spouse 被部分替换
-                    # 但其实直接遍历所有key替换即可，Jinja2风格通常是独立的一块
-                    for key, value in flat_context.items():
-                        if value is None: value = ""
-                        val_str = str(value)
-                        # 简单替换 {{ key }} 和 {{ key.subkey }}
-                        # 注意：需要处理空格如 {{ spouse.name }}
-                        target = f"{{{{{key}}}}}"
-                        target_space = f"{{{{ {key} }}}}"
-                        if target in text:
-                            text = text.replace(target, val_str)
-                        if target_space in text:
-                            text = text.replace(target_space, val_str)
-                    cell.value = text
+                text = cell.value
+                if not (text and isinstance(text, str) and "{{" in text):
+                    continue
+                parts = []
+                pos = 0
+                for m in EXCEL_PLACEHOLDER.finditer(text):
+                    if m.start() > pos:
+                        parts.append(text[pos:m.start()])
+                    parts.append((m.group(1), m.group(0)))
+                    pos = m.end()
+                if pos < len(text):
+                    parts.append(text[pos:])
+                if any(isinstance(part, tuple) for part in parts):
+                    cells.append((sheet_idx, cell.coordinate, parts))
+    return cells
+
+_MISSING = object()
+
+def lookup_context(context, key):
+    """按 {{ spouse.name }} 的写法取值，等价于 flatten_context 后再合并原始 context"""
+    if key in context:
+        return context[key]
+    value = context
+    for part in key.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    # 扁平化只保留叶子节点
+    return _MISSING if isinstance(value, dict) else value
+
+def fill_excel_template(template_path, output_path, context):
+    wb, cells = template_cache.xlsx(template_path)
+    sheets = wb.worksheets
+    for sheet_idx, coordinate, parts in cells:
+        chunks = []
+        for part in parts:
+            if isinstance(part, str):
+                chunks.append(part)
+                continue
+            key, raw = part
+            value = lookup_context(context, key)
+            if value is _MISSING:
+                # 没有对应数据时保留原占位符
+                chunks.append(raw)
+            else:
+                chunks.append("" if value is None else str(value))
+        sheets[sheet_idx][coordinate].value = "".join(chunks)
     wb.save(output_path)
     wb.close()
 
+# ============= 数据存档编码 =============
+# 数据存档 txt 末尾的 SYSTEM_DATA_START:<载荷>:SYSTEM_DATA_END 一行供前端导入和浏览器插件读取
+#   格式 1（旧）：Base64(JSON)
+#   格式 2：SD2.<数据结构版本>.Base64(zlib(紧凑 JSON))
+# Base64 字符中没有 "."，两种格式据此区分；读取时都支持
+
+SYSTEM_DATA_FORMAT = 2
+# 存档中 ContractRequest 的数据结构版本，字段含义不兼容地变化时递增
+SYSTEM_DATA_SCHEMA = 1
+SYSTEM_DATA_PATTERN = re.compile(r"SYSTEM_DATA_START:([^:\s]*):SYSTEM_DATA_END")
+
+class SystemDataError(ValueError):
+    """SYSTEM_DATA 载荷无法解析"""
+
+def encode_system_data(payload: dict) -> str:
+    raw = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    body = base64.b64encode(zlib.compress(raw, 9)).decode("ascii")
+    return f"SD{SYSTEM_DATA_FORMAT}.{SYSTEM_DATA_SCHEMA}.{body}"
+
+def decode_system_data(payload: str):
+    """解析 SYSTEM_DATA 载荷，返回 (格式版本, 数据结构版本, 数据)；旧格式的数据结构版本为 1"""
+    if "." not in payload:
+        version, schema, body = 1, 1, payload
+    else:
+        parts = payload.split(".", 2)
+        if len(parts) != 3 or not (parts[1].isascii() and parts[1].isdigit()):
+            raise SystemDataError("存档格式不正确")
+        tag, schema, body = parts
+        if tag != "SD2":
+            raise SystemDataError(f"不支持的存档格式: {tag}")
+        version = 2
+        schema = int(schema)
+        if schema > SYSTEM_DATA_SCHEMA:
+            raise SystemDataError(f"存档由更新版本的系统生成（数据结构版本 {schema}），请升级后再读取")
+    try:
+        raw = base64.b64decode(body, validate=True)
+        if version == 2:
+            raw = zlib.decompress(raw)
+        return version, schema, json.loads(raw.decode("utf-8"))
+    except Exception as e:
+        raise SystemDataError(f"存档数据已损坏: {type(e).__name__}: {e}")
+
+def extract_system_data(text: str):
+    """从数据存档全文中取出并解析 SYSTEM_DATA，返回 (格式版本, 数据结构版本, 数据)；没有时返回 None"""
+    match = SYSTEM_DATA_PATTERN.search(text)
+    if match is None:
+        return None
+    return decode_system_data(match.group(1))
+
 # ✨✨✨ 核心逻辑：生成“三明治”报告文件 ✨✨✨
 def generate_smart_report(data: ContractRequest):
     # 🌟 预先计算 Derived Data 确保写入 JSON
@@ -454,25 +991,271 @@ def generate_smart_report(data: ContractRequest):
     lines.append("="*40)
     
     # --- Part 2: 机器可读部分 (JSON数据) ---
-    # 使用 Base64 简单编码防止中文乱码和换行问题干扰
-    json_str = json.dumps(data.model_dump(), ensure_ascii=False)
-    b64_str = base64.b64encode(json_str.encode('utf-8')).decode('utf-8')
-    
-    lines.append(f"SYSTEM_DATA_START:{b64_str}:SYSTEM_DATA_END")
+    # 压缩后 Base64 编码，防止中文乱码和换行问题干扰（格式见“数据存档编码”）
+    lines.append(f"SYSTEM_DATA_START:{encode_system_data(data.model_dump())}:SYSTEM_DATA_END")
     
     return "\n".join(lines)
 
+# ============= 性能指标 =============
+# 各阶段耗时写入进程内的直方图（只做计数，开销很小），/metrics 被抓取时才生成 Prometheus 文本；
+# 同一请求内的阶段耗时同时记录下来，通过 Server-Timing 响应头返回
+
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _metric_labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            lines.append(f"{self.name}{_metric_labels(self.labels, label_values)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=METRIC_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}     # 标签值 -> [各区间计数..., 总和, 次数]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 3)
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        for label_values, series in items:
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ["+Inf"], series):
+                cumulative += count
+                labels = _metric_labels(self.labels + ("le",), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _metric_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {series[-2]}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+class Gauge:
+    """抓取时调用 fn 取当前值；metric_type 为 counter 时用于暴露其他地方维护的累计值"""
+
+    def __init__(self, name, help_text, fn, metric_type="gauge"):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        self.metric_type = metric_type
+
+    def collect(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.metric_type}", f"{self.name} {self.fn()}"]
+
+METRICS = []
+
+def register_metric(metric):
+    METRICS.append(metric)
+    return metric
+
+HTTP_SECONDS = register_metric(Histogram("bank_http_request_seconds", "HTTP 请求处理时间", ("method", "route", "status")))
+STAGE_SECONDS = register_metric(Histogram("bank_stage_seconds", "各处理阶段耗时", ("stage",)))
+TEMPLATE_SECONDS = register_metric(Histogram("bank_template_render_seconds", "单个模板渲染耗时（渲染进程内）", ("template",)))
+TEMPLATE_ERRORS = register_metric(Counter("bank_template_render_errors_total", "模板渲染失败次数", ("template",)))
+BYTES_WRITTEN = register_metric(Counter("bank_bytes_written_total", "生成的文件字节数", ("kind",)))
+RENDER_CACHE_LOOKUPS = register_metric(Counter("bank_render_cache_lookups_total", "渲染缓存查询次数", ("result",)))
+register_metric(Gauge("bank_log_dropped_total", "日志队列已满而丢弃的日志条数", lambda: log_stats["dropped"], "counter"))
+register_metric(Gauge("bank_log_over_budget_total", "超出单请求日志上限而丢弃的日志条数", lambda: log_stats["over_budget"], "counter"))
+
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+def record_stage(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+@contextlib.contextmanager
+def timed(stage):
+    """记录 with 块的耗时"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+def format_server_timing(timings, total):
+    """同名阶段（如多次 executor_wait）合并；耗时单位为毫秒"""
+    merged = {}
+    for stage, seconds in timings:
+        merged[stage] = merged.get(stage, 0) + seconds
+    merged["total"] = total
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in merged.items())
+
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+class RequestContextMiddleware:
+    """
+    请求级上下文：请求ID（沿用客户端的 X-Request-ID 或新生成）、日志预算、阶段计时
+    响应中返回 X-Request-ID 和 Server-Timing，并记录请求处理时间
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        request_id = dict(scope.get("headers", [])).get(b"x-request-id", b"").decode("latin-1")
+        if not REQUEST_ID_PATTERN.match(request_id):
+            request_id = uuid.uuid4().hex[:12]
+        log_context = LogContext(request_id, LOG_REQUEST_MAX_CHARS)
+        log_token = _log_context.set(log_context)
+        timings = []
+        token = _request_timings.set(timings)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_context(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                header = format_server_timing(timings, time.perf_counter() - start)
+                message = {**message, "headers": list(message.get("headers", [])) + [
+                    (b"server-timing", header.encode("latin-1")),
+                    (b"x-request-id", request_id.encode("latin-1")),
+                ]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_context)
+        finally:
+            _request_timings.reset(token)
+            # 按路由模板统计，避免 /api/jobs/{id} 这类路径产生大量序列
+            route = getattr(scope.get("route"), "path", None) or "other"
+            HTTP_SECONDS.observe(time.perf_counter() - start, scope["method"], route, str(status))
+            if log_context.dropped:
+                log_context.budget = None
+                logger.warning(f"本请求日志超出上限，已丢弃 {log_context.dropped} 条")
+            _log_context.reset(log_token)
+
+app.add_middleware(RequestContextMiddleware)
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus 文本格式的性能指标"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.collect())
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# ============= 阻塞任务与准入控制 =============
+
+# 阻塞任务（文件读写、渲染调度、压缩、Excel 解析）线程数
+BLOCKING_WORKERS = int(os.environ.get("BANK_BLOCKING_WORKERS", "8"))
+# 同时处理的生成请求数上限，以及超出上限后允许排队的请求数
+MAX_IN_FLIGHT = int(os.environ.get("BANK_MAX_IN_FLIGHT", "4"))
+MAX_QUEUE = int(os.environ.get("BANK_MAX_QUEUE", "16"))
+RETRY_AFTER_SECONDS = int(os.environ.get("BANK_RETRY_AFTER", "5"))
+
+blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking")
+
+async def run_blocking(fn, *args):
+    """在阻塞任务线程池中执行 fn(*args)，不占用事件循环；请求上下文（阶段计时）随之带入线程"""
+    loop = asyncio.get_running_loop()
+    submitted = time.perf_counter()
+    context = contextvars.copy_context()
+
+    def call():
+        record_stage("executor_wait", time.perf_counter() - submitted)
+        return fn(*args)
+
+    return await loop.run_in_executor(blocking_executor, context.run, call)
+
+class AdmissionController:
+    """
+    生成类请求的准入控制
+    正在处理的请求达到上限时排队，排队也满时直接返回 503 + Retry-After
+    """
+
+    def __init__(self, max_in_flight, max_queue):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.waiting = 0
+        self._semaphore = None
+
+    async def acquire(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        if self.in_flight >= self.max_in_flight and self.waiting >= self.max_queue:
+            logger.warning(f"⚠️ 请求被拒绝：处理中 {self.in_flight}，排队 {self.waiting}")
+            raise HTTPException(
+                status_code=503,
+                detail="服务繁忙，请稍后重试",
+                headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+            )
+        self.waiting += 1
+        start = time.perf_counter()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+            record_stage("admission_wait", time.perf_counter() - start)
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+admission = AdmissionController(MAX_IN_FLIGHT, MAX_QUEUE)
+register_metric(Gauge("bank_requests_in_flight", "正在处理的生成请求数", lambda: admission.in_flight))
+register_metric(Gauge("bank_requests_waiting", "排队等待的生成请求数", lambda: admission.waiting))
+
 # --- 接口 ---
 
-@app.get("/api/branches")
-async def get_branches():
+# ============= 配置与支行数据 =============
+
+# 配置文件变化检查间隔（秒）
+CONFIG_POLL_SECONDS = float(os.environ.get("BANK_CONFIG_POLL", "2"))
+
+def _load_branches():
     if not os.path.exists(BRANCH_FILE): return []
     try:
         with open(BRANCH_FILE, "r", encoding="utf-8") as f: return json.load(f)
     except: return []
 
-@app.get("/api/config")
-async def get_system_config():
+def _load_system_config(template_files):
     default_config = {"options": {"education": [], "ethnicity": [], "occupation": [], "loan_use": [], "collateral_type": []}, "templates": []}
     if not os.path.exists(DATA_FILE): return default_config
     try:
@@ -480,122 +1263,693 @@ async def get_system_config():
             config = json.load(f)
         valid_templates = []
         for tmpl in config.get("templates", []):
-            if os.path.exists(os.path.join(TEMPLATE_DIR, tmpl['filename'])):
+            # 清单中没有时再查一次磁盘（子目录、Windows 文件名大小写等情况）
+            if tmpl['filename'] in template_files or os.path.exists(os.path.join(TEMPLATE_DIR, tmpl['filename'])):
                 tmpl['value'] = tmpl['filename']
                 valid_templates.append(tmpl)
         config["templates"] = valid_templates
         return config
     except: return default_config
 
-@app.get("/api/customers")
-async def get_customers():
-    """读取Excel文件，返回到期客户列表"""
+def _stat_signature(path):
     try:
-        import pandas as pd
-        excel_path = os.path.join(BASE_DIR, "贷款到期清单.xlsx")
-        
-        if not os.path.exists(excel_path):
-            logger.warning(f"未找到到期清单文件: {excel_path}")
-            return {"customers": []}
-        
-        logger.info(f"正在读取到期清单: {excel_path}")
-        # 指定身份证等列为字符串类型，避免科学计数法
-        df = pd.read_excel(excel_path, dtype={
-            "证件号（对公情况）": str,
-            "身份证": str,
-            "共同借款人1证件号": str,
-            "共同借款人2证件号": str,
-            "担保人1身份证": str,
-            "担保人2身份证": str,
-            "担保人3身份证": str,
-            "担保人4身份证": str,
-            "担保人5身份证": str,
-            "联系方式（对公情况）": str,
-            "联系方式": str,
-            "共同借款人1联系方式": str,
-            "共同借款人2联系方式": str,
-            "担保人1联系方式": str,
-            "担保人2联系方式": str,
-            "担保人3联系方式": str,
-            "担保人4联系方式": str,
-            "担保人5联系方式": str
-        })
-        customers = []
-        
-        for idx, row in df.iterrows():
-            # 读取或推断客户主体类型
-            customer_type_raw = str(row.get("客户主体", "")).strip()
-            main_id = str(row.get("证件号（对公情况）", "")).strip()
-            # 如果Excel中有customer_type，使用它；否则根据证件号推断
-            if customer_type_raw and customer_type_raw != "nan":
-                customer_type = customer_type_raw
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+class ConfigRegistry:
+    """
+    data.json / branches.json / 模板目录清单的内存快照
+    后台线程按 mtime 轮询，文件变化后整体重建快照并一次性替换，接口读取时不访问磁盘
+    """
+
+    def __init__(self, poll_seconds):
+        self.poll_seconds = poll_seconds
+        self._snapshot = None     # (签名, 支行列表, 系统配置, 模板文件集合)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _signature(self):
+        return (_stat_signature(DATA_FILE), _stat_signature(BRANCH_FILE), _stat_signature(TEMPLATE_DIR))
+
+    def _build(self, signature):
+        try:
+            template_files = frozenset(os.listdir(TEMPLATE_DIR))
+        except OSError:
+            template_files = frozenset()
+        return (signature, _load_branches(), _load_system_config(template_files), template_files)
+
+    def refresh(self, force=False):
+        """文件有变化时重建快照，返回是否发生了替换"""
+        with self._lock:
+            signature = self._signature()
+            if not force and self._snapshot is not None and self._snapshot[0] == signature:
+                return False
+            self._snapshot = self._build(signature)
+        logger.info("配置已加载: 支行 %d 个，模板 %d 个" % (len(self._snapshot[1]), len(self._snapshot[2].get("templates", []))))
+        return True
+
+    def current(self):
+        """返回当前快照 (签名, 支行列表, 系统配置, 模板文件集合)，各部分取自同一次加载"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            self.refresh()
+            snapshot = self._snapshot
+        return snapshot
+
+    @property
+    def branches(self):
+        return self.current()[1]
+
+    @property
+    def system_config(self):
+        return self.current()[2]
+
+    @property
+    def template_files(self):
+        return self.current()[3]
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_seconds):
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning(f"配置刷新失败: {e}")
+
+    def start(self):
+        self.refresh()
+        if self._thread is None and self.poll_seconds > 0:
+            self._thread = threading.Thread(target=self._watch, name="config-watch", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+config_registry = ConfigRegistry(CONFIG_POLL_SECONDS)
+
+def _signature_mtime(*signatures):
+    """取签名中最新的修改时间（秒），文件都不存在时返回 None"""
+    mtimes = [sig[0] for sig in signatures if sig is not None]
+    return max(mtimes) / 1e9 if mtimes else None
+
+@app.get("/api/branches")
+async def get_branches(request: Request):
+    signature, branches, _, _ = config_registry.current()
+    return conditional_json(request, signature[1], lambda: branches, _signature_mtime(signature[1]))
+
+@app.get("/api/config")
+async def get_system_config(request: Request):
+    # 有效模板列表取决于模板目录，版本同时包含 data.json 和模板目录的签名
+    signature, _, system_config, _ = config_registry.current()
+    version = (signature[0], signature[2])
+    return conditional_json(request, version, lambda: system_config, _signature_mtime(*version))
+
+# 到期清单：Excel 按行增量导入本地客户库（SQLite），接口从客户库读取，重启后无需重新解析
+CUSTOMER_FILE = os.path.join(BASE_DIR, "贷款到期清单.xlsx")
+CUSTOMER_DB_FILE = os.environ.get("BANK_CUSTOMER_DB", os.path.join(CWD, "customers.db"))
+# 解析逻辑版本，变化时即使 Excel 未改动也重新导入
+CUSTOMER_PARSER_VERSION = 4
+
+# 到期日可能是日期单元格，也可能是以下格式的文本
+DUE_DATE_FORMATS = ("%Y-%m-%d", "%Y/%m/%d", "%Y.%m.%d", "%Y%m%d", "%Y-%m-%d %H:%M:%S", "%Y/%m/%d %H:%M:%S")
+
+def _cell_text(value):
+    """单元格值转为字符串：空单元格为空串；整数值的浮点数去掉 .0，避免证件号、手机号变成 1.38e+10 的形式"""
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+def _due_date_text(value):
+    """到期日统一为 YYYY-MM-DD，无法识别时保留原文"""
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d")
+    text = _cell_text(value)
+    for fmt in DUE_DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return text
+
+# 校验规则：证件号为18位（身份证号或统一社会信用代码）；联系方式允许手机号、座机号
+ID_NUMBER_PATTERN = re.compile(r"^(\d{17}[\dXx]|[0-9A-Z]{18})$")
+PHONE_PATTERN = re.compile(r"^[\d+\- ]{7,20}$")
+DUE_DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+CUSTOMER_TYPES = ("personal", "enterprise")
+
+def _customer_excel_columns():
+    """到期清单的列定义：(字段, 表头, 转换函数, 校验)；关联人的字段为 (角色, 序号, 属性)"""
+    text, valid_id, valid_phone = _cell_text, ID_NUMBER_PATTERN.match, PHONE_PATTERN.match
+    columns = [
+        ("customer_type", "客户主体", text, CUSTOMER_TYPES.__contains__),
+        ("branch_short_name", "支行简称", text, None),
+        ("main_name", "贷款人", text, None),
+        ("main_id_card", "证件号（对公情况）", text, valid_id),
+        ("main_mobile", "联系方式（对公情况）", text, valid_phone),
+        ("main_address", "住址", text, None),
+        ("spouse_name", "配偶名", text, None),
+        ("spouse_id_card", "身份证", text, valid_id),
+        ("spouse_mobile", "联系方式", text, valid_phone),
+        ("due_date", "到期日", _due_date_text, DUE_DATE_PATTERN.match),
+    ]
+    # 共同借款人1-2、担保人1-5
+    for role, label, id_title, count in (("joint_borrowers", "共同借款人", "证件号", 2), ("guarantors", "担保人", "身份证", 5)):
+        for seq in range(count):
+            columns += [
+                ((role, seq, "name"), f"{label}{seq + 1}名称", text, None),
+                ((role, seq, "id_card"), f"{label}{seq + 1}{id_title}", text, valid_id),
+                ((role, seq, "mobile"), f"{label}{seq + 1}联系方式", text, valid_phone),
+            ]
+    return columns
+
+CUSTOMER_EXCEL_COLUMNS = _customer_excel_columns()
+# 每次按列转换的行数，内存占用只与块大小有关
+CUSTOMER_CHUNK_ROWS = 1000
+# 每列最多记录的不合格行号
+CUSTOMER_INVALID_SAMPLES = 20
+
+class CustomerSheetSchema:
+    """
+    按表头编译后的到期清单列定义
+    表头只解析一次；之后每块原始行先转置为列，逐列做空值归一、字符串转换和校验，再组装客户记录
+    """
+
+    def __init__(self, header, columns=CUSTOMER_EXCEL_COLUMNS):
+        positions = {}
+        for i, name in enumerate(header):
+            if name is not None:
+                positions.setdefault(str(name).strip(), i)
+        self.columns = [(field, title, positions.get(title), convert, check) for field, title, convert, check in columns]
+        self.roles = {field[0]: field[1] + 1 for field, *_ in self.columns if isinstance(field, tuple)}
+        self.rows = 0
+        self.skipped = 0
+        self.stats = {title: {"present": index is not None, "filled": 0, "empty": 0, "invalid": 0, "invalid_rows": []}
+                      for _, title, index, _, _ in self.columns}
+
+    def convert(self, rows):
+        """把一块原始行（openpyxl values_only 元组）转换为客户记录列表"""
+        count = len(rows)
+        # 行长度可能不一致，zip_longest 用 None 补齐
+        cells = list(itertools.zip_longest(*rows))
+        values = {}
+        for field, title, index, convert, check in self.columns:
+            if index is None or index >= len(cells):
+                column = [""] * count
             else:
-                customer_type = "enterprise" if main_id.startswith("91") else "personal"
-            
-            customer = {
-                "customer_type": customer_type,
-                "branch_short_name": str(row.get("支行简称", "")).strip(),
-                "main_name": str(row.get("贷款人", "")).strip(),
-                "main_id_card": main_id,
-                "main_mobile": str(row.get("联系方式（对公情况）", "")).strip(),
-                "main_address": str(row.get("住址", "")).strip(),
-                "spouse_name": str(row.get("配偶名", "")).strip(),
-                "spouse_id_card": str(row.get("身份证", "") if pd.notna(row.get("身份证")) else "").strip(),
-                "spouse_mobile": str(row.get("联系方式", "") if pd.notna(row.get("联系方式")) else "").strip(),
-                "joint_borrowers": [],
-                "guarantors": []
-            }
-            
-            # 解析共同借款人1-2
-            for i in range(1, 3):
-                jb_name_col = f"共同借款人{i}名称"
-                jb_name = str(row.get(jb_name_col, "")).strip()
-                if jb_name and jb_name != "nan":
-                    joint_borrower = {
-                        "name": jb_name,
-                        "id_card": str(row.get(f"共同借款人{i}证件号", "")).strip(),
-                        "mobile": str(row.get(f"共同借款人{i}联系方式", "")).strip()
-                    }
-                    customer["joint_borrowers"].append(joint_borrower)
-            
-            # 解析担保人1-5
-            for i in range(1, 6):
-                g_name_col = f"担保人{i}名称"
-                g_name = str(row.get(g_name_col, "")).strip()
-                if g_name and g_name != "nan":
-                    guarantor = {
-                        "name": g_name,
-                        "id_card": str(row.get(f"担保人{i}身份证", "")).strip(),
-                        "mobile": str(row.get(f"担保人{i}联系方式", "")).strip()
-                    }
-                    customer["guarantors"].append(guarantor)
-            
+                column = list(map(convert, cells[index]))
+            values[field] = column
+            stat = self.stats[title]
+            empty = column.count("")
+            stat["filled"] += count - empty
+            stat["empty"] += empty
+            if check is not None and count > empty:
+                invalid = list(itertools.compress(range(count), (v and not check(v) for v in column)))
+                if invalid:
+                    stat["invalid"] += len(invalid)
+                    # Excel 行号：表头占第 1 行
+                    room = CUSTOMER_INVALID_SAMPLES - len(stat["invalid_rows"])
+                    stat["invalid_rows"].extend(self.rows + i + 2 for i in invalid[:max(room, 0)])
+        self.rows += count
+
+        # Excel 中没有客户主体时根据证件号推断
+        values["customer_type"] = [
+            kind or ("enterprise" if id_card.startswith("91") else "personal")
+            for kind, id_card in zip(values["customer_type"], values["main_id_card"])
+        ]
+        # 关联人按组展开：每组名称非空时追加到对应行的列表
+        parties = {}
+        for role, groups in self.roles.items():
+            lists = [[] for _ in range(count)]
+            for seq in range(groups):
+                names, id_cards, mobiles = (values[(role, seq, key)] for key in ("name", "id_card", "mobile"))
+                for i in itertools.compress(range(count), names):
+                    lists[i].append({"name": names[i], "id_card": id_cards[i], "mobile": mobiles[i]})
+            parties[role] = lists
+
+        customers = []
+        records = zip(*(values[f] for f in CUSTOMER_FIELDS), *(parties[role] for role in CUSTOMER_PARTY_ROLES))
+        keys = CUSTOMER_FIELDS + CUSTOMER_PARTY_ROLES
+        for name, record in zip(values["main_name"], records):
             # 只添加有效的客户（至少有姓名）
-            if customer["main_name"] and customer["main_name"] != "nan":
-                customers.append(customer)
-        
-        logger.info(f"成功读取 {len(customers)} 个到期客户")
-        return {"customers": customers}
-    
-    except Exception as e:
-        logger.error(f"读取到期清单失败: {e}")
-        logger.error(traceback.format_exc())
-        return {"customers": [], "error": str(e)}
+            if name:
+                customers.append(dict(zip(keys, record)))
+        self.skipped += count - len(customers)
+        return customers
 
+    def report(self):
+        """各列的校验统计：是否存在、非空/空值个数、不合格个数及前若干个不合格的 Excel 行号"""
+        return {"rows": self.rows, "skipped": self.skipped, "columns": self.stats}
 
-# Helper function to generate investigation report context
-def generate_investigation_context(data: ContractRequest):
-    """生成调查报告的context"""
-    # Build main borrower summary
-    if data.main_borrower:
-        mb = data.main_borrower
-        main_summary = f"{mb.name}，{mb.gender}，{mb.age}岁，身份证号：{mb.id_card}，"
+def iter_customer_excel(excel_path, report=None):
+    """
+    逐块读取到期清单 Excel（openpyxl 只读模式），逐个产出客户记录
+    不整表载入内存，内存占用与行数无关；传入 report（dict）时读取结束后写入各列校验统计
+    """
+    import openpyxl
+
+    wb = openpyxl.load_workbook(excel_path, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        schema = CustomerSheetSchema(header)
+        while True:
+            chunk = list(itertools.islice(rows, CUSTOMER_CHUNK_ROWS))
+            if not chunk:
+                break
+            yield from schema.convert(chunk)
+        if report is not None:
+            report.update(schema.report())
+    finally:
+        wb.close()
+
+def log_customer_validation(report):
+    """缺失的列、含不合格值的列写入警告日志"""
+    missing = [title for title, stat in report.get("columns", {}).items() if not stat["present"]]
+    if missing:
+        logger.info(f"到期清单缺少列: {', '.join(missing)}")
+    for title, stat in report.get("columns", {}).items():
+        if stat["invalid"]:
+            logger.warning(f"到期清单「{title}」列有 {stat['invalid']} 个值格式不正确，行号: {stat['invalid_rows']}")
+
+def parse_customer_excel(excel_path):
+    """解析到期清单 Excel，返回客户列表"""
+    return list(iter_customer_excel(excel_path))
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+CUSTOMER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS customers (
+    id TEXT PRIMARY KEY,
+    source_row INTEGER NOT NULL,
+    customer_type TEXT NOT NULL,
+    branch_short_name TEXT NOT NULL,
+    main_name TEXT NOT NULL,
+    main_id_card TEXT NOT NULL,
+    main_mobile TEXT NOT NULL,
+    main_address TEXT NOT NULL,
+    spouse_name TEXT NOT NULL,
+    spouse_id_card TEXT NOT NULL,
+    spouse_mobile TEXT NOT NULL,
+    due_date TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS customers_order ON customers (source_row);
+CREATE INDEX IF NOT EXISTS customers_branch_due ON customers (branch_short_name, due_date);
+CREATE INDEX IF NOT EXISTS customers_due ON customers (due_date);
+CREATE INDEX IF NOT EXISTS customers_main_id_card ON customers (main_id_card);
+CREATE TABLE IF NOT EXISTS customer_parties (
+    customer_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    id_card TEXT NOT NULL,
+    mobile TEXT NOT NULL,
+    PRIMARY KEY (customer_id, role, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS customer_parties_id_card ON customer_parties (id_card);
+CREATE TABLE IF NOT EXISTS customer_source (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+CUSTOMER_FIELDS = ("customer_type", "branch_short_name", "main_name", "main_id_card", "main_mobile", "main_address",
+                   "spouse_name", "spouse_id_card", "spouse_mobile", "due_date")
+# 关联人角色即客户记录中的列表字段名
+CUSTOMER_PARTY_ROLES = ("joint_borrowers", "guarantors")
+
+class CustomerStore:
+    """
+    本地客户库：客户一行，共同借款人/担保人另表存放
+    客户ID即整行内容的哈希（customer_id），重新导入时新出现的哈希插入、消失的删除、其余不动
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._schema_ready = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        if not self._schema_ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(CUSTOMER_SCHEMA)
+            self._schema_ready = True
+        return conn
+
+    def sync(self, excel_path, st):
+        """把到期清单导入客户库，返回统计；清单内容和解析逻辑都未变时返回 None"""
+        with contextlib.closing(self._connect()) as conn:
+            source = {row["key"]: row["value"] for row in conn.execute("SELECT key, value FROM customer_source")}
+            signature = {"size": str(st.st_size), "mtime_ns": str(st.st_mtime_ns), "parser": str(CUSTOMER_PARSER_VERSION)}
+            if all(source.get(k) == v for k, v in signature.items()):
+                return None
+            sha256 = _file_sha256(excel_path)
+            signature["sha256"] = sha256
+            if source.get("sha256") == sha256 and source.get("parser") == signature["parser"]:
+                # 文件时间变了但内容相同（如复制覆盖）
+                self._write_source(conn, signature)
+                conn.commit()
+                return None
+            logger.info(f"正在导入到期清单: {excel_path}")
+            validation = {}
+            stats = self._import(conn, iter_customer_excel(excel_path, validation))
+            signature["validation"] = json.dumps(validation, ensure_ascii=False)
+            self._write_source(conn, signature)
+            conn.commit()
+        logger.info(f"到期清单已导入客户库: {stats}")
+        log_customer_validation(validation)
+        return stats
+
+    def _import(self, conn, customers):
+        """customers 可以是生成器，逐条写入，不要求整表在内存中"""
+        existing = {row["id"]: row["source_row"] for row in conn.execute("SELECT id, source_row FROM customers")}
+        stats = {"rows": 0, "inserted": 0, "moved": 0, "deleted": 0, "unchanged": 0}
+        seen = set()
+        for row, customer in enumerate(customers):
+            stats["rows"] += 1
+            cid = customer_id(customer)
+            # 内容完全相同的重复行只保留第一条
+            if cid in seen:
+                continue
+            seen.add(cid)
+            old_row = existing.get(cid)
+            if old_row is None:
+                conn.execute(f"INSERT INTO customers (id, source_row, {', '.join(CUSTOMER_FIELDS)}) "
+                             f"VALUES ({', '.join('?' * (len(CUSTOMER_FIELDS) + 2))})",
+                             (cid, row, *(customer[f] for f in CUSTOMER_FIELDS)))
+                conn.executemany("INSERT INTO customer_parties (customer_id, role, seq, name, id_card, mobile) "
+                                 "VALUES (?, ?, ?, ?, ?, ?)",
+                                 [(cid, role, seq, p["name"], p["id_card"], p["mobile"])
+                                  for role in CUSTOMER_PARTY_ROLES for seq, p in enumerate(customer[role])])
+                stats["inserted"] += 1
+            elif old_row != row:
+                # 只是在清单中的位置变了
+                conn.execute("UPDATE customers SET source_row = ? WHERE id = ?", (row, cid))
+                stats["moved"] += 1
+            else:
+                stats["unchanged"] += 1
+        gone = [(cid,) for cid in existing if cid not in seen]
+        conn.executemany("DELETE FROM customer_parties WHERE customer_id = ?", gone)
+        conn.executemany("DELETE FROM customers WHERE id = ?", gone)
+        stats["deleted"] = len(gone)
+        return stats
+
+    def validation(self):
+        """最近一次导入时的各列校验统计，未导入过时返回 None"""
+        with contextlib.closing(self._connect()) as conn:
+            row = conn.execute("SELECT value FROM customer_source WHERE key = 'validation'").fetchone()
+        return json.loads(row["value"]) if row else None
+
+    @staticmethod
+    def _write_source(conn, signature):
+        conn.executemany("INSERT OR REPLACE INTO customer_source (key, value) VALUES (?, ?)", signature.items())
+
+    def fetch(self, where="", params=()):
+        """按清单顺序返回 [(客户ID, 客户)]；where 为 customers 表上的筛选条件"""
+        with contextlib.closing(self._connect()) as conn:
+            customers = {}
+            for row in conn.execute(f"SELECT * FROM customers {where} ORDER BY source_row", params):
+                customer = {f: row[f] for f in CUSTOMER_FIELDS}
+                for role in CUSTOMER_PARTY_ROLES:
+                    customer[role] = []
+                customers[row["id"]] = customer
+            party_sql = "SELECT customer_id, role, name, id_card, mobile FROM customer_parties"
+            if where:
+                party_sql += f" WHERE customer_id IN (SELECT id FROM customers {where})"
+            for p in conn.execute(party_sql + " ORDER BY customer_id, role, seq", params):
+                customer = customers.get(p["customer_id"])
+                if customer is not None:
+                    customer[p["role"]].append({"name": p["name"], "id_card": p["id_card"], "mobile": p["mobile"]})
+        return list(customers.items())
+
+    def get(self, cid):
+        found = self.fetch("WHERE id = ?", (cid,))
+        return found[0][1] if found else None
+
+    def query(self, branch_short_name="", due_from="", due_to=""):
+        """按支行、到期日范围筛选（走索引）"""
+        clauses = []
+        params = []
+        if branch_short_name:
+            clauses.append("branch_short_name = ?")
+            params.append(branch_short_name)
+        if due_from or due_to:
+            clauses.append("due_date != ''")
+        if due_from:
+            clauses.append("due_date >= ?")
+            params.append(due_from)
+        if due_to:
+            clauses.append("due_date <= ?")
+            params.append(due_to)
+        return self.fetch(f"WHERE {' AND '.join(clauses)}" if clauses else "", tuple(params))
+
+class CustomerListCache:
+    """
+    到期客户列表缓存
+    数据来自客户库；到期清单的 (size, mtime) 变化后先增量导入客户库，再从客户库重新读取
+    """
+
+    def __init__(self, excel_path, store):
+        self.excel_path = excel_path
+        self.store = store
+        self._state = None        # ((size, mtime_ns), 客户列表)，整体替换，读取时无需加锁
+        self._lock = threading.Lock()
+
+    def get(self):
+        """返回客户列表；文件不存在时返回 None"""
+        state = self.snapshot()
+        return state[1] if state is not None else None
+
+    def snapshot(self):
+        """返回 ((size, mtime_ns), 客户列表)，两者对应同一版本的到期清单；文件不存在时返回 None"""
+        if not os.path.exists(self.excel_path):
+            return None
+        st = os.stat(self.excel_path)
+        state = self._state
+        if state is not None and state[0] == (st.st_size, st.st_mtime_ns):
+            return state
+        with self._lock:
+            st = os.stat(self.excel_path)
+            state = self._state
+            if state is not None and state[0] == (st.st_size, st.st_mtime_ns):
+                return state
+            with timed("customers_load"):
+                self._load(st)
+            return self._state
+
+    def _load(self, st):
+        key = (st.st_size, st.st_mtime_ns)
+        stats = self.store.sync(self.excel_path, st)
+        # 客户库内容未变，内存中的列表仍然有效
+        if stats is None and self._state is not None:
+            self._state = (key, self._state[1])
+            return
+        customers = [customer for _, customer in self.store.fetch()]
+        self._state = (key, customers)
+        logger.info(f"从客户库加载 {len(customers)} 个到期客户")
+
+customer_store = CustomerStore(CUSTOMER_DB_FILE)
+customer_cache = CustomerListCache(CUSTOMER_FILE, customer_store)
+
+def pinyin_initials(text):
+    """汉字转拼音首字母（如 张三 -> zs），未安装 pypinyin 时返回空串"""
+    try:
+        from pypinyin import lazy_pinyin, Style
+    except ImportError:
+        return ""
+    return "".join(p[0] for p in lazy_pinyin(text, style=Style.FIRST_LETTER) if p).lower()
+
+def customer_id(customer):
+    """按内容生成稳定的客户ID"""
+    raw = json.dumps(customer, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+def customer_summary(customer):
+    """搜索结果中的精简客户信息"""
+    return {
+        "id": customer_id(customer),
+        "customer_type": customer["customer_type"],
+        "branch_short_name": customer["branch_short_name"],
+        "main_name": customer["main_name"],
+        "main_id_card": customer["main_id_card"],
+        "joint_borrower_count": len(customer["joint_borrowers"]),
+        "guarantor_count": len(customer["guarantors"]),
+    }
+
+class CustomerSearchIndex:
+    """
+    到期客户内存索引
+    名称/证件号/支行简称/拼音首字母 按前缀查找，证件号额外支持后缀查找（如身份证后四位）
+    """
+
+    def __init__(self, customers):
+        self.customers = customers
+        self.ids = [customer_id(c) for c in customers]
+        self.by_id = {cid: i for i, cid in enumerate(self.ids)}
+        prefix_keys = []
+        suffix_keys = []
+        for i, c in enumerate(customers):
+            names = [c["main_name"]]
+            id_cards = [c["main_id_card"]]
+            for party in c["joint_borrowers"] + c["guarantors"]:
+                names.append(party["name"])
+                id_cards.append(party["id_card"])
+            for name in names:
+                if not name:
+                    continue
+                prefix_keys.append((name.lower(), i))
+                initials = pinyin_initials(name)
+                if initials:
+                    prefix_keys.append((initials, i))
+            for id_card in id_cards:
+                if not id_card:
+                    continue
+                id_card = id_card.lower()
+                prefix_keys.append((id_card, i))
+                suffix_keys.append((id_card[::-1], i))
+            if c["branch_short_name"]:
+                prefix_keys.append((c["branch_short_name"].lower(), i))
+        prefix_keys.sort()
+        suffix_keys.sort()
+        self._prefix = prefix_keys
+        self._suffix = suffix_keys
+
+    @staticmethod
+    def _scan(keys, query):
+        matched = set()
+        pos = bisect.bisect_left(keys, (query, -1))
+        while pos < len(keys) and keys[pos][0].startswith(query):
+            matched.add(keys[pos][1])
+            pos += 1
+        return matched
+
+    def search(self, q="", branch="", page=1, page_size=20):
+        q = q.strip().lower()
+        if q:
+            matched = self._scan(self._prefix, q) | self._scan(self._suffix, q[::-1])
+            indexes = sorted(matched)
+        else:
+            indexes = range(len(self.customers))
+        if branch:
+            indexes = [i for i in indexes if self.customers[i]["branch_short_name"] == branch]
+        indexes = list(indexes)
+        start = (page - 1) * page_size
+        return {
+            "total": len(indexes),
+            "page": page,
+            "page_size": page_size,
+            "items": [customer_summary(self.customers[i]) for i in indexes[start:start + page_size]],
+        }
+
+    def get(self, cid):
+        i = self.by_id.get(cid)
+        return None if i is None else self.customers[i]
+
+_customer_index = None
+_customer_index_lock = threading.Lock()
+
+def get_customer_index():
+    """客户列表变化后重建索引"""
+    global _customer_index
+    customers = customer_cache.get()
+    if customers is None:
+        return None
+    index = _customer_index
+    if index is not None and index.customers is customers:
+        return index
+    with _customer_index_lock:
+        if _customer_index is None or _customer_index.customers is not customers:
+            _customer_index = CustomerSearchIndex(customers)
+            logger.info(f"客户搜索索引已重建: {len(customers)} 个客户")
+        return _customer_index
+
+@app.get("/api/customers")
+async def get_customers(request: Request):
+    """返回到期客户列表（来自客户库，到期清单有变化时先增量导入）；支持 ETag/304"""
+    try:
+        state = await run_blocking(customer_cache.snapshot)
+        if state is None:
+            logger.warning(f"未找到到期清单文件: {CUSTOMER_FILE}")
+            return {"customers": []}
+        (size, mtime_ns), customers = state
+        return conditional_json(request, (size, mtime_ns, CUSTOMER_PARSER_VERSION),
+                                lambda: {"customers": customers}, mtime_ns / 1e9)
+    
+    except Exception as e:
+        logger.error(f"读取到期清单失败: {e}")
+        logger.error(traceback.format_exc())
+        return {"customers": [], "error": str(e)}
+
+@app.get("/api/customers/search")
+async def search_customers(q: str = "", branch: str = "", page: int = 1, page_size: int = 20):
+    """搜索到期客户（分页），支持姓名/证件号前缀、证件号后缀、拼音首字母"""
+    page = max(page, 1)
+    page_size = min(max(page_size, 1), 200)
+    try:
+        index = await run_blocking(get_customer_index)
+        if index is None:
+            return {"total": 0, "page": page, "page_size": page_size, "items": []}
+        return index.search(q, branch, page, page_size)
+    except Exception as e:
+        logger.error(f"搜索到期客户失败: {e}")
+        logger.error(traceback.format_exc())
+        return {"total": 0, "page": page, "page_size": page_size, "items": [], "error": str(e)}
+
+@app.get("/api/customers/validation")
+async def get_customer_validation():
+    """到期清单各列的校验统计（缺失的列、空值和格式不正确的值及其行号）"""
+    def load():
+        if customer_cache.get() is None:
+            return None
+        return customer_cache.store.validation()
+
+    report = await run_blocking(load)
+    if report is None:
+        raise HTTPException(status_code=404, detail="到期清单尚未导入")
+    return report
+
+def get_customer(cid):
+    """从客户库按ID取客户（先确认客户库与到期清单一致）"""
+    if customer_cache.get() is None:
+        return None
+    return customer_cache.store.get(cid)
+
+@app.get("/api/customers/{cid}")
+async def get_customer_detail(cid: str):
+    """获取单个到期客户的完整信息（含共同借款人和担保人）"""
+    customer = await run_blocking(get_customer, cid)
+    if customer is None:
+        raise HTTPException(status_code=404, detail="客户不存在或到期清单已更新")
+    return {"id": cid, **customer}
+
+
+# Helper function to generate investigation report context
+def generate_investigation_context(data: ContractRequest):
+    """
+    生成调查报告的context（/api/generate 与 /api/generate-investigation-report 共用）
+    年龄、评估价值大写由证件号、金额计算，不依赖请求中是否已填写
+    """
+    # Build main borrower summary
+    if data.main_borrower:
+        mb = data.main_borrower
+        main_summary = f"{mb.name}，{mb.gender}，{calculate_age(mb.id_card)}岁，身份证号：{mb.id_card}，"
         main_summary += f"联系电话：{mb.mobile}，职业：{mb.occupation or '无'}，"
         main_summary += f"学历：{mb.education or '无'}，现住址：{mb.address}。"
         
         if data.spouse and data.spouse.name:
             sp = data.spouse
-            main_summary += f" 配偶{sp.name}，{sp.gender}，{sp.age}岁，"
+            main_summary += f" 配偶{sp.name}，{sp.gender}，{calculate_age(sp.id_card)}岁，"
             main_summary += f"身份证号：{sp.id_card}，联系电话：{sp.mobile}。"
     else:
         main_summary = "未填写"
@@ -606,7 +1960,7 @@ def generate_investigation_context(data: ContractRequest):
         for i, jb in enumerate(data.joint_borrowers, 1):
             if not jb.name:
                 continue
-            jb_text = f"{i}. {jb.name}，{jb.gender}，{jb.age}岁，身份证号：{jb.id_card}，"
+            jb_text = f"{i}. {jb.name}，{jb.gender}，{calculate_age(jb.id_card)}岁，身份证号：{jb.id_card}，"
             jb_text += f"联系电话：{jb.mobile}，职业：{jb.occupation or '无'}，"
             jb_text += f"与借款人关系：{jb.relation or '无'}，住址：{jb.address}。"
             jb_items.append(jb_text)
@@ -620,7 +1974,7 @@ def generate_investigation_context(data: ContractRequest):
         for i, g in enumerate(data.guarantors, 1):
             if not g.name:
                 continue
-            g_text = f"{i}. {g.name}，{g.gender}，{g.age}岁，身份证号：{g.id_card}，"
+            g_text = f"{i}. {g.name}，{g.gender}，{calculate_age(g.id_card)}岁，身份证号：{g.id_card}，"
             g_text += f"联系电话：{g.mobile}，职业：{g.occupation or '无'}，"
             g_text += f"与借款人关系：{g.relation or '无'}，住址：{g.address}。"
             g_items.append(g_text)
@@ -638,7 +1992,7 @@ def generate_investigation_context(data: ContractRequest):
             c_text += f"权证号：{c.cert_no}，建筑面积：{c.area}，"
             if c.land_area:
                 c_text += f"土地面积：{c.land_area}，"
-            c_text += f"评估价值：{c.value}元（{c.value_cn}）。"
+            c_text += f"评估价值：{c.value}元（{num_to_cn(c.value)}）。"
             c_items.append(c_text)
         collaterals_summary = "\\n".join(c_items) if c_items else "无"
     else:
@@ -667,71 +2021,90 @@ def generate_investigation_context(data: ContractRequest):
     }
 
 # ============= Context Building Helper Functions =============
+# keys 为模板引用的顶层变量名集合（见 template_variables）时只计算这些变量，为 None 时全部计算
+
+def _wanted(keys):
+    return (lambda key: True) if keys is None else keys.__contains__
 
-def _calculate_derived_fields(data: ContractRequest) -> dict:
+def _calculate_derived_fields(data: ContractRequest, keys=None) -> dict:
     """集中计算所有派生字段，避免重复计算和遗漏"""
+    want = _wanted(keys)
     derived = {}
     
     # 金额中文
-    if data.loan_amount:
+    if data.loan_amount and want('loan_amount_cn'):
         derived['loan_amount_cn'] = num_to_cn(data.loan_amount)
     
     # 日期中文
-    if data.start_date:
+    if data.start_date and want('start_date_cn'):
         derived['start_date_cn'] = format_date_cn(data.start_date)
-    if data.end_date:
+    if data.end_date and want('end_date_cn'):
         derived['end_date_cn'] = format_date_cn(data.end_date)
     
     # 年龄计算（集中处理，确保一致性）
-    if data.main_borrower and data.main_borrower.id_card:
+    if data.main_borrower and data.main_borrower.id_card and want('main_age'):
         derived['main_age'] = calculate_age(data.main_borrower.id_card)
-    if data.spouse and data.spouse.id_card:
+    if data.spouse and data.spouse.id_card and want('spouse_age'):
         derived['spouse_age'] = calculate_age(data.spouse.id_card)
     
     # 贷款类型中文
     loan_type_map = {'credit': '信用', 'guarantee': '担保', 'mortgage': '抵押'}
-    derived['loan_type_cn'] = loan_type_map.get(data.loan_type, data.loan_type)
-    derived['loan_type'] = derived['loan_type_cn']  # 覆盖为中文
+    loan_type_cn = loan_type_map.get(data.loan_type, data.loan_type)
+    if want('loan_type_cn'):
+        derived['loan_type_cn'] = loan_type_cn
+    if want('loan_type'):
+        derived['loan_type'] = loan_type_cn  # 覆盖为中文
     
     # 婚姻状况
-    derived['main_marital_status'] = '已婚' if (data.spouse and data.spouse.name) else '未婚'
+    if want('main_marital_status'):
+        derived['main_marital_status'] = '已婚' if (data.spouse and data.spouse.name) else '未婚'
     
     return derived
 
-def _expand_lists(data: ContractRequest) -> dict:
+def _expand_lists(data: ContractRequest, keys=None) -> dict:
     """展开列表数据为独立变量，确保数据完整"""
+    want = _wanted(keys)
     expanded = {}
     
     # 共同借款人 (1-3)
     for i in range(3):
+        key = f'joint_borrower{i+1}'
+        if not want(key):
+            continue
         if data.joint_borrowers and i < len(data.joint_borrowers):
             jb_data = data.joint_borrowers[i].model_dump()  # 完整复制
             jb_data['age'] = calculate_age(jb_data.get('id_card', ''))
-            expanded[f'joint_borrower{i+1}'] = jb_data
+            expanded[key] = jb_data
         else:
-            expanded[f'joint_borrower{i+1}'] = {}
+            expanded[key] = {}
     
     # 担保人 (1-7)
     for i in range(7):
+        key = f'guarantor{i+1}'
+        if not want(key):
+            continue
         if data.guarantors and i < len(data.guarantors):
             g_data = data.guarantors[i].model_dump()  # 完整复制
             g_data['age'] = calculate_age(g_data.get('id_card', ''))
-            expanded[f'guarantor{i+1}'] = g_data
+            expanded[key] = g_data
         else:
-            expanded[f'guarantor{i+1}'] = {}
+            expanded[key] = {}
     
     # 抵押物 (1-5)
     for i in range(5):
+        key = f'collateral{i+1}'
+        if not want(key):
+            continue
         if data.collaterals and i < len(data.collaterals):
             c_data = data.collaterals[i].model_dump()  # 完整复制
             c_data['value_cn'] = num_to_cn(c_data.get('value', 0))
-            expanded[f'collateral{i+1}'] = c_data
+            expanded[key] = c_data
         else:
-            expanded[f'collateral{i+1}'] = {}
+            expanded[key] = {}
     
     return expanded
 
-def _create_aliases(data: ContractRequest) -> dict:
+def _create_aliases(data: ContractRequest, keys=None) -> dict:
     """创建常用别名和快捷键"""
     aliases = {}
     
@@ -758,303 +2131,1796 @@ def _create_aliases(data: ContractRequest) -> dict:
             'branch_short': data.branch.short_name
         })
     
+    if keys is not None:
+        aliases = {k: v for k, v in aliases.items() if k in keys}
     return aliases
 
-def build_complete_context(data: ContractRequest) -> dict:
+def build_complete_context(data: ContractRequest, keys=None) -> dict:
     """
     统一构建完整的context，确保数据完整性
     这是整个系统的核心数据准备函数
+    keys 为所选模板引用的顶层变量名集合时，只构建这些变量（见 template_context_keys）
     """
     # 1. 基础数据（从Pydantic模型导出）
-    context = data.model_dump()
+    if keys is None:
+        context = data.model_dump()
+    else:
+        fields = keys & ContractRequest.model_fields.keys()
+        context = data.model_dump(include=fields) if fields else {}
     
     # 2. 预计算所有派生字段
-    derived = _calculate_derived_fields(data)
+    derived = _calculate_derived_fields(data, keys)
     context.update(derived)
     
     # 3. 列表展开（带完整数据复制）
-    expanded = _expand_lists(data)
+    expanded = _expand_lists(data, keys)
     context.update(expanded)
     
     # 4. 别名和快捷键
-    aliases = _create_aliases(data)
+    aliases = _create_aliases(data, keys)
     context.update(aliases)
     
     # 5. 全面扁平化（支持 {{ spouse.name }} 等嵌套访问）
-    flat = flatten_context(context)
-    context.update(flat)
+    # 按需构建时不需要：docx 模板只能按顶层变量取值，Excel 占位符由 lookup_context 逐级查找
+    if keys is None:
+        flat = flatten_context(context)
+        context.update(flat)
     
     return context
 
-# ============= API Endpoints =============
+# 调查报告模板（/api/generate-investigation-report 使用，也可以在 /api/generate 中选择）
+INVESTIGATION_TEMPLATE = "investigation_report.docx"
 
-@app.post("/api/generate")
-async def generate_contract(data: ContractRequest):
-    # 详细记录请求数据，方便排查数据问题
-    logger.info(f"====== 收到生成请求 ======")
-    logger.info(f"类型: {data.customer_type} | 金额: {data.loan_amount}")
-    try:
-        # 记录完整的 JSON 数据（截断过长内容避免刷屏）
-        debug_json = data.model_dump_json()
-        if len(debug_json) > 1000:
-            logger.info(f"请求数据(前1000字符): {debug_json[:1000]}...")
-        else:
-            logger.info(f"完整请求数据: {debug_json}")
-    except:
-        pass
-    
-    # ✨✨✨ 使用统一的context构建函数 ✨✨✨
-    context = build_complete_context(data)
-    logger.debug(f"✅ Context构建完成，共 {len(context)} 个键")
-    logger.debug(f"关键字段检查 - spouse: {'存在' if context.get('spouse') else '缺失'}, guarantor1: {'存在' if context.get('guarantor1') else '缺失'}")
+def is_investigation_template(tmpl_name):
+    """调查报告模板额外使用 generate_investigation_context 生成的摘要变量"""
+    return str(tmpl_name).endswith(INVESTIGATION_TEMPLATE)
 
-    task_id = str(int(time.time() * 1000))
-    temp_dir = os.path.join(OUTPUT_DIR, task_id)
-    os.makedirs(temp_dir, exist_ok=True)
-    
-    # 🌟 统一文件名格式
-    date_str = datetime.now().strftime('%Y%m%d')
-    prefix = data.enterprise.name if data.customer_type == 'enterprise' else (data.main_borrower.name if data.main_borrower else "客户")
-    
-    generated_files = []
-    errors = []  # Initialize errors list here
+def template_context(tmpl_name, data: ContractRequest, context: dict):
+    """
+    模板实际使用的 context：调查报告在全局 context 上合并专用摘要变量，
+    模板里既可以使用专用变量 (main_summary)，也可以使用通用变量 (main_borrower.name, joint_borrower1.age)
+    """
+    if is_investigation_template(tmpl_name):
+        return {**context, **generate_investigation_context(data)}
+    return context
+
+def template_context_keys(template_names):
+    """
+    所选模板共同引用的顶层变量名；任一模板无法分析时返回 None（构建完整 context）
+    找不到的模板跳过，由 prepare_package 报错
+    """
+    keys = set()
+    for tmpl_name in template_names:
+        if not tmpl_name:
+            continue
+        tmpl_path = os.path.join(TEMPLATE_DIR, tmpl_name)
+        if not os.path.exists(tmpl_path):
+            continue
+        try:
+            keys |= template_cache.variables(tmpl_path)
+        except Exception as e:
+            logger.warning(f"⚠️ 模板[{tmpl_name}]变量分析失败，使用完整context: {e}")
+            return None
+    return keys
+
+# ============= 模板静态分析 =============
+
+# context 变量 -> 依赖的表单字段（ContractRequest 字段本身依赖自己）
+CONTEXT_DEPENDENCIES = {
+    'loan_amount_cn': ['loan_amount'],
+    'start_date_cn': ['start_date'],
+    'end_date_cn': ['end_date'],
+    'main_age': ['main_borrower'],
+    'spouse_age': ['spouse'],
+    'loan_type_cn': ['loan_type'],
+    'main_marital_status': ['spouse'],
+    'main_name': ['main_borrower'],
+    'main_card': ['main_borrower'],
+    'main_addr': ['main_borrower'],
+    'ent_name': ['enterprise'],
+    'ent_code': ['enterprise'],
+    'branch_name': ['branch'],
+    'branch_short_name': ['branch'],
+    'branch_short': ['branch'],
+    **{f'joint_borrower{i}': ['joint_borrowers'] for i in range(1, 4)},
+    **{f'guarantor{i}': ['guarantors'] for i in range(1, 8)},
+    **{f'collateral{i}': ['collaterals'] for i in range(1, 6)},
+}
+
+# 调查报告摘要变量依赖的表单字段
+INVESTIGATION_DEPENDENCIES = {
+    'main_borrower_summary': ['main_borrower', 'spouse'],
+    'main_summary': ['main_borrower', 'spouse'],
+    'joint_borrowers_summary': ['joint_borrowers'],
+    'joint_summary': ['joint_borrowers'],
+    'guarantors_summary': ['guarantors'],
+    'guarantor_summary': ['guarantors'],
+    'collaterals_summary': ['collaterals'],
+    'collateral_summary': ['collaterals'],
+}
 
+@functools.lru_cache(maxsize=None)
+def context_schema(investigation=False):
+    """
+    build_complete_context 能产生的全部变量结构
+    用一份所有字段都有值的样例数据构建（列表按展开上限填满），结果只用于检查变量名
+    """
+    person = Person(id_card="110101200001010000")
+    sample = ContractRequest(
+        branch=BranchInfo(), main_borrower=person, spouse=person, enterprise=Enterprise(),
+        joint_borrowers=[person] * 3, guarantors=[person] * 7, collaterals=[Collateral()] * 5,
+        loan_amount=1, start_date="2000-01-01", end_date="2000-01-01",
+    )
+    schema = build_complete_context(sample)
+    if investigation:
+        schema = {**schema, **generate_investigation_context(sample)}
+    return schema
+
+def is_known_path(schema, path):
+    """路径能否在 context 中取到值；取到非字典的值后，后面的部分视为对该值的属性/方法访问"""
+    value = schema
+    for part in path.split("."):
+        if isinstance(value, BaseModel):
+            value = value.model_dump()
+        if not isinstance(value, dict):
+            return True
+        if part not in value:
+            return False
+        value = value[part]
+    return True
+
+def analyze_template_file(name, path):
+    """分析单个模板，返回可直接输出给前端的结果"""
+    result = {
+        "name": name,
+        "type": os.path.splitext(name)[1].lstrip("."),
+        "ok": True,
+        "error": None,
+        "variables": [],
+        "unknown": [],
+        "fields": [],
+    }
     try:
-        # 1. 生成 .TXT (含数据)
-        report_name = f"{prefix}_数据存档_{date_str}.txt"
-        report_path = os.path.join(temp_dir, report_name)
-        with open(report_path, "w", encoding="utf-8") as f:
-            f.write(generate_smart_report(data))
-        generated_files.append(report_path)
-
-        # 2. 生成合同 (多线程加速)
-        def process_template(tmpl_name):
-            if not tmpl_name: return None
-            tmpl_path = os.path.join(TEMPLATE_DIR, tmpl_name)
-            
-            # check existence
-            if not os.path.exists(tmpl_path):
-                # 增强调试信息：列出目录下的文件，帮助定位文件名不匹配问题 (e.g. 隐藏后缀/编码差异)
-                try:
-                    existing_files = os.listdir(TEMPLATE_DIR)
-                    logger.error(f"❌ 文件未找到: {os.path.abspath(tmpl_path)}")
-                    logger.error(f"📂 模板目录 ({TEMPLATE_DIR}) 下的文件: {existing_files}")
-                except Exception as ex:
-                    logger.error(f"无法列出模板目录: {ex}")
-                return {"error": f"找不到模板文件: {tmpl_name} (路径: {os.path.abspath(tmpl_path)})"}
+        entry = template_cache.analyze(path)
+    except Exception as e:
+        result.update(ok=False, error=f"{type(e).__name__}: {e}")
+        return result
+    investigation = is_investigation_template(name)
+    schema = context_schema(investigation)
+    dependencies = {**CONTEXT_DEPENDENCIES, **(INVESTIGATION_DEPENDENCIES if investigation else {})}
+    fields = set()
+    for var in entry.variables:
+        if var in ContractRequest.model_fields:
+            fields.add(var)
+        fields.update(dependencies.get(var, []))
+    result["variables"] = sorted(entry.paths)
+    result["unknown"] = sorted(p for p in entry.paths if not is_known_path(schema, p))
+    result["fields"] = sorted(fields)
+    return result
+
+class TemplateCatalog:
+    """
+    模板目录的静态分析结果
+    启动时和模板文件变化后（按 mtime/大小轮询）分析 TEMPLATE_DIR 下的所有 docx/xlsx，
+    记录能否解析、引用了哪些变量、哪些变量 context 中没有，以及需要填写的表单字段
+    """
+
+    def __init__(self, poll_seconds):
+        self.poll_seconds = poll_seconds
+        self._results = {}        # 文件名 -> (文件签名, 分析结果)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        """重新分析有变化的模板，返回是否有变化"""
+        with self._lock:
+            try:
+                names = sorted(n for n in os.listdir(TEMPLATE_DIR) if n.endswith(('.docx', '.xlsx')))
+            except OSError:
+                names = []
+            results = {}
+            changed = set(self._results) != set(names)
+            for name in names:
+                path = os.path.join(TEMPLATE_DIR, name)
+                signature = _stat_signature(path)
+                cached = self._results.get(name)
+                if cached is not None and cached[0] == signature:
+                    results[name] = cached
+                    continue
+                result = analyze_template_file(name, path)
+                if not result["ok"]:
+                    logger.warning(f"⚠️ 模板[{name}]无法解析: {result['error']}")
+                elif result["unknown"]:
+                    logger.warning(f"⚠️ 模板[{name}]引用了不存在的变量: {result['unknown']}")
+                results[name] = (signature, result)
+                changed = True
+            self._results = results
+        if changed:
+            bad = sum(1 for _, r in results.values() if not r["ok"])
+            logger.info(f"模板分析完成: {len(results)} 个模板，{bad} 个无法解析")
+        return changed
 
-            base_name, ext = os.path.splitext(tmpl_name)
-            save_name = f"{prefix}_{base_name}_{date_str}{ext}"
-            save_path = os.path.join(temp_dir, save_name)
+    def get(self, name):
+        """单个模板的分析结果；尚未分析（或刚修改）时当场分析"""
+        path = os.path.join(TEMPLATE_DIR, name)
+        signature = _stat_signature(path)
+        if signature is None:
+            return None
+        cached = self._results.get(name)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        return analyze_template_file(name, path)
 
+    def all(self):
+        return [result for _, result in self._results.values()]
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_seconds):
             try:
-                # Special handling for investigation report
-                if tmpl_name == 'investigation_report.docx' or str(tmpl_name).endswith('investigation_report.docx'):
-                    # 1. 先生成专用 summary 上下文
-                    report_context = generate_investigation_context(data)
-                    # 2. ✨✨✨ 关键修复：合并全局 context！✨✨✨
-                    # 这样模板里既可以使用专用变量 (main_summary)，也可以使用通用变量 (main_borrower.name, joint_borrower1.age)
-                    full_report_ctx = context.copy()
-                    full_report_ctx.update(report_context)
-                    
-                    doc = DocxTemplate(tmpl_path)
-                    doc.render(full_report_ctx)
-                    doc.save(save_path)
-                elif tmpl_name.endswith('.docx'):
-                    doc = DocxTemplate(tmpl_path)
-                    doc.render(context)
-                    doc.save(save_path)
-                elif tmpl_name.endswith('.xlsx'):
-                    fill_excel_template(tmpl_path, save_path, context)
-                return {"path": save_path}
+                self.refresh()
             except Exception as e:
-                error_detail = f"模板[{tmpl_name}]处理失败: {str(e)}"
-                logger.error(f"❌ {error_detail}")
-                logger.error(traceback.format_exc())
-                return {"error": error_detail}
-
-        # 使用线程池并发处理
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            results = list(executor.map(process_template, data.selected_templates))
-        
-        # 收集成功的文件和错误
-        for res in results:
-            if not res: continue
-            if "path" in res:
-                generated_files.append(res["path"])
-            elif "error" in res:
-                errors.append(res["error"])
-        
-        # 如果有任何错误，抛出异常给前端显示
-        if errors:
-            raise Exception("\n".join(errors))
-            
-        if not generated_files:
-             raise Exception("未生成任何文件，请检查模版选择")
-
-        zip_name = f"{prefix}_业务文件包_{date_str}.zip"
-        zip_path = os.path.join(OUTPUT_DIR, zip_name)
-        with zipfile.ZipFile(zip_path, 'w') as zf:
-            for file in generated_files: zf.write(file, arcname=os.path.basename(file))
-        
-        return FileResponse(zip_path, filename=zip_name, media_type='application/zip')
+                logger.warning(f"模板分析失败: {e}")
+
+    def start(self):
+        # 首次分析由启动预热完成，这里只负责之后的轮询
+        if self._thread is None and self.poll_seconds > 0:
+            self._thread = threading.Thread(target=self._watch, name="template-watch", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+template_catalog = TemplateCatalog(CONFIG_POLL_SECONDS)
+
+def check_templates(template_names):
+    """生成前检查所选模板，返回问题列表（找不到或无法解析的模板）"""
+    problems = []
+    for tmpl_name in template_names:
+        if not tmpl_name:
+            continue
+        result = template_catalog.get(tmpl_name)
+        if result is None:
+            problems.append(f"找不到模板文件: {tmpl_name}")
+        elif not result["ok"]:
+            problems.append(f"模板[{tmpl_name}]无法解析: {result['error']}")
+    return problems
 
+async def preflight_templates(template_names):
+    """所选模板有问题时直接返回 400，不占用渲染资源"""
+    problems = await run_blocking(check_templates, template_names)
+    if problems:
+        logger.warning(f"❌ 模板检查未通过: {problems}")
+        raise HTTPException(status_code=400, detail="模板检查未通过:\n" + "\n".join(problems))
+
+@app.get("/api/templates/analysis")
+async def get_template_analysis():
+    """所有模板的分析结果：引用的变量、不存在的变量、需要的表单字段"""
+    return {
+        "templates": template_catalog.all(),
+        "context_keys": sorted(k for k in context_schema() if "." not in k),
+    }
+
+# ============= 渲染后端 =============
+
+# 渲染后端：process（多进程，默认）或 thread；进程数默认取 CPU 核数（最多 4）
+RENDER_BACKEND = os.environ.get("BANK_RENDER_BACKEND", "process")
+RENDER_WORKERS = int(os.environ.get("BANK_RENDER_WORKERS", "0") or 0) or min(4, os.cpu_count() or 1)
+
+def render_template_job(tmpl_name, tmpl_path, save_name, context):
+    """
+    渲染单个模板，返回文件内容；可在渲染进程中执行，异常以结果形式返回给主进程记录
+    渲染耗时随结果带回主进程，由 collect_render_results 计入指标
+    """
+    start = time.perf_counter()
+    try:
+        buf = io.BytesIO()
+        if tmpl_name.endswith('.docx'):
+            doc = template_cache.docx(tmpl_path)
+            doc.render(context)
+            doc.save(buf)
+        elif tmpl_name.endswith('.xlsx'):
+            fill_excel_template(tmpl_path, buf, context)
+        return {"name": save_name, "content": buf.getvalue(), "template": tmpl_name, "seconds": time.perf_counter() - start}
     except Exception as e:
-        logger.error("="*60)
-        logger.error("❌ 生成文件时发生错误")
-        logger.error(f"错误类型: {type(e).__name__}")
-        logger.error(f"错误信息: {str(e)}")
-        logger.error(f"选择的模板: {data.selected_templates if hasattr(data, 'selected_templates') else '未知'}")
-        logger.error("详细堆栈:")
-        logger.error(traceback.format_exc())
-        logger.error("="*60)
-        
-        if hasattr(e, 'status_code') and e.status_code == 422:
-            raise HTTPException(status_code=422, detail=f"数据验证失败: {e.detail}")
-        
-        # 返回更详细的错误信息
-        error_msg = f"{type(e).__name__}: {str(e)}"
-        raise HTTPException(status_code=500, detail=error_msg)
-    finally:
-        if os.path.exists(temp_dir): shutil.rmtree(temp_dir)
+        return {"error": f"模板[{tmpl_name}]处理失败: {str(e)}", "traceback": traceback.format_exc(),
+                "template": tmpl_name, "seconds": time.perf_counter() - start}
 
-@app.post("/api/generate-investigation-report")
-async def generate_investigation_report(data: dict):
-    """生成客户调查报告（简洁版）- 接受部分数据"""
+def _render_worker_ping():
+    return os.getpid()
+
+def _render_worker_init(template_dir):
+    """渲染进程启动时预加载模板目录下的所有模板"""
     try:
-        # Extract main data with safe defaults
-        loan_use = data.get('loan_use', '未填写')
-        loan_amount = data.get('loan_amount', 0)
-        loan_term = data.get('loan_term', 0)
-        
-        main_borrower = data.get('main_borrower')
-        spouse = data.get('spouse')
-        joint_borrowers = data.get('joint_borrowers', [])
-        guarantors = data.get('guarantors', [])
-        collaterals = data.get('collaterals', [])
-        
-        # Build main borrower summary
-        if main_borrower and main_borrower.get('name'):
-            mb = main_borrower
-            age = calculate_age(mb.get('id_card', '')) if mb.get('id_card') else '未知'
-            main_summary = f"{mb.get('name', '未知')}，{mb.get('gender', '未知')}，{age}岁，"
-            main_summary += f"身份证号：{mb.get('id_card', '未填写')}，"
-            main_summary += f"联系电话：{mb.get('mobile', '未填写')}，"
-            main_summary += f"职业：{mb.get('occupation', '未填写')}，"
-            main_summary += f"学历：{mb.get('education', '未填写')}，"
-            main_summary += f"现住址：{mb.get('address', '未填写')}。"
-            
-            if spouse and spouse.get('name'):
-                sp = spouse
-                sp_age = calculate_age(sp.get('id_card', '')) if sp.get('id_card') else '未知'
-                main_summary += f" 配偶{sp.get('name', '未知')}，{sp.get('gender', '未知')}，{sp_age}岁，"
-                main_summary += f"身份证号：{sp.get('id_card', '未填写')}，"
-                main_summary += f"联系电话：{sp.get('mobile', '未填写')}。"
+        names = os.listdir(template_dir)
+    except OSError:
+        return
+    for name in names:
+        if name.endswith(('.docx', '.xlsx')):
+            try:
+                template_cache.get(os.path.join(template_dir, name))
+            except Exception:
+                # 损坏的模板留到实际使用时再报错
+                pass
+
+class JobCancelled(Exception):
+    """生成任务被用户取消"""
+
+class RenderBackend:
+    """
+    跨请求共享的渲染执行器
+    docxtpl/openpyxl 渲染是纯 Python 的 CPU 计算，多进程才能利用多核
+    """
+
+    def __init__(self, mode, workers):
+        self.mode = mode
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    if self.mode == "process":
+                        os.environ[RENDER_WORKER_ENV] = "1"
+                        self._executor = ProcessPoolExecutor(
+                            max_workers=self.workers,
+                            mp_context=multiprocessing.get_context("spawn"),
+                            initializer=_render_worker_init,
+                            initargs=(TEMPLATE_DIR,),
+                        )
+                    else:
+                        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+                    logger.info(f"渲染后端已启动: {self.mode} x {self.workers}")
+        return self._executor
+
+    def warm(self):
+        """提前启动全部渲染进程（进程启动时会预加载模板），首个生成请求不必等待进程启动"""
+        if self.mode != "process":
+            return
+        wait(self.submit_all(_render_worker_ping, [()] * self.workers))
+
+    def submit_all(self, fn, jobs):
+        """提交 fn(*job)，返回 Future 列表"""
+        executor = self._get_executor()
+        return [executor.submit(fn, *job) for job in jobs]
+
+    def map(self, fn, jobs, on_result=None, cancel_event=None):
+        """
+        并发执行 fn(*job)，按提交顺序返回结果
+        on_result(结果) 在每个任务完成时调用；cancel_event 被设置后取消剩余任务并抛出 JobCancelled
+        """
+        if not jobs:
+            return []
+        futures = self.submit_all(fn, jobs)
+        try:
+            for future in as_completed(futures):
+                if cancel_event is not None and cancel_event.is_set():
+                    for f in futures: f.cancel()
+                    raise JobCancelled()
+                if on_result is not None:
+                    on_result(future.result())
+            return [f.result() for f in futures]
+        except BrokenProcessPool:
+            # 渲染进程异常退出，丢弃进程池，下次请求重新创建
+            logger.error("❌ 渲染进程池已损坏，将重新创建")
+            self.shutdown(wait=False)
+            raise
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+render_backend = RenderBackend(RENDER_BACKEND, RENDER_WORKERS)
+
+# ============= 渲染结果缓存 =============
+
+# 渲染结果缓存目录与容量（MB），容量为 0 时关闭
+RENDER_CACHE_DIR = os.environ.get("BANK_RENDER_CACHE_DIR", os.path.join(CWD, "render_cache"))
+RENDER_CACHE_MB = int(os.environ.get("BANK_RENDER_CACHE_MB", "256"))
+# 渲染结果的代码版本：context 构建、金额大写、模板渲染、数据存档等会改变生成结果的代码修改后递增，
+# 磁盘上旧版本的缓存随之失效（按容量自然淘汰）
+RENDER_CACHE_VERSION = 1
+
+def request_fingerprint(data: ContractRequest, date_str: str):
+    """
+    规范化后的请求内容哈希（不含模板选择）
+    生成日期参与计算：文件名、年龄和报告日期都与当天有关
+    """
+    payload = data.model_dump(mode="json", exclude={"selected_templates"})
+    raw = json.dumps([payload, date_str], ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def template_versions(template_names):
+    """[(模板名, 内容sha256)]，模板修改后哈希随之变化；有模板找不到或无法读取时返回 None"""
+    versions = []
+    for tmpl_name in template_names:
+        if not tmpl_name: continue
+        try:
+            versions.append((tmpl_name, template_cache.get(os.path.join(TEMPLATE_DIR, tmpl_name)).sha256))
+        except Exception:
+            return None
+    return versions
+
+def cache_key(*parts):
+    raw = json.dumps(parts, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class RenderCache:
+    """
+    按内容寻址的渲染结果磁盘缓存（单个文档和整个 ZIP 包）
+    键由请求内容和模板内容哈希得出，模板修改后自然失效；总大小超过上限时按最近使用时间淘汰
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._index = None        # 键 -> 文件大小，按最近使用排序
+        self._total = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _load_index(self):
+        # 启动后首次使用时扫描缓存目录，按 mtime 恢复使用顺序
+        if self._index is not None:
+            return
+        files = []
+        if os.path.isdir(self.directory):
+            for sub in os.listdir(self.directory):
+                sub_dir = os.path.join(self.directory, sub)
+                if not os.path.isdir(sub_dir): continue
+                for name in os.listdir(sub_dir):
+                    if name.endswith(".tmp"): continue
+                    try:
+                        st = os.stat(os.path.join(sub_dir, name))
+                    except OSError:
+                        continue
+                    files.append((st.st_mtime, name, st.st_size))
+        files.sort()
+        self._index = OrderedDict((name, size) for _, name, size in files)
+        self._total = sum(self._index.values())
+        self._evict()
+
+    def _evict(self):
+        while self._total > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._total -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self._lock:
+            self._load_index()
+            if key not in self._index:
+                RENDER_CACHE_LOOKUPS.inc(1, "miss")
+                return None
+            self._index.move_to_end(key)
+        RENDER_CACHE_LOOKUPS.inc(1, "hit")
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                size = self._index.pop(key, None)
+                if size is not None:
+                    self._total -= size
+            return None
+        return content
+
+    def put(self, key, content):
+        if not self.enabled or len(content) > self.max_bytes:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(content)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning(f"渲染缓存写入失败: {e}")
+            return
+        with self._lock:
+            self._load_index()
+            self._total -= self._index.pop(key, 0)
+            self._index[key] = len(content)
+            self._total += len(content)
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._index = OrderedDict()
+            self._total = 0
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+render_cache = RenderCache(RENDER_CACHE_DIR, RENDER_CACHE_MB * 1024 * 1024)
+register_metric(Gauge("bank_render_cache_bytes", "渲染缓存占用字节数", lambda: render_cache._total))
+
+def render_with_cache(jobs, fingerprint, versions, progress=None, cancel_event=None):
+    """
+    与 render_backend.map 相同，按任务顺序返回渲染结果；已缓存的文档不再渲染，新渲染成功的文档写入缓存
+    fingerprint 为 None 时不使用缓存
+    """
+    results = [None] * len(jobs)
+    pending = []    # [(任务序号, 缓存键)]
+    sha = dict(versions or [])
+    for i, (tmpl_name, _, save_name, _) in enumerate(jobs):
+        key = cache_key("doc", RENDER_CACHE_VERSION, fingerprint, tmpl_name, sha.get(tmpl_name)) if fingerprint else None
+        content = render_cache.get(key) if key else None
+        if content is not None:
+            results[i] = {"name": save_name, "content": content}
         else:
-            main_summary = "未填写"
-        
-        # Build joint borrowers summary
-        if joint_borrowers:
-            jb_items = []
-            for i, jb in enumerate(joint_borrowers, 1):
-                if not jb.get('name'):
+            pending.append((i, key))
+    if progress is not None:
+        for res in results:
+            if res is not None: progress.advance(res)
+    rendered = render_backend.map(render_template_job, [jobs[i] for i, _ in pending],
+                                  progress and progress.advance, cancel_event)
+    for (i, key), res in zip(pending, rendered):
+        results[i] = res
+        if key and res and "content" in res:
+            render_cache.put(key, res["content"])
+    return results
+
+# ============= 历史存档检索 =============
+# 扫描目录树中的数据存档（*_数据存档_*.txt，以及文件包 zip 中的同名文件），解析 SYSTEM_DATA 后
+# 写入本地 SQLite，姓名、证件号、地址、权证号建 FTS5 全文索引；重扫时按 (mtime, 大小) 只处理有变化的文件。
+# 本机生成的文件包在生成时直接入库（见 index_package_archives），不依赖是否另存到 output 目录
+
+# 扫描的目录（多个用系统路径分隔符分开），默认为文件包另存目录
+ARCHIVE_DIRS = [d for d in os.environ.get("BANK_ARCHIVE_DIRS", OUTPUT_DIR).split(os.pathsep) if d]
+ARCHIVE_INDEX_FILE = os.environ.get("BANK_ARCHIVE_INDEX", os.path.join(CWD, "archive_index.db"))
+# 自动重扫间隔（秒），0 为只在启动时和手动触发时扫描
+ARCHIVE_POLL_SECONDS = float(os.environ.get("BANK_ARCHIVE_POLL", "300"))
+ARCHIVE_NAME_MARK = "_数据存档_"
+# 未另存到磁盘的文件包在索引中的路径前缀（不在任何扫描目录下，重扫时不会被当作已删除的文件）
+GENERATED_ARCHIVE_PREFIX = "generated:"
+ARCHIVE_SEARCH_FIELDS = ("names", "id_cards", "addresses", "cert_nos")
+# 同一字段多个值之间的分隔符：私用区字符会被 FTS5 当作一个词，查询中去掉它，短语就不会跨值匹配
+_FTS_SEPARATOR = "\ue000"
+# 证件号整体作为一个词，另存一份倒序（加此前缀），前缀/后缀检索都走词典，不必逐字匹配
+_FTS_REVERSED = "\ue001"
+# 至少这么长的纯字母数字检索词视为证件号，只查证件号
+ARCHIVE_ID_MIN_CHARS = 6
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archive_files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS archives (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    member TEXT NOT NULL,
+    archived_on TEXT NOT NULL,
+    customer_type TEXT,
+    name TEXT,
+    id_card TEXT,
+    loan_amount REAL,
+    branch TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS archives_path ON archives (path);
+CREATE INDEX IF NOT EXISTS archives_date ON archives (archived_on, id);
+CREATE VIRTUAL TABLE IF NOT EXISTS archive_fts USING fts5(names, id_cards, addresses, cert_nos, tokenize='unicode61');
+"""
+
+def is_archive_name(name):
+    base = name.replace("\\", "/").rsplit("/", 1)[-1]
+    return ARCHIVE_NAME_MARK in base and base.lower().endswith(".txt")
+
+def zip_archive_texts(source):
+    """zip（路径或文件对象）中的数据存档：[(zip 内文件名, 文本)]"""
+    texts = []
+    with zipfile.ZipFile(source) as zf:
+        for member in zf.namelist():
+            if is_archive_name(member):
+                texts.append((member, zf.read(member).decode("utf-8-sig", errors="replace")))
+    return texts
+
+def read_archive_texts(path):
+    """文件中的数据存档：[(zip 内文件名，txt 本身为空串, 文本)]"""
+    if path.lower().endswith(".zip"):
+        return zip_archive_texts(path)
+    with open(path, "rb") as f:
+        return [("", f.read().decode("utf-8-sig", errors="replace"))]
+
+def archive_search_values(data: dict):
+    """数据存档中参与检索的值：{字段: [值...]}"""
+    people = [data.get("main_borrower"), data.get("spouse"), *(data.get("joint_borrowers") or []), *(data.get("guarantors") or [])]
+    people = [p for p in people if isinstance(p, dict)]
+    enterprise = data.get("enterprise") or {}
+    collaterals = [c for c in data.get("collaterals") or [] if isinstance(c, dict)]
+    return {
+        "names": [p.get("name") for p in people] + [p.get("legal_rep") for p in people]
+                 + [enterprise.get("name"), enterprise.get("legal_rep")] + [c.get("owner") for c in collaterals],
+        "id_cards": [p.get("id_card") for p in people] + [enterprise.get("credit_code")],
+        "addresses": [p.get("address") for p in people] + [enterprise.get("address")] + [c.get("location") for c in collaterals],
+        "cert_nos": [c.get("cert_no") for c in collaterals],
+    }
+
+def _fts_chars(text):
+    """逐字切分：中文没有空格分词，按单字建索引，查询时用短语匹配即为子串匹配"""
+    return " ".join(ch for ch in str(text) if not ch.isspace() and ch not in ('"', _FTS_SEPARATOR))
+
+def _fts_document(values):
+    seen = []
+    for value in values:
+        if value and str(value).strip() and value not in seen:
+            seen.append(value)
+    return f" {_FTS_SEPARATOR} ".join(_fts_chars(v) for v in seen)
+
+def _id_token(value):
+    return re.sub(r"[^0-9a-z]", "", str(value).lower())
+
+def _fts_id_document(values):
+    tokens = []
+    for value in values:
+        token = _id_token(value or "")
+        if token and token not in tokens:
+            tokens.append(token)
+    return " ".join(tokens + [_FTS_REVERSED + t[::-1] for t in tokens])
+
+def _archive_term_query(term, field):
+    chars = _fts_chars(term)
+    if not chars:
+        return None
+    token = _id_token(term)
+    id_like = token and token == term.lower()
+    if (field and field != "id_cards") or not id_like:
+        # 证件号列只有整词，非证件号检索词在其他列逐字匹配
+        return f'{field or "{names addresses cert_nos}"} : "{chars}"'
+    id_expr = f'id_cards : ("{token}" * OR "{_FTS_REVERSED}{token[::-1]}" *)'
+    if field or len(token) >= ARCHIVE_ID_MIN_CHARS:
+        return id_expr
+    return f'({id_expr} OR {{names addresses cert_nos}} : "{chars}")'
+
+def archive_match_query(q, field=""):
+    """
+    检索词（空格分隔，全部命中）转为 FTS5 查询；可限定字段
+    姓名、地址、权证号按任意片段匹配；证件号按开头或结尾匹配
+    """
+    parts = [p for p in (_archive_term_query(term, field) for term in q.split()) if p]
+    return " AND ".join(parts) if parts else None
+
+def _archive_date(name, mtime):
+    m = re.search(ARCHIVE_NAME_MARK + r"(\d{4})(\d{2})(\d{2})", name)
+    if m:
+        return f"{m[1]}-{m[2]}-{m[3]}"
+    return datetime.fromtimestamp(mtime).strftime("%Y-%m-%d")
+
+class ArchiveIndex:
+    """历史数据存档索引（SQLite）"""
+
+    def __init__(self, db_path, poll_seconds=0):
+        self.db_path = db_path
+        self.poll_seconds = poll_seconds
+        self.last_scan = None     # 最近一次扫描的统计
+        self._scan_lock = threading.Lock()
+        self._schema_ready = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        if not self._schema_ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(ARCHIVE_SCHEMA)
+            self._schema_ready = True
+        return conn
+
+    def scan(self, roots=None):
+        """扫描目录树，增量更新索引，返回统计"""
+        stats = {"files": 0, "changed": 0, "archives": 0, "removed": 0, "errors": 0}
+        start = time.perf_counter()
+        with self._scan_lock, contextlib.closing(self._connect()) as conn:
+            for root in roots or ARCHIVE_DIRS:
+                root = os.path.abspath(root)
+                if os.path.isdir(root):
+                    self._scan_root(conn, root, stats)
+            conn.commit()
+        stats["seconds"] = round(time.perf_counter() - start, 3)
+        self.last_scan = {**stats, "finished_at": datetime.now().isoformat(timespec="seconds")}
+        if stats["changed"] or stats["removed"]:
+            logger.info(f"存档索引已更新: {stats}")
+        return stats
+
+    def _scan_root(self, conn, root, stats):
+        # root 下已入库的文件：按路径范围取，避免 LIKE 转义
+        prefix = root.rstrip(os.sep) + os.sep
+        known = {row["path"]: (row["mtime_ns"], row["size"]) for row in conn.execute(
+            "SELECT path, mtime_ns, size FROM archive_files WHERE path >= ? AND path < ?",
+            (prefix, prefix[:-1] + chr(ord(os.sep) + 1)))}
+        seen = set()
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                if not (is_archive_name(filename) or filename.lower().endswith(".zip")):
                     continue
-                jb_age = calculate_age(jb.get('id_card', '')) if jb.get('id_card') else '未知'
-                jb_text = f"{i}. {jb.get('name', '未知')}，{jb.get('gender', '未知')}，{jb_age}岁，"
-                jb_text += f"身份证号：{jb.get('id_card', '未填写')}，"
-                jb_text += f"联系电话：{jb.get('mobile', '未填写')}，"
-                jb_text += f"职业：{jb.get('occupation', '未填写')}，"
-                jb_text += f"与借款人关系：{jb.get('relation', '未填写')}，"
-                jb_text += f"住址：{jb.get('address', '未填写')}。"
-                jb_items.append(jb_text)
-            joint_summary = "\\n".join(jb_items) if jb_items else "无"
-        else:
-            joint_summary = "无"
-        
-        # Build guarantors summary
-        if guarantors:
-            g_items = []
-            for i, g in enumerate(guarantors, 1):
-                if not g.get('name'):
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
                     continue
-                g_age = calculate_age(g.get('id_card', '')) if g.get('id_card') else '未知'
-                g_text = f"{i}. {g.get('name', '未知')}，{g.get('gender', '未知')}，{g_age}岁，"
-                g_text += f"身份证号：{g.get('id_card', '未填写')}，"
-                g_text += f"联系电话：{g.get('mobile', '未填写')}，"
-                g_text += f"职业：{g.get('occupation', '未填写')}，"
-                g_text += f"与借款人关系：{g.get('relation', '未填写')}，"
-                g_text += f"住址：{g.get('address', '未填写')}。"
-                g_items.append(g_text)
-            guarantors_summary = "\\n".join(g_items) if g_items else "无"
-        else:
-            guarantors_summary = "无"
-        
-        # Build collaterals summary
-        if collaterals:
-            c_items = []
-            for i, c in enumerate(collaterals, 1):
-                if not c.get('type'):
+                seen.add(path)
+                stats["files"] += 1
+                if known.get(path) == (st.st_mtime_ns, st.st_size):
                     continue
-                c_text = f"{i}. {c.get('type', '未知')}，坐落于{c.get('location', '未填写')}，"
-                c_text += f"权证号：{c.get('cert_no', '未填写')}，"
-                c_text += f"建筑面积：{c.get('area', '未填写')}，"
-                if c.get('land_area'):
-                    c_text += f"土地面积：{c.get('land_area')}，"
-                c_value = c.get('value', 0)
-                c_text += f"评估价值：{c_value}元（{num_to_cn(c_value) if c_value else '未填写'}）。"
-                c_items.append(c_text)
-            collaterals_summary = "\\n".join(c_items) if c_items else "无"
-        else:
-            collaterals_summary = "无"
-        
-        # Prepare context
-        context = {
-            "loan_use": loan_use,
-            "loan_amount": loan_amount,
-            "loan_amount_cn": num_to_cn(loan_amount) if loan_amount else "零元整",
-            "loan_term": loan_term,
-            "main_borrower_summary": main_summary,
-            "joint_borrowers_summary": joint_summary,
-            "guarantors_summary": guarantors_summary,
-            "collaterals_summary": collaterals_summary,
-        }
-        
-        # Load template
-        template_path = os.path.join(TEMPLATE_DIR, "investigation_report.docx")
-        if not os.path.exists(template_path):
-            raise HTTPException(status_code=404, detail="报告模板不存在")
-        
-        doc = DocxTemplate(template_path)
-        doc.render(context)
-        
-        # Save to temp file
-        borrower_name = main_borrower.get('name') if main_borrower else str(loan_amount)
-        filename = f"调查报告_{borrower_name}_{datetime.now().strftime('%Y%m%d%H%M%S')}.docx"
-        temp_file = os.path.join(TEMP_DIR, filename)
-        os.makedirs(TEMP_DIR, exist_ok=True)
-        doc.save(temp_file)
+                self._index_file(conn, path, st, stats)
+                stats["changed"] += 1
+                # 大量新文件时分批提交，期间的检索可以看到已入库的部分
+                if stats["changed"] % 200 == 0:
+                    conn.commit()
+        for path in set(known) - seen:
+            self._remove_file(conn, path)
+            stats["removed"] += 1
+
+    def _remove_file(self, conn, path):
+        conn.execute("DELETE FROM archive_fts WHERE rowid IN (SELECT id FROM archives WHERE path = ?)", (path,))
+        conn.execute("DELETE FROM archives WHERE path = ?", (path,))
+        conn.execute("DELETE FROM archive_files WHERE path = ?", (path,))
+
+    def _index_file(self, conn, path, st, stats):
+        try:
+            texts = read_archive_texts(path)
+            errors = []
+        except Exception as e:
+            # 单个文件读取失败只记入 archive_files.error，不影响其余文件的索引
+            texts = []
+            errors = [f"{type(e).__name__}: {e}"]
+        self._index_texts(conn, path, texts, st.st_mtime_ns, st.st_size, stats, errors)
+
+    def _index_texts(self, conn, path, texts, mtime_ns, size, stats, errors=()):
+        """用 texts（[(zip 内文件名, 文本)]）替换 path 在索引中的全部存档"""
+        self._remove_file(conn, path)
+        errors = list(errors)
+        for member, text in texts:
+            try:
+                decoded = extract_system_data(text)
+                if decoded is not None and isinstance(decoded[2], dict):
+                    self._insert(conn, path, member, decoded[2], mtime_ns / 1e9)
+                    stats["archives"] += 1
+            except SystemDataError as e:
+                errors.append(f"{member or os.path.basename(path)}: {e}")
+            except Exception as e:
+                errors.append(f"{member or os.path.basename(path)}: {type(e).__name__}: {e}")
+        if errors:
+            stats["errors"] += len(errors)
+            logger.warning(f"⚠️ 存档无法解析: {path}: {errors}")
+        conn.execute("INSERT INTO archive_files (path, mtime_ns, size, error) VALUES (?, ?, ?, ?)",
+                     (path, mtime_ns, size, "; ".join(errors) or None))
+
+    def covers(self, path):
+        """path 是否在扫描目录下（重扫时会检查它是否仍然存在）"""
+        path = os.path.abspath(path)
+        return any(path.startswith(os.path.abspath(root).rstrip(os.sep) + os.sep) for root in ARCHIVE_DIRS)
+
+    def add_file(self, path):
+        """立即索引刚写出的文件包；之后重扫时 (mtime, 大小) 未变，不会重复处理"""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stats = {"archives": 0, "errors": 0}
+        with self._scan_lock, contextlib.closing(self._connect()) as conn:
+            self._index_file(conn, path, st, stats)
+            conn.commit()
+        return stats
+
+    def add_generated(self, name, texts):
+        """索引没有另存到磁盘的文件包中的存档；同名文件包（同一客户同一天）再次生成时替换"""
+        stats = {"archives": 0, "errors": 0}
+        with self._scan_lock, contextlib.closing(self._connect()) as conn:
+            self._index_texts(conn, GENERATED_ARCHIVE_PREFIX + name, texts, time.time_ns(), 0, stats)
+            conn.commit()
+        return stats
+
+    def _insert(self, conn, path, member, data, mtime):
+        enterprise = data.get("enterprise") or {}
+        main_borrower = data.get("main_borrower") or {}
+        is_enterprise = data.get("customer_type") == "enterprise"
+        # 先算好检索字段再写入，数据结构不对时抛出异常不会留下只写了一半的记录
+        values = archive_search_values(data)
+        fts_row = (_fts_document(values["names"]), _fts_id_document(values["id_cards"]),
+                   _fts_document(values["addresses"]), _fts_document(values["cert_nos"]))
+        cursor = conn.execute(
+            "INSERT INTO archives (path, member, archived_on, customer_type, name, id_card, loan_amount, branch, data) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, member, _archive_date(member or path, mtime), data.get("customer_type"),
+             enterprise.get("name") if is_enterprise else main_borrower.get("name"),
+             enterprise.get("credit_code") if is_enterprise else main_borrower.get("id_card"),
+             data.get("loan_amount"), (data.get("branch") or {}).get("short_name"),
+             json.dumps(data, ensure_ascii=False, separators=(",", ":"))))
+        conn.execute("INSERT INTO archive_fts (rowid, names, id_cards, addresses, cert_nos) VALUES (?, ?, ?, ?, ?)",
+                     (cursor.lastrowid, *fts_row))
+
+    def search(self, q="", field="", page=1, page_size=20):
+        """按姓名/证件号/地址/权证号的任意片段检索，最近的存档在前"""
+        columns = "a.id, a.path, a.member, a.archived_on, a.customer_type, a.name, a.id_card, a.loan_amount, a.branch"
+        match = archive_match_query(q, field)
+        with contextlib.closing(self._connect()) as conn:
+            if match is None:
+                total = conn.execute("SELECT count(*) FROM archives").fetchone()[0]
+                rows = conn.execute(f"SELECT {columns} FROM archives a ORDER BY a.archived_on DESC, a.id DESC LIMIT ? OFFSET ?",
+                                    (page_size, (page - 1) * page_size)).fetchall()
+            else:
+                total = conn.execute("SELECT count(*) FROM archive_fts WHERE archive_fts MATCH ?", (match,)).fetchone()[0]
+                rows = conn.execute(f"SELECT {columns} FROM archive_fts JOIN archives a ON a.id = archive_fts.rowid "
+                                    "WHERE archive_fts MATCH ? ORDER BY a.archived_on DESC, a.id DESC LIMIT ? OFFSET ?",
+                                    (match, page_size, (page - 1) * page_size)).fetchall()
+        return {"total": total, "page": page, "page_size": page_size, "items": [dict(row) for row in rows]}
+
+    def get(self, archive_id):
+        with contextlib.closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM archives WHERE id = ?", (archive_id,)).fetchone()
+        if row is None:
+            return None
+        item = dict(row)
+        item["data"] = json.loads(item["data"])
+        return item
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_seconds):
+            try:
+                self.scan()
+            except Exception as e:
+                logger.warning(f"存档索引更新失败: {e}")
+
+    def start(self):
+        """首次扫描，之后按间隔在后台重扫"""
+        self.scan()
+        if self._thread is None and self.poll_seconds > 0:
+            self._thread = threading.Thread(target=self._watch, name="archive-watch", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+archive_index = ArchiveIndex(ARCHIVE_INDEX_FILE, ARCHIVE_POLL_SECONDS)
+
+def index_package_archives(zip_name, saved_path, texts):
+    """
+    生成的文件包立即加入存档索引：已另存到扫描目录下时索引该文件，否则按文件包名索引其中的数据存档
+    texts() 返回文件包中的 [(文件名, 文本)]；索引失败只记日志，不影响文件返回
+    """
+    try:
+        with timed("archive_index"):
+            if saved_path and archive_index.covers(saved_path):
+                archive_index.add_file(saved_path)
+            else:
+                archive_index.add_generated(zip_name, texts())
+    except Exception as e:
+        logger.warning(f"⚠️ 文件包未能加入存档索引: {zip_name}: {type(e).__name__}: {e}")
+
+@app.get("/api/archives/search")
+async def search_archives(q: str = "", field: str = "", page: int = 1, page_size: int = 20):
+    """检索历史数据存档；q 为空格分隔的检索词（姓名、证件号、地址、权证号的任意片段），field 可限定字段"""
+    if field and field not in ARCHIVE_SEARCH_FIELDS:
+        raise HTTPException(status_code=400, detail=f"field 只能是: {', '.join(ARCHIVE_SEARCH_FIELDS)}")
+    page = max(page, 1)
+    page_size = min(max(page_size, 1), 200)
+    return await run_blocking(archive_index.search, q, field, page, page_size)
+
+@app.post("/api/archives/rescan")
+async def rescan_archives():
+    """立即增量重扫存档目录"""
+    return await run_blocking(archive_index.scan)
+
+@app.get("/api/archives/{archive_id}")
+async def get_archive(archive_id: int):
+    """单个存档的完整数据（可直接用于回填表单）"""
+    item = await run_blocking(archive_index.get, archive_id)
+    if item is None:
+        raise HTTPException(status_code=404, detail="存档不存在")
+    return item
+
+# ============= 启动预热 =============
+# 服务启动后立即开始响应（前端页面、只读接口）；渲染库导入、配置、模板分析、到期清单和渲染进程
+# 在后台依次准备好。预热完成前到达的请求按需自行加载，各缓存自带锁，不会重复加载
+
+def _import_render_libraries():
+    import openpyxl, docx, jinja2  # noqa: F401
+    compiled_template_class()
+
+def _warm_templates():
+    template_catalog.refresh()
+    template_catalog.start()
+
+class Warmup:
+    """按顺序执行预热步骤，记录每步的状态和耗时；某一步失败不影响后续步骤"""
+
+    def __init__(self, steps):
+        self.steps = steps
+        self.status = {name: {"status": "pending"} for name, _ in steps}
+        self.finished_at = None
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self.finished_at is not None
+
+    def _run(self):
+        start = time.perf_counter()
+        for name, fn in self.steps:
+            state = self.status[name]
+            state["status"] = "running"
+            step_start = time.perf_counter()
+            try:
+                fn()
+                state["status"] = "done"
+            except Exception as e:
+                state["status"] = "failed"
+                state["error"] = f"{type(e).__name__}: {e}"
+                logger.warning(f"⚠️ 预热步骤[{name}]失败: {e}", exc_info=e)
+            state["seconds"] = round(time.perf_counter() - step_start, 3)
+        self.finished_at = time.time()
+        summary = ", ".join(f"{name} {self.status[name]['seconds']}s" for name, _ in self.steps)
+        logger.info(f"启动预热完成，用时 {time.perf_counter() - start:.2f}s ({summary})")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="warmup", daemon=True)
+            self._thread.start()
+
+    def wait(self, timeout=None):
+        """等待预热结束，返回是否已完成"""
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.ready
+
+    def to_dict(self):
+        return {"ready": self.ready, "steps": {name: dict(state) for name, state in self.status.items()}}
+
+warmup = Warmup([
+    ("config", config_registry.start),
+    ("imports", _import_render_libraries),
+    ("templates", _warm_templates),
+    ("customers", get_customer_index),
+    ("archives", archive_index.start),
+    ("render_pool", render_backend.warm),
+])
+
+register_metric(Gauge("bank_ready", "启动预热是否已完成", lambda: int(warmup.ready)))
+
+@app.get("/api/ready")
+async def get_readiness():
+    """启动预热进度；全部步骤结束前返回 503"""
+    return JSONResponse(warmup.to_dict(), status_code=200 if warmup.ready else 503)
+
+# ============= API Endpoints =============
+
+def package_prefix(data: ContractRequest):
+    """统一文件名前缀：企业名或主借款人姓名"""
+    return data.enterprise.name if data.customer_type == 'enterprise' else (data.main_borrower.name if data.main_borrower else "客户")
+
+def prepare_package(data: ContractRequest, context: dict, prefix: str, date_str: str):
+    """
+    准备单个客户的业务文件包：生成数据存档 txt，并为所选模板生成渲染任务
+    返回 (已生成文件 [(文件名, 内容)], 渲染任务, 错误)
+    """
+    entries = []
+    errors = []
+
+    # 1. 生成 .TXT (含数据)，换行符与原先按文本模式写文件时一致
+    report_name = f"{prefix}_数据存档_{date_str}.txt"
+    report_text = generate_smart_report(data).replace("\n", os.linesep)
+    entries.append((report_name, report_text.encode("utf-8")))
+
+    # 2. 生成合同 (渲染进程池并发处理)
+    jobs = []
+    for tmpl_name in data.selected_templates:
+        if not tmpl_name: continue
+        tmpl_path = os.path.join(TEMPLATE_DIR, tmpl_name)
         
-        logger.info(f"生成调查报告: {filename}")
+        # check existence
+        if not os.path.exists(tmpl_path):
+            # 增强调试信息：列出目录下的文件，帮助定位文件名不匹配问题 (e.g. 隐藏后缀/编码差异)
+            try:
+                existing_files = os.listdir(TEMPLATE_DIR)
+                logger.error(f"❌ 文件未找到: {os.path.abspath(tmpl_path)}")
+                logger.error(f"📂 模板目录 ({TEMPLATE_DIR}) 下的文件: {existing_files}")
+            except Exception as ex:
+                logger.error(f"无法列出模板目录: {ex}")
+            errors.append(f"找不到模板文件: {tmpl_name} (路径: {os.path.abspath(tmpl_path)})")
+            continue
+
+        base_name, ext = os.path.splitext(tmpl_name)
+        save_name = f"{prefix}_{base_name}_{date_str}{ext}"
+
+        jobs.append((tmpl_name, tmpl_path, save_name, template_context(tmpl_name, data, context)))
+    return entries, jobs, errors
+
+def collect_render_results(results, entries, errors):
+    """把渲染结果分别加入已生成文件和错误列表"""
+    for res in results:
+        if not res: continue
+        if "seconds" in res:
+            TEMPLATE_SECONDS.observe(res["seconds"], res["template"])
+            if "error" in res:
+                TEMPLATE_ERRORS.inc(1, res["template"])
+        if "content" in res:
+            entries.append((res["name"], res["content"]))
+        elif "error" in res:
+            # 堆栈来自渲染进程，作为字段记录在同一条日志中
+            logger.error(f"❌ {res['error']}", extra={"fields": {
+                "event": "render_error",
+                "template": res.get("template"),
+                "exc": res.get("traceback", "")[-LOG_EXC_MAX_CHARS:],
+            }})
+            errors.append(res["error"])
+
+# 文件包另存一份到 output 目录作为留档（默认开启，与以前一致；BANK_SAVE_OUTPUT_COPY=0 关闭）
+SAVE_OUTPUT_COPY = os.environ.get("BANK_SAVE_OUTPUT_COPY", "1") == "1"
+
+DOCX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+def attachment_headers(filename):
+    """下载文件名响应头（与 FileResponse 的处理方式一致，支持中文文件名）"""
+    quoted = urllib.parse.quote(filename)
+    if quoted != filename:
+        return {"Content-Disposition": f"attachment; filename*=utf-8''{quoted}"}
+    return {"Content-Disposition": f'attachment; filename="{filename}"'}
+
+def build_zip(entries):
+    """在内存中打包 [(文件名, 内容)]"""
+    with timed("zip"):
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as zf:
+            for name, content in entries:
+                zf.writestr(name, content)
+        content = buf.getvalue()
+    BYTES_WRITTEN.inc(len(content), "zip")
+    return content
+
+def save_output_copy(zip_name, content):
+    """另存文件包，返回保存的路径；未开启或保存失败时返回 None"""
+    if not SAVE_OUTPUT_COPY:
+        return None
+    path = os.path.join(OUTPUT_DIR, zip_name)
+    try:
+        with timed("output_copy"):
+            os.makedirs(OUTPUT_DIR, exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(content)
+        BYTES_WRITTEN.inc(len(content), "output_copy")
+        return path
+    except Exception as e:
+        logger.warning(f"文件包另存失败: {e}")
+        return None
+
+def archive_package(zip_name, content):
+    """文件包留档：另存到 output 目录，并把其中的数据存档加入历史存档索引"""
+    saved_path = save_output_copy(zip_name, content)
+    index_package_archives(zip_name, saved_path, lambda: zip_archive_texts(io.BytesIO(content)))
+
+class _ZipStreamBuffer:
+    """只追加的写缓冲，zipfile 写入后由生成器取走已写出的字节"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+class ZipPackageStream:
+    """
+    边渲染边输出的 ZIP 流
+    先写入已就绪的文件，之后模板每渲染完成一个就写入一个；中途失败的模板记入 生成错误.txt
+    """
+
+    def __init__(self, zip_name, entries, futures):
+        self.zip_name = zip_name
+        self._futures = futures
+        # 生成器在工作线程中执行，close() 不能直接关闭；停止标志由生成器在写入每个文件前检查
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.chunks = self._generate(entries)
+
+    def _generate(self, entries):
+        buf = _ZipStreamBuffer()
+        errors = []
+        copy_file = None
+        saved_path = os.path.join(OUTPUT_DIR, self.zip_name)
+        if SAVE_OUTPUT_COPY:
+            os.makedirs(OUTPUT_DIR, exist_ok=True)
+            # 先写临时文件，完整写出后再替换：中途断开不会留下不完整的包，也不会覆盖之前完整的同名文件
+            copy_file = open(saved_path + ".part", "wb")
+        completed = False
+        try:
+            with zipfile.ZipFile(buf, 'w') as zf:
+                for name, content in entries:
+                    if self._stop.is_set():
+                        return
+                    zf.writestr(name, content)
+                    yield from self._emit(buf, copy_file)
+                for future in as_completed(self._futures):
+                    if self._stop.is_set():
+                        return
+                    results = []
+                    collect_render_results([future.result()], results, errors)
+                    for name, content in results:
+                        zf.writestr(name, content)
+                    yield from self._emit(buf, copy_file)
+                if errors:
+                    zf.writestr("生成错误.txt", "\n".join(errors))
+            yield from self._emit(buf, copy_file)
+            completed = True
+        finally:
+            if copy_file is not None:
+                copy_file.close()
+                if not completed:
+                    with contextlib.suppress(OSError):
+                        os.remove(copy_file.name)
+        # 完整输出后才替换为正式文件并加入存档索引（客户端中途断开时不会执行到这里）
+        if copy_file is None:
+            saved_path = None
+        else:
+            try:
+                os.replace(copy_file.name, saved_path)
+            except OSError as e:
+                logger.warning(f"文件包另存失败: {e}")
+                saved_path = None
+        index_package_archives(self.zip_name, saved_path,
+                               lambda: [(name, content.decode("utf-8-sig")) for name, content in entries if is_archive_name(name)])
+
+    @staticmethod
+    def _emit(buf, copy_file):
+        data = buf.drain()
+        if data:
+            BYTES_WRITTEN.inc(len(data), "zip_stream")
+            if copy_file is not None:
+                copy_file.write(data)
+            yield data
+
+    def next_chunk(self):
+        """取下一块（在工作线程中调用），None 表示结束；已停止时由本线程关闭生成器"""
+        with self._lock:
+            chunk = None if self._stop.is_set() else next(self.chunks, None)
+            if self._stop.is_set():
+                self.chunks.close()
+                return None
+            return chunk
+
+    def close(self):
+        """停止输出，可在任意线程调用：取消未开始的渲染；生成器正在执行时留给执行它的线程关闭"""
+        self._stop.set()
+        for future in self._futures:
+            future.cancel()
+        if self._lock.acquire(blocking=False):
+            try:
+                self.chunks.close()
+            finally:
+                self._lock.release()
+
+@app.post("/api/generate")
+async def generate_contract(data: ContractRequest, stream: bool = False):
+    """生成业务文件包；stream=true 时第一个模板渲染完成即开始分块返回 ZIP"""
+    await preflight_templates(data.selected_templates)
+    if stream:
+        return await generate_contract_stream(data)
+    async with admission.slot():
+        return await run_blocking(generate_contract_sync, data)
+
+async def generate_contract_stream(data: ContractRequest):
+    await admission.acquire()
+    try:
+        package = await run_blocking(start_package_stream, data)
+    except BaseException:
+        admission.release()
+        raise
+
+    async def body():
+        try:
+            try:
+                while True:
+                    chunk = await run_blocking(package.next_chunk)
+                    if chunk is None:
+                        break
+                    yield chunk
+            finally:
+                package.close()
+        finally:
+            # 客户端断开时 close() 即使出错也要归还名额
+            admission.release()
+
+    return StreamingResponse(body(), media_type='application/zip', headers=attachment_headers(package.zip_name))
+
+def start_package_stream(data: ContractRequest):
+    """提交渲染任务并等到第一个模板完成；此前的错误仍以 500 返回"""
+    log_generate_request(data)
+    try:
+        with timed("context"):
+            context = build_complete_context(data, template_context_keys(data.selected_templates))
+        prefix = package_prefix(data)
+        date_str = datetime.now().strftime('%Y%m%d')
+        with timed("prepare"):
+            entries, jobs, errors = prepare_package(data, context, prefix, date_str)
+        if errors:
+            raise Exception("\n".join(errors))
+        futures = render_backend.submit_all(render_template_job, jobs)
+        if futures:
+            with timed("first_render"):
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            first_errors = [f.result()["error"] for f in done if "error" in f.result()]
+            if first_errors:
+                for f in futures: f.cancel()
+                raise Exception("\n".join(first_errors))
+        return ZipPackageStream(f"{prefix}_业务文件包_{date_str}.zip", entries, futures)
+    except Exception as e:
+        raise generate_error_response(data, e)
+
+def log_generate_request(data: ContractRequest):
+    """记录生成请求：摘要每次记录；完整请求数据方便排查数据问题，按配置截断和抽样"""
+    fields = {
+        "event": "generate_request",
+        "customer_type": data.customer_type,
+        "loan_amount": data.loan_amount,
+        "templates": data.selected_templates,
+    }
+    if LOG_PAYLOAD_CHARS > 0 and random.random() < LOG_PAYLOAD_SAMPLE:
+        try:
+            payload = data.model_dump_json()
+            fields["payload"] = payload[:LOG_PAYLOAD_CHARS]
+            if len(payload) > LOG_PAYLOAD_CHARS:
+                fields["payload_size"] = len(payload)
+        except Exception:
+            pass
+    logger.info("收到生成请求", extra={"fields": fields})
+
+def generate_error_response(data: ContractRequest, e: Exception) -> HTTPException:
+    """记录生成失败的详细信息，并转换为返回给前端的 HTTPException"""
+    logger.error(f"❌ 生成文件时发生错误: {type(e).__name__}: {e}", exc_info=e, extra={"fields": {
+        "event": "generate_error",
+        "error_type": type(e).__name__,
+        "templates": getattr(data, 'selected_templates', None),
+    }})
+    
+    if hasattr(e, 'status_code') and e.status_code == 422:
+        return HTTPException(status_code=422, detail=f"数据验证失败: {e.detail}")
+    
+    # 返回更详细的错误信息
+    error_msg = f"{type(e).__name__}: {str(e)}"
+    return HTTPException(status_code=500, detail=error_msg)
+
+def generate_contract_sync(data: ContractRequest):
+    log_generate_request(data)
+    try:
+        zip_name, content = build_package(data)
+        archive_package(zip_name, content)
+        return Response(content, media_type='application/zip', headers=attachment_headers(zip_name))
+    except Exception as e:
+        raise generate_error_response(data, e)
+
+def build_package(data: ContractRequest, progress=None, cancel_event=None):
+    """
+    生成单个客户的业务文件包，返回 (ZIP 文件名, ZIP 内容)；任一模板失败时抛出异常
+    progress 为可选的进度接收对象（见 GenerationJob）
+    """
+    # 🌟 统一文件名格式
+    date_str = datetime.now().strftime('%Y%m%d')
+    prefix = package_prefix(data)
+    zip_name = f"{prefix}_业务文件包_{date_str}.zip"
+
+    # 相同请求 + 相同模板版本直接返回缓存的文件包（需在 prepare_package 修改 data 之前计算）
+    versions = template_versions(data.selected_templates) if render_cache.enabled else None
+    fingerprint = request_fingerprint(data, date_str) if versions is not None else None
+    if fingerprint:
+        package_key = cache_key("zip", RENDER_CACHE_VERSION, SYSTEM_DATA_FORMAT, fingerprint, versions)
+        with timed("cache_lookup"):
+            content = render_cache.get(package_key)
+        if content is not None:
+            logger.info(f"♻️ 文件包命中缓存: {zip_name}")
+            if progress is not None:
+                progress.start(0)
+            return zip_name, content
+
+    # ✨✨✨ 使用统一的context构建函数，只构建所选模板用到的变量 ✨✨✨
+    with timed("context"):
+        context = build_complete_context(data, template_context_keys(data.selected_templates))
+    logger.debug(f"✅ Context构建完成，共 {len(context)} 个键")
+    logger.debug(f"关键字段检查 - spouse: {'存在' if context.get('spouse') else '缺失'}, guarantor1: {'存在' if context.get('guarantor1') else '缺失'}")
+    
+    with timed("prepare"):
+        generated_files, jobs, errors = prepare_package(data, context, prefix, date_str)
+    if progress is not None:
+        progress.start(len(jobs))
+    with timed("render"):
+        results = render_with_cache(jobs, fingerprint, versions, progress, cancel_event)
+    
+    # 收集成功的文件和错误
+    collect_render_results(results, generated_files, errors)
+    
+    # 如果有任何错误，抛出异常给前端显示
+    if errors:
+        raise Exception("\n".join(errors))
         
-        return FileResponse(
-            path=temp_file,
-            filename=filename,
-            media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+    if not generated_files:
+         raise Exception("未生成任何文件，请检查模版选择")
+
+    content = build_zip(generated_files)
+    if fingerprint:
+        render_cache.put(package_key, content)
+    return zip_name, content
+
+def decode_archive(archive: ArchiveText):
+    try:
+        decoded = extract_system_data(archive.content)
+    except SystemDataError as e:
+        return {"name": archive.name, "ok": False, "error": str(e)}
+    if decoded is None:
+        return {"name": archive.name, "ok": False, "error": "未找到存档数据"}
+    version, schema, data = decoded
+    return {"name": archive.name, "ok": True, "format": version, "schema": schema, "data": data}
+
+@app.post("/api/archives/decode")
+async def decode_archives(req: ArchiveDecodeRequest):
+    """批量解析数据存档 txt（新旧格式均可），逐个返回其中的业务数据或错误原因"""
+    results = await run_blocking(lambda: [decode_archive(a) for a in req.archives])
+    return {"results": results}
+
+# ============= 批量生成 =============
+
+# 单次批量生成的客户数上限
+BATCH_MAX_CUSTOMERS = int(os.environ.get("BANK_BATCH_MAX_CUSTOMERS", "500"))
+
+def parse_id_card(id_card):
+    """从18位身份证号解析性别和出生日期（与前端 parseIdCard 一致）"""
+    id_card = (id_card or "").strip()
+    if len(id_card) != 18 or not id_card[:17].isdigit():
+        return {}
+    try:
+        birthday = datetime.strptime(id_card[6:14], "%Y%m%d").strftime("%Y-%m-%d")
+    except ValueError:
+        return {}
+    return {
+        "gender": "男" if int(id_card[16]) % 2 == 1 else "女",
+        "birthday": birthday,
+        "age": calculate_age(id_card),
+    }
+
+def _party_from_customer(name, id_card, mobile):
+    return Person(
+        name=name,
+        id_type="营业执照" if id_card.startswith("91") else "身份证",
+        id_card=id_card,
+        mobile=mobile,
+        **parse_id_card(id_card),
+    )
+
+def customer_to_request(customer, batch: BatchRequest, branches) -> ContractRequest:
+    """把到期清单中的一行客户映射为 ContractRequest（与前端选择到期客户时的填充逻辑一致）"""
+    main = _party_from_customer(customer["main_name"], customer["main_id_card"], customer["main_mobile"])
+    main.address = customer["main_address"]
+    is_enterprise = customer["customer_type"] == "enterprise" or customer["main_id_card"].startswith("91")
+    enterprise = None
+    if is_enterprise:
+        enterprise = Enterprise(
+            name=customer["main_name"],
+            credit_code=customer["main_id_card"],
+            address=customer["main_address"],
         )
-    
+    spouse = None
+    if customer["spouse_name"]:
+        spouse = _party_from_customer(customer["spouse_name"], customer["spouse_id_card"], customer["spouse_mobile"])
+    branch = next((b for b in branches if b.get("short_name") == customer["branch_short_name"]), None)
+    return ContractRequest(
+        customer_type="enterprise" if is_enterprise else "personal",
+        loan_type=batch.loan_type,
+        branch=BranchInfo(**branch) if branch else BranchInfo(short_name=customer["branch_short_name"]),
+        main_borrower=main,
+        spouse=spouse,
+        enterprise=enterprise,
+        joint_borrowers=[_party_from_customer(p["name"], p["id_card"], p["mobile"]) for p in customer["joint_borrowers"]],
+        guarantors=[_party_from_customer(p["name"], p["id_card"], p["mobile"]) for p in customer["guarantors"]],
+        selected_templates=batch.selected_templates,
+    )
+
+def select_batch_customers(batch: BatchRequest):
+    """按请求筛选客户，返回 [(客户ID, 客户)]"""
+    if customer_cache.get() is None:
+        raise HTTPException(status_code=404, detail="未找到到期清单文件")
+    store = customer_cache.store
+    if batch.customer_ids:
+        found = {cid: store.get(cid) for cid in batch.customer_ids}
+        missing = [cid for cid, c in found.items() if c is None]
+        if missing:
+            raise HTTPException(status_code=404, detail=f"客户不存在或到期清单已更新: {', '.join(missing)}")
+        return [(cid, found[cid]) for cid in batch.customer_ids]
+    if not (batch.branch_short_name or batch.due_from or batch.due_to):
+        raise HTTPException(status_code=400, detail="请指定客户或筛选条件（支行/到期日）")
+    return store.query(batch.branch_short_name, batch.due_from, batch.due_to)
+
+@app.post("/api/generate-batch")
+async def generate_batch(batch: BatchRequest):
+    """批量生成多个到期客户的业务文件包，打包为一个 ZIP（每个客户一个文件夹）"""
+    await preflight_templates(batch.selected_templates)
+    async with admission.slot():
+        return await run_blocking(generate_batch_sync, batch)
+
+def generate_batch_sync(batch: BatchRequest):
+    try:
+        zip_name, content = build_batch(batch)
+        archive_package(zip_name, content)
+        return Response(content, media_type='application/zip', headers=attachment_headers(zip_name))
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error("="*60)
-        logger.error("❌ 生成调查报告时发生错误")
-        logger.error(f"错误类型: {type(e).__name__}")
-        logger.error(f"错误信息: {str(e)}")
-        logger.error("详细堆栈:")
+        logger.error(f"❌ 批量生成失败: {type(e).__name__}: {e}")
         logger.error(traceback.format_exc())
-        logger.error("="*60)
-        
-        error_msg = f"{type(e).__name__}: {str(e)}"
-        raise HTTPException(status_code=500, detail=error_msg)
+        raise HTTPException(status_code=500, detail=f"{type(e).__name__}: {str(e)}")
+
+def build_batch(batch: BatchRequest, progress=None, cancel_event=None):
+    """批量生成，返回 (ZIP 文件名, ZIP 内容)；参数错误以 HTTPException 抛出"""
+    if not batch.selected_templates:
+        raise HTTPException(status_code=400, detail="请选择模板")
+    customers = select_batch_customers(batch)
+    if not customers:
+        raise HTTPException(status_code=404, detail="没有符合条件的客户")
+    if len(customers) > BATCH_MAX_CUSTOMERS:
+        raise HTTPException(status_code=400, detail=f"单次最多生成 {BATCH_MAX_CUSTOMERS} 个客户，当前 {len(customers)} 个")
+    logger.info(f"====== 收到批量生成请求: {len(customers)} 个客户 ======")
+
+    branches = config_registry.branches
+    # 所有客户使用同一组模板，只需分析一次
+    context_keys = template_context_keys(batch.selected_templates)
+
+    task_id = uuid.uuid4().hex[:8]
+    date_str = datetime.now().strftime('%Y%m%d')
+
+    # 1. 所有客户的渲染任务一次性提交，模板在渲染进程中复用
+    packages = []   # [(文件夹名, 已生成文件, 错误)]
+    all_jobs = []
+    job_owner = []  # 每个任务对应 packages 中的序号
+    used_folders = set()
+    for cid, customer in customers:
+        data = customer_to_request(customer, batch, branches)
+        prefix = package_prefix(data)
+        folder = f"{prefix}_{customer['main_id_card'][-4:]}" if customer["main_id_card"] else prefix
+        if folder in used_folders:
+            folder = f"{folder}_{cid[:6]}"
+        used_folders.add(folder)
+        try:
+            with timed("prepare"):
+                files, jobs, errors = prepare_package(data, build_complete_context(data, context_keys), prefix, date_str)
+        except Exception as e:
+            logger.error(f"❌ 客户[{prefix}]准备失败: {e}")
+            logger.error(traceback.format_exc())
+            files, jobs, errors = [], [], [f"{type(e).__name__}: {str(e)}"]
+        job_owner.extend([len(packages)] * len(jobs))
+        all_jobs.extend(jobs)
+        packages.append((folder, files, errors))
+
+    if progress is not None:
+        progress.start(len(all_jobs))
+    with timed("render"):
+        results = render_backend.map(render_template_job, all_jobs, progress and progress.advance, cancel_event)
+    for owner, res in zip(job_owner, results):
+        collect_render_results([res], packages[owner][1], packages[owner][2])
+
+    # 2. 汇总：失败的客户写入结果说明，不影响其他客户
+    summary = []
+    ok_count = 0
+    for folder, files, errors in packages:
+        if errors:
+            summary.append(f"[失败] {folder}: " + "；".join(errors))
+        else:
+            ok_count += 1
+            summary.append(f"[成功] {folder}: {len(files)} 个文件")
+    if ok_count == 0:
+        raise Exception("所有客户均生成失败:\n" + "\n".join(summary))
+
+    zip_name = f"批量业务文件包_{date_str}_{task_id}.zip"
+    entries = [("批量生成结果.txt", "\n".join(summary).encode("utf-8"))]
+    for folder, files, errors in packages:
+        if errors:
+            continue
+        entries.extend((f"{folder}/{name}", content) for name, content in files)
+    logger.info(f"批量生成完成: 成功 {ok_count} / {len(packages)}")
+    return zip_name, build_zip(entries)
+
+# ============= 异步生成任务 =============
+
+# 后台执行生成任务的线程数；完成的任务结果保留时长（秒）
+JOB_WORKERS = int(os.environ.get("BANK_JOB_WORKERS", "2"))
+JOB_RESULT_TTL = int(os.environ.get("BANK_JOB_RESULT_TTL", "3600"))
+# 未完成（排队中 + 执行中）的任务数上限，超出时返回 503 + Retry-After
+MAX_JOBS = int(os.environ.get("BANK_MAX_JOBS", "16"))
+
+class GenerationJob:
+    """一个后台生成任务：状态、进度事件和结果"""
+
+    def __init__(self, kind, label):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.label = label
+        self.status = "queued"    # queued / running / done / failed / cancelled
+        self.total = 0
+        self.completed = 0
+        self.error = None
+        self.zip_name = None
+        self.content = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.events = []          # 进度事件，SSE 按序号推送
+        self.cancel_event = threading.Event()
+        self.future = None
+        self._lock = threading.Lock()
+
+    def _emit(self, event, **payload):
+        with self._lock:
+            self.events.append({"event": event, "data": {"job_id": self.id, **payload}})
+
+    def start(self, total):
+        self.total = total
+        self._emit("start", total=total)
+
+    def advance(self, result):
+        self.completed += 1
+        self._emit(
+            "progress",
+            completed=self.completed,
+            total=self.total,
+            file=result.get("name"),
+            error=result.get("error"),
+        )
+
+    def finish(self, status, error=None):
+        self.status = status
+        self.error = error
+        self.finished_at = time.time()
+        self._emit(status, error=error, zip_name=self.zip_name)
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "label": self.label,
+            "status": self.status,
+            "total": self.total,
+            "completed": self.completed,
+            "error": self.error,
+            "zip_name": self.zip_name,
+            "created_at": self.created_at,
+        }
+
+class JobManager:
+    """
+    后台生成任务管理
+    任务在独立线程池中编排，实际渲染仍交给 render_backend；结果保存在内存中，过期后清理
+    """
+
+    def __init__(self, workers, ttl, max_jobs):
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def active(self):
+        """未完成的任务数"""
+        return sum(1 for job in list(self._jobs.values()) if job.finished_at is None)
+
+    def submit(self, kind, label, build, *args):
+        self._purge()
+        job = GenerationJob(kind, label)
+        with self._lock:
+            active = self.active
+            if active >= self.max_jobs:
+                logger.warning(f"⚠️ 任务被拒绝：未完成任务 {active}")
+                raise HTTPException(
+                    status_code=503,
+                    detail="任务过多，请稍后重试",
+                    headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+                )
+            self._jobs[job.id] = job
+        job.future = self._executor.submit(self._run, job, build, *args)
+        logger.info(f"任务已提交: {job.id} ({kind} | {label})")
+        return job
+
+    def _run(self, job, build, *args):
+        if job.cancel_event.is_set():
+            job.finish("cancelled")
+            return
+        job.status = "running"
+        # 任务日志以任务ID关联，不受单请求日志上限限制
+        _log_context.set(LogContext(f"job-{job.id[:12]}"))
+        try:
+            job.zip_name, job.content = build(*args, progress=job, cancel_event=job.cancel_event)
+            archive_package(job.zip_name, job.content)
+            job.finish("done")
+        except JobCancelled:
+            job.finish("cancelled")
+        except HTTPException as e:
+            job.finish("failed", str(e.detail))
+        except Exception as e:
+            logger.error(f"❌ 任务 {job.id} 失败: {type(e).__name__}: {e}", exc_info=e)
+            job.finish("failed", f"{type(e).__name__}: {str(e)}")
+
+    def get(self, job_id):
+        self._purge()
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        job.cancel_event.set()
+        # 尚未开始的任务直接取消
+        if job.future is not None and job.future.cancel():
+            job.finish("cancelled")
+        return job
+
+    def _purge(self):
+        now = time.time()
+        with self._lock:
+            expired = [jid for jid, job in self._jobs.items()
+                       if job.finished_at and now - job.finished_at > self.ttl]
+            for jid in expired:
+                del self._jobs[jid]
+
+    def _watch(self):
+        # 没有新的提交和查询时也按时释放过期结果占用的内存
+        while not self._stop.wait(min(max(self.ttl, 1), 60)):
+            self._purge()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watch, name="job-purge", daemon=True)
+            self._thread.start()
+
+    def shutdown(self):
+        self._stop.set()
+        for job in list(self._jobs.values()):
+            job.cancel_event.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+job_manager = JobManager(JOB_WORKERS, JOB_RESULT_TTL, MAX_JOBS)
+register_metric(Gauge("bank_jobs_active", "未完成的后台生成任务数", lambda: job_manager.active))
+
+def _get_job_or_404(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
+    return job
+
+@app.post("/api/jobs/generate")
+async def submit_generate_job(data: ContractRequest):
+    """提交单个客户的生成任务，立即返回任务ID"""
+    await preflight_templates(data.selected_templates)
+    log_generate_request(data)
+    job = job_manager.submit("generate", package_prefix(data), build_package, data)
+    return job.to_dict()
+
+@app.post("/api/jobs/generate-batch")
+async def submit_batch_job(batch: BatchRequest):
+    """提交批量生成任务，立即返回任务ID"""
+    await preflight_templates(batch.selected_templates)
+    label = f"{len(batch.customer_ids)} 个客户" if batch.customer_ids else (batch.branch_short_name or f"{batch.due_from}~{batch.due_to}")
+    job = job_manager.submit("batch", label, build_batch, batch)
+    return job.to_dict()
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    return _get_job_or_404(job_id).to_dict()
+
+@app.get("/api/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+    """以 SSE 推送任务进度：start / progress（每个模板一次）/ done / failed / cancelled"""
+    job = _get_job_or_404(job_id)
+
+    async def events():
+        cursor = 0
+        idle = 0.0
+        while True:
+            pending = job.events[cursor:]
+            for item in pending:
+                yield f"event: {item['event']}\ndata: {json.dumps(item['data'], ensure_ascii=False)}\n\n"
+            cursor += len(pending)
+            if job.finished_at and cursor >= len(job.events):
+                break
+            if pending:
+                idle = 0.0
+            elif idle >= 15:
+                # 保持连接，避免代理断开空闲连接
+                yield ": keep-alive\n\n"
+                idle = 0.0
+            await asyncio.sleep(0.2)
+            idle += 0.2
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.get("/api/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    job = _get_job_or_404(job_id)
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail=f"任务尚未完成（{job.status}）")
+    return Response(job.content, media_type='application/zip', headers=attachment_headers(job.zip_name))
+
+@app.delete("/api/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
+    return job.to_dict()
+
+def drop_nulls(value):
+    """去掉 JSON 中的 null（对象的字段、数组的元素），缺少的字段按模型默认值处理"""
+    if isinstance(value, dict):
+        return {k: drop_nulls(v) for k, v in value.items() if v is not None}
+    if isinstance(value, list):
+        return [drop_nulls(v) for v in value if v is not None]
+    return value
+
+@app.post("/api/generate-investigation-report")
+async def generate_investigation_report(data: dict):
+    """
+    生成客户调查报告（简洁版）- 接受部分数据，在内存中渲染后直接返回
+    缺少的字段和值为 null 的字段按默认值处理；字段类型不符（如金额不是数字）时返回 422
+    """
+    try:
+        request = ContractRequest.model_validate(drop_nulls(data))
+    except ValidationError as e:
+        # 与 FastAPI 校验请求体的错误格式一致
+        raise RequestValidationError([{**err, "loc": ("body", *err["loc"])} for err in e.errors()])
+    async with admission.slot():
+        return await run_blocking(generate_investigation_report_sync, request)
+
+def generate_investigation_report_sync(data: ContractRequest):
+    template_path = os.path.join(TEMPLATE_DIR, INVESTIGATION_TEMPLATE)
+    if not os.path.exists(template_path):
+        raise HTTPException(status_code=404, detail="报告模板不存在")
+
+    borrower_name = data.main_borrower.name if data.main_borrower and data.main_borrower.name else str(data.loan_amount)
+    filename = f"调查报告_{borrower_name}_{datetime.now().strftime('%Y%m%d%H%M%S')}.docx"
+    # 与 /api/generate 相同：只构建模板引用的变量，再合并调查报告摘要，交给渲染进程池渲染到内存
+    context = build_complete_context(data, template_context_keys([INVESTIGATION_TEMPLATE]))
+    job = (INVESTIGATION_TEMPLATE, template_path, filename, template_context(INVESTIGATION_TEMPLATE, data, context))
+    with timed("render"):
+        results = render_backend.map(render_template_job, [job])
+    entries, errors = [], []
+    collect_render_results(results, entries, errors)
+    if errors:
+        logger.error(f"❌ 生成调查报告失败: {errors[0]}",
+                     extra={"fields": {"event": "investigation_report_error", "template": INVESTIGATION_TEMPLATE}})
+        raise HTTPException(status_code=500, detail=errors[0])
+
+    content = entries[0][1]
+    BYTES_WRITTEN.inc(len(content), "investigation_report")
+    logger.info(f"生成调查报告: {filename}")
+    return Response(content, media_type=DOCX_MEDIA_TYPE, headers=attachment_headers(filename))
 
 if __name__ == "__main__":
+    # PyInstaller 打包后渲染进程池需要
+    multiprocessing.freeze_support()
     import uvicorn
     import socket
     import webbrowser
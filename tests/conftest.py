@@ -0,0 +1,30 @@
+"""
+测试公共夹具：在临时目录中导入 main（app.log、客户库、存档索引、输出目录都在 CWD 下），
+整个测试会话共用一个 TestClient，lifespan 只启动/关闭一次。
+"""
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def main_module(tmp_path_factory):
+    with pytest.MonkeyPatch.context() as mp:
+        mp.chdir(tmp_path_factory.mktemp("bank"))
+        # 渲染用线程，不启动渲染进程；不写渲染缓存
+        mp.setenv("BANK_RENDER_BACKEND", "thread")
+        mp.setenv("BANK_RENDER_CACHE_MB", "0")
+        mp.syspath_prepend(ROOT_DIR)
+        import main
+        yield main
+
+
+@pytest.fixture(scope="session")
+def client(main_module):
+    from fastapi.testclient import TestClient
+
+    with TestClient(main_module.app) as c:
+        yield c
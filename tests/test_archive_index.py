@@ -0,0 +1,50 @@
+"""
+历史存档索引：单个文件无法读取或数据结构不对时记入 archive_files.error，其余文件照常入库
+"""
+import contextlib
+import os
+import zipfile
+
+
+def archive_text(main_module, data):
+    return f"====== 业务录入辅助报告 ======\nSYSTEM_DATA_START:{main_module.encode_system_data(data)}:SYSTEM_DATA_END\n"
+
+
+def person(name, id_card):
+    return {"customer_type": "personal", "main_borrower": {"name": name, "id_card": id_card}}
+
+
+def test_bad_file_does_not_stop_indexing(main_module, tmp_path):
+    root = tmp_path / "archives"
+    root.mkdir()
+    (root / "张三_数据存档_20260101.txt").write_text(archive_text(main_module, person("张三", "330102199001011234")), encoding="utf-8")
+    with zipfile.ZipFile(root / "李四_业务文件包_20260102.zip", "w") as zf:
+        zf.writestr("李四_数据存档_20260102.txt", archive_text(main_module, person("李四", "330102199202021234")))
+    # 数据结构不对：enterprise 应为对象
+    (root / "坏企业_数据存档_20260103.txt").write_text(
+        archive_text(main_module, {"customer_type": "enterprise", "enterprise": "坏企业"}), encoding="utf-8")
+    # zip 内的存档压缩数据损坏
+    broken = root / "王五_业务文件包_20260104.zip"
+    with zipfile.ZipFile(broken, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("王五_数据存档_20260104.txt", archive_text(main_module, person("王五", "330102199303031234")) * 20)
+    content = bytearray(broken.read_bytes())
+    start = len("PK\x03\x04") + 26 + len("王五_数据存档_20260104.txt".encode("utf-8"))
+    content[start:start + 16] = b"\xff" * 16
+    broken.write_bytes(bytes(content))
+
+    index = main_module.ArchiveIndex(str(tmp_path / "archive_index.db"))
+    stats = index.scan([str(root)])
+
+    assert stats["files"] == 4
+    assert stats["archives"] == 2
+    assert stats["errors"] == 2
+    assert sorted(item["name"] for item in index.search()["items"]) == ["张三", "李四"]
+    with contextlib.closing(index._connect()) as conn:
+        errors = {os.path.basename(row["path"]): row["error"] for row in conn.execute("SELECT path, error FROM archive_files")}
+    assert errors["张三_数据存档_20260101.txt"] is None
+    assert errors["李四_业务文件包_20260102.zip"] is None
+    assert "AttributeError" in errors["坏企业_数据存档_20260103.txt"]
+    assert errors["王五_业务文件包_20260104.zip"]
+    # 坏文件没有留下半条记录
+    with contextlib.closing(index._connect()) as conn:
+        assert conn.execute("SELECT count(*) FROM archive_fts").fetchone()[0] == 2
@@ -0,0 +1,47 @@
+"""
+/api/generate-investigation-report：部分数据（含 null 字段）也能生成报告
+"""
+import io
+import re
+import zipfile
+
+DOCX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+
+def report_text(content):
+    xml = zipfile.ZipFile(io.BytesIO(content)).read("word/document.xml").decode("utf-8")
+    return re.sub(r"<[^>]+>", "", xml)
+
+
+def test_partial_body_with_nulls(client):
+    r = client.post("/api/generate-investigation-report", json={
+        "loan_amount": None,
+        "loan_use": None,
+        "main_borrower": {"name": "张三", "id_card": "330102199001011234", "gender": None, "mobile": None},
+        "spouse": None,
+        "joint_borrowers": [None],
+        "guarantors": None,
+        "collaterals": [{"type": "房产", "value": 120000, "area": None}],
+    })
+    assert r.status_code == 200
+    assert r.headers["content-type"] == DOCX_MEDIA_TYPE
+    assert "attachment" in r.headers["content-disposition"]
+    text = report_text(r.content)
+    assert "张三" in text
+    assert "壹拾贰万元整" in text
+
+
+def test_null_main_borrower(client):
+    r = client.post("/api/generate-investigation-report", json={"main_borrower": None, "loan_amount": 50000})
+    assert r.status_code == 200
+    assert "伍万元整" in report_text(r.content)
+
+
+def test_empty_body(client):
+    assert client.post("/api/generate-investigation-report", json={}).status_code == 200
+
+
+def test_wrong_type_is_rejected(client):
+    r = client.post("/api/generate-investigation-report", json={"loan_amount": "abc"})
+    assert r.status_code == 422
+    assert r.json()["detail"][0]["loc"] == ["body", "loan_amount"]
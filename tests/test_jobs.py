@@ -0,0 +1,76 @@
+"""
+后台生成任务：未完成任务数超过上限时返回 503，过期结果在查询时清理
+"""
+import io
+import threading
+import time
+import zipfile
+
+import pytest
+from fastapi import HTTPException
+
+
+def empty_zip():
+    buf = io.BytesIO()
+    zipfile.ZipFile(buf, "w").close()
+    return buf.getvalue()
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+@pytest.fixture
+def gate():
+    gate = threading.Event()
+    yield gate
+    gate.set()
+
+
+def blocked_build(gate, progress=None, cancel_event=None):
+    gate.wait(10)
+    return "测试_业务文件包.zip", empty_zip()
+
+
+def test_queue_limit(main_module, gate):
+    manager = main_module.JobManager(1, 3600, 2)
+    try:
+        running = manager.submit("generate", "甲", blocked_build, gate)
+        manager.submit("generate", "乙", blocked_build, gate)
+        with pytest.raises(HTTPException) as exc:
+            manager.submit("generate", "丙", blocked_build, gate)
+        assert exc.value.status_code == 503
+        assert exc.value.headers["Retry-After"] == str(main_module.RETRY_AFTER_SECONDS)
+        # 任务完成后名额释放
+        gate.set()
+        assert wait_until(lambda: manager.active == 0)
+        assert manager.get(running.id).status == "done"
+        manager.submit("generate", "丙", blocked_build, gate)
+    finally:
+        manager.shutdown()
+
+
+def test_expired_results_purged_on_read(main_module, gate):
+    manager = main_module.JobManager(1, 0.05, 2)
+    try:
+        gate.set()
+        job = manager.submit("generate", "甲", blocked_build, gate)
+        assert wait_until(lambda: job.finished_at is not None)
+        time.sleep(0.1)
+        assert manager.get(job.id) is None
+    finally:
+        manager.shutdown()
+
+
+def test_submit_endpoint_returns_503(main_module, client, monkeypatch):
+    manager = main_module.JobManager(1, 3600, 0)
+    monkeypatch.setattr(main_module, "job_manager", manager)
+    try:
+        r = client.post("/api/jobs/generate", json={"main_borrower": {"name": "张三"}})
+        assert r.status_code == 503
+        assert "Retry-After" in r.headers
+    finally:
+        manager.shutdown()
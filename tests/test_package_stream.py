@@ -0,0 +1,97 @@
+"""
+/api/generate?stream=true：客户端中途断开时归还准入名额，生成器由执行它的线程关闭，
+output 目录不留下不完整的文件包
+"""
+import asyncio
+import io
+import os
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+
+@pytest.fixture
+def gated_stream(main_module, monkeypatch):
+    """模板渲染卡在 gate 上的文件包流"""
+    gate = threading.Event()
+    executor = ThreadPoolExecutor(1)
+    packages = []
+
+    def render():
+        gate.wait(10)
+        return {"name": "合同.docx", "content": b"docx"}
+
+    def start(data):
+        package = main_module.ZipPackageStream("测试_业务文件包.zip", [("说明.txt", b"x")], [executor.submit(render)])
+        packages.append(package)
+        return package
+
+    monkeypatch.setattr(main_module, "SAVE_OUTPUT_COPY", True)
+    monkeypatch.setattr(main_module, "admission", main_module.AdmissionController(1, 0))
+    monkeypatch.setattr(main_module, "start_package_stream", start)
+    yield gate, packages
+    gate.set()
+    executor.shutdown()
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def output_path(main_module, name="测试_业务文件包.zip"):
+    return os.path.join(main_module.OUTPUT_DIR, name)
+
+
+def test_disconnect_releases_admission(main_module, gated_stream):
+    gate, packages = gated_stream
+    # 之前完整生成的同名文件包不应被覆盖
+    os.makedirs(main_module.OUTPUT_DIR, exist_ok=True)
+    with open(output_path(main_module), "wb") as f:
+        f.write(b"earlier")
+
+    async def disconnect_mid_stream():
+        response = await main_module.generate_contract_stream(None)
+        chunks = response.body_iterator
+        assert await chunks.__anext__()
+        # 第二块要等模板渲染完成，此时断开（Starlette 取消发送任务）
+        pending = asyncio.ensure_future(chunks.__anext__())
+        await asyncio.sleep(0.1)
+        pending.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await pending
+
+    asyncio.run(disconnect_mid_stream())
+    assert main_module.admission.in_flight == 0
+
+    # 渲染结束后，工作线程看到停止标志自行关闭生成器
+    gate.set()
+    package = packages[0]
+    assert wait_until(lambda: package.chunks.gi_frame is None)
+    assert not os.path.exists(output_path(main_module) + ".part")
+    with open(output_path(main_module), "rb") as f:
+        assert f.read() == b"earlier"
+
+
+def test_complete_stream_saves_copy(main_module, gated_stream):
+    gate, packages = gated_stream
+    gate.set()
+    package = main_module.start_package_stream(None)
+    content = b"".join(iter(package.next_chunk, None))
+    with open(output_path(main_module), "rb") as f:
+        assert f.read() == content
+    assert not os.path.exists(output_path(main_module) + ".part")
+    assert sorted(zipfile.ZipFile(io.BytesIO(content)).namelist()) == ["合同.docx", "说明.txt"]
+
+
+def test_close_before_start(main_module, gated_stream):
+    gate, packages = gated_stream
+    package = main_module.start_package_stream(None)
+    package.close()
+    assert package.chunks.gi_frame is None
+    assert package.next_chunk() is None
@@ -0,0 +1,66 @@
+"""
+SYSTEM_DATA 存档载荷编解码：格式不正确、数据截断、更新版本生成的载荷都返回 SystemDataError，
+/api/archives/decode 逐个返回错误原因而不是 500
+"""
+import base64
+import json
+import zlib
+
+import pytest
+
+DATA = {"loan_amount": 50000, "main_borrower": {"name": "张三"}}
+
+
+def sd2(schema, data=DATA):
+    raw = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    return f"SD2.{schema}.{base64.b64encode(zlib.compress(raw)).decode('ascii')}"
+
+
+def test_round_trip(main_module):
+    payload = main_module.encode_system_data(DATA)
+    assert main_module.decode_system_data(payload) == (2, main_module.SYSTEM_DATA_SCHEMA, DATA)
+
+
+def test_legacy_payload(main_module):
+    payload = base64.b64encode(json.dumps(DATA).encode("utf-8")).decode("ascii")
+    assert main_module.decode_system_data(payload) == (1, 1, DATA)
+
+
+@pytest.mark.parametrize("payload", ["SD2.1", "SD2.x.abc", "SD2..abc", "SD2.-1.abc", "SD2.１.abc", "."])
+def test_malformed_payload(main_module, payload):
+    with pytest.raises(main_module.SystemDataError, match="存档格式不正确"):
+        main_module.decode_system_data(payload)
+
+
+def test_unknown_format(main_module):
+    with pytest.raises(main_module.SystemDataError, match="不支持的存档格式"):
+        main_module.decode_system_data("SD9.1.abc")
+
+
+@pytest.mark.parametrize("keep", [0.3, 0.9])
+def test_truncated_payload(main_module, keep):
+    payload = main_module.encode_system_data(DATA)
+    with pytest.raises(main_module.SystemDataError, match="存档数据已损坏"):
+        main_module.decode_system_data(payload[:int(len(payload) * keep)])
+
+
+def test_newer_schema(main_module):
+    with pytest.raises(main_module.SystemDataError, match="更新版本"):
+        main_module.decode_system_data(sd2(main_module.SYSTEM_DATA_SCHEMA + 1))
+
+
+def test_decode_endpoint_reports_errors(main_module, client):
+    def archive(name, payload):
+        return {"name": name, "content": f"SYSTEM_DATA_START:{payload}:SYSTEM_DATA_END"}
+
+    r = client.post("/api/archives/decode", json={"archives": [
+        archive("好.txt", main_module.encode_system_data(DATA)),
+        archive("短.txt", "SD2.1"),
+        archive("坏.txt", "SD2.x.abc"),
+        archive("新.txt", sd2(main_module.SYSTEM_DATA_SCHEMA + 1)),
+    ]})
+    assert r.status_code == 200
+    results = r.json()["results"]
+    assert results[0]["ok"] and results[0]["data"] == DATA
+    assert [res["ok"] for res in results[1:]] == [False, False, False]
+    assert results[1]["error"] == results[2]["error"] == "存档格式不正确"